@@ -0,0 +1,79 @@
+"""Benchmark the rendering of rescaled and colormapped single band tiles.
+
+Compares `postprocess` followed by the rio-tiler colormap (as tiles were
+rendered before) with the fused `rescale_colormap`, for 256 and 512 tiles,
+reporting the time and the peak memory allocated per tile (encoding excluded).
+
+Usage
+-----
+    $ python benchmarks/colormap.py
+
+"""
+
+import time
+import tracemalloc
+
+import numpy as np
+from rio_tiler.colormap import apply_cmap, cmap
+
+from covid_api.api.utils import get_colormap_lut, postprocess, rescale_colormap
+
+RESCALE = "0,1000"
+COLORMAP = "viridis"
+
+
+def _before(tile, mask, colormap):
+    data = postprocess(tile.copy(), mask, rescale=RESCALE)
+    data, alpha = apply_cmap(data, colormap)
+    return data, mask * alpha * 255
+
+
+def _after(tile, mask, lut):
+    return rescale_colormap(tile, mask, (0, 1000), lut)
+
+
+def _timeit(func, *args, repeat=20):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def _peak_memory(func, *args):
+    func(*args)  # warm up the lookup tables and buffers
+    tracemalloc.start()
+    func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+    """Run benchmark."""
+    print(
+        f"{'size':>5} {'dtype':>8} {'before (ms)':>12} {'after (ms)':>11} "
+        f"{'speedup':>8} {'before (KiB)':>13} {'after (KiB)':>12}"
+    )
+    rng = np.random.RandomState(0)
+    colormap = cmap.get(COLORMAP)
+    lut = get_colormap_lut(COLORMAP)
+    for size in (256, 512):
+        mask = np.full((size, size), 255, dtype="uint8")
+        mask[: size // 8] = 0
+        for dtype in ("uint16", "float32"):
+            tile = (rng.random_sample((1, size, size)) * 1200).astype(dtype)
+            before = _timeit(_before, tile, mask, colormap)
+            after = _timeit(_after, tile, mask, lut)
+            before_mem = _peak_memory(_before, tile, mask, colormap)
+            after_mem = _peak_memory(_after, tile, mask, lut)
+            print(
+                f"{size:>5} {dtype:>8} {before * 1000:>12.2f} {after * 1000:>11.2f} "
+                f"{before / after:>7.1f}x {before_mem / 1024:>13.0f} "
+                f"{after_mem / 1024:>12.0f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
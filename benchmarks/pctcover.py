@@ -0,0 +1,62 @@
+"""Benchmark the coverage weights used for zonal statistics.
+
+Compares the vectorized `rasterize_pctcover` against the original shapely
+loop, on circles of increasing size rasterized at a fixed resolution.
+
+Usage
+-----
+    $ python benchmarks/pctcover.py
+
+"""
+
+import time
+
+import numpy as np
+from affine import Affine
+from rasterstats.io import bounds_window
+from shapely.geometry import Point
+
+from covid_api.api.utils import _rasterize_pctcover_shapely, rasterize_pctcover
+
+RESOLUTION = 0.01  # ~1km
+TRANSFORM = Affine(RESOLUTION, 0, -180, 0, -RESOLUTION, 90)
+
+
+def _timeit(func, *args, repeat=3, **kwargs):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    """Run benchmark."""
+    print(
+        f"{'radius':>8} {'cells':>10} {'loop (ms)':>12} {'vectorized (ms)':>16} "
+        f"{'speedup':>8} {'mean diff':>10}"
+    )
+    rng = np.random.RandomState(0)
+    for radius in (0.1, 0.5, 1, 2, 4):
+        geom = Point(-77.0, 38.9).buffer(radius, 256)
+        window = bounds_window(geom.bounds, TRANSFORM)
+        atrans = TRANSFORM * Affine.translation(window[1][0], window[0][0])
+        shape = (window[0][1] - window[0][0], window[1][1] - window[1][0])
+        values = rng.random_sample(shape)
+
+        loop, reference = _timeit(
+            _rasterize_pctcover_shapely, geom, atrans, shape, repeat=1
+        )
+        vectorized, pctcover = _timeit(rasterize_pctcover, geom, atrans, shape)
+        diff = abs(
+            np.average(values, weights=pctcover) - np.average(values, weights=reference)
+        )
+        print(
+            f"{radius:>8} {shape[0] * shape[1]:>10} {loop * 1000:>12.1f} "
+            f"{vectorized * 1000:>16.1f} {loop / vectorized:>7.0f}x {diff:>10.2e}"
+        )
+
+
+if __name__ == "__main__":
+    main()
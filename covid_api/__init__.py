@@ -2,4 +2,10 @@
 
 import pkg_resources
 
+# geojson-pydantic coordinates are `Tuple[Union[float, int], ...]`. typing caches
+# these types by equality, so if rio-tiler (imported first by `covid_api.api.utils`
+# or `covid_api.db.zonal_stats`) builds `Tuple[Union[int, float], ...]` before,
+# pydantic truncates the coordinates to int. Define the geometries first.
+import geojson_pydantic.geometries  # noqa: F401, isort:skip
+
 version = pkg_resources.get_distribution(__package__).version
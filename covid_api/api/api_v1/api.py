@@ -6,6 +6,7 @@ from covid_api.api.api_v1.endpoints import (
     metadata,
     modis,
     ogc,
+    operations,
     planet,
     sites,
     tiles,
@@ -19,6 +20,7 @@ api_router.include_router(tiles.router, tags=["tiles"])
 api_router.include_router(metadata.router, tags=["metadata"])
 api_router.include_router(ogc.router, tags=["OGC"])
 api_router.include_router(timelapse.router, tags=["timelapse"])
+api_router.include_router(operations.router, tags=["operations"])
 api_router.include_router(datasets.router, tags=["datasets"])
 api_router.include_router(sites.router, tags=["sites"])
 api_router.include_router(groups.router, tags=["indicator groups"])
@@ -5,12 +5,13 @@ from covid_api.db.memcache import CacheLayer
 from covid_api.db.static.datasets import datasets
 from covid_api.db.static.errors import InvalidIdentifier
 from covid_api.models.static import Datasets
+from covid_api.ressources.responses import ETagRoute
 
 from fastapi import APIRouter, Depends, HTTPException, Response
 
 from starlette.requests import Request
 
-router = APIRouter()
+router = APIRouter(route_class=ETagRoute)
 
 
 @router.get(
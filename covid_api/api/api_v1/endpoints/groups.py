@@ -2,10 +2,11 @@
 
 from covid_api.db.static.groups import groups
 from covid_api.models.static import IndicatorGroup, IndicatorGroups
+from covid_api.ressources.responses import ETagRoute
 
 from fastapi import APIRouter
 
-router = APIRouter()
+router = APIRouter(route_class=ETagRoute)
 
 
 @router.get(
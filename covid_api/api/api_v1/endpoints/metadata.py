@@ -7,9 +7,8 @@ from typing import Any, Dict, Optional, Union
 from urllib.parse import urlencode
 
 import numpy
-from rio_tiler.io import cogeo
 
-from covid_api.api.utils import info as cogInfo
+from covid_api.api import utils
 from covid_api.core import config
 from covid_api.models.mapbox import TileJSON
 from covid_api.ressources.enums import ImageType
@@ -20,10 +19,10 @@ from starlette.concurrency import run_in_threadpool
 from starlette.requests import Request
 from starlette.responses import Response
 
-_info = partial(run_in_threadpool, cogInfo)
-_bounds = partial(run_in_threadpool, cogeo.bounds)
-_metadata = partial(run_in_threadpool, cogeo.metadata)
-_spatial_info = partial(run_in_threadpool, cogeo.spatial_info)
+_info = partial(run_in_threadpool, utils.info)
+_bounds = partial(run_in_threadpool, utils.bounds)
+_metadata = partial(run_in_threadpool, utils.metadata)
+_spatial_info = partial(run_in_threadpool, utils.spatial_info)
 
 router = APIRouter()
 
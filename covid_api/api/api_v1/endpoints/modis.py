@@ -5,12 +5,12 @@ from typing import Any, Dict
 from rio_tiler.utils import render
 
 from covid_api.api import utils
-from covid_api.db.memcache import CacheLayer
+from covid_api.db.tiered import TieredCacheLayer
 from covid_api.ressources.common import mimetype
 from covid_api.ressources.enums import ImageType
 from covid_api.ressources.responses import TileResponse
 
-from fastapi import APIRouter, Depends, Path, Query
+from fastapi import APIRouter, BackgroundTasks, Depends, Path, Query
 
 from starlette.concurrency import run_in_threadpool
 
@@ -41,7 +41,8 @@ async def tile(
     x: int = Path(..., description="Mercator tiles's column"),
     y: int = Path(..., description="Mercator tiles's row"),
     date: str = Query(..., description="date of site for detections"),
-    cache_client: CacheLayer = Depends(utils.get_cache),
+    cache_client: TieredCacheLayer = Depends(utils.get_image_cache),
+    background_tasks: BackgroundTasks = None,
 ) -> TileResponse:
     """Handle /modis requests."""
     timings = []
@@ -52,20 +53,24 @@ async def tile(
     content = None
     if cache_client:
         try:
-            content, ext = cache_client.get_image_from_cache(tile_hash)
+            content, ext = await cache_client.get_image_from_cache(tile_hash)
             headers["X-Cache"] = "HIT"
         except Exception:
             content = None
 
     if not content:
-        with utils.Timer() as t:
-            content = await _tile(x, y, z, date)
 
-        timings.append(("Read", t.elapsed))
-        timings.append(("Format", t.elapsed))
+        async def _render_tile():
+            with utils.Timer() as t:
+                content = await _tile(x, y, z, date)
 
-        if cache_client and content:
-            cache_client.set_image_cache(tile_hash, (content, ImageType.png))
+            timings.append(("Read", t.elapsed))
+            timings.append(("Format", t.elapsed))
+            return content, ImageType.png
+
+        content, _ = await utils.get_or_render_image(
+            cache_client, tile_hash, _render_tile, background_tasks
+        )
 
     if timings:
         headers["X-Server-Timings"] = "; ".join(
@@ -2,12 +2,12 @@
 
 from urllib.parse import urlencode
 
-import rasterio
 from rasterio import warp
 from rio_tiler import constants
 from rio_tiler.mercator import get_zooms
 
 from covid_api.core import config
+from covid_api.db.handles import open_dataset
 from covid_api.ressources.common import mimetype
 from covid_api.ressources.enums import ImageType
 from covid_api.ressources.responses import XMLResponse
@@ -50,7 +50,7 @@ def wtms(
     kwargs.pop("tile_scale", None)
     qs = urlencode(list(kwargs.items()))
 
-    with rasterio.open(url) as src_dst:
+    with open_dataset(url) as src_dst:
         bounds = list(
             warp.transform_bounds(
                 src_dst.crs, constants.WGS84_CRS, *src_dst.bounds, densify_pts=21
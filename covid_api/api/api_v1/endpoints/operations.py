@@ -1,4 +1,100 @@
 """API operations."""
 
-# /point
-# /static/{lon},{lat},{zoom}/{width}x{height}.{format}?
+from typing import List, Optional, Union
+
+from pydantic import ValidationError
+
+from covid_api.api import utils
+from covid_api.core.config import TIMELAPSE_MAX_CONCURRENCY
+from covid_api.core.workers import timelapse_pool
+from covid_api.errors import WorkerPoolFull
+from covid_api.models.timelapse import PointRequest, PointValue
+
+from fastapi import APIRouter, HTTPException, Query
+
+from starlette.requests import Request
+
+router = APIRouter()
+
+
+def _get_point_value(query: PointRequest, url: str, dataset):
+
+    url = utils.format_spotlight_url(query, url, dataset)
+    try:
+        return dict(value=utils.get_point_value(query.lon, query.lat, url))
+
+    except Exception:
+        raise HTTPException(
+            status_code=400,
+            detail=(
+                "Unable to read the pixel value. This either due to the point being "
+                "outside of the COG or there are no COGs available for the requested "
+                "date range."
+            ),
+        )
+
+
+@router.get(
+    "/point",
+    responses={200: {"description": "Return the pixel values of a point"}},
+    response_model=Union[List[PointValue], PointValue],
+    response_model_exclude_none=True,
+)
+def point(
+    request: Request,
+    lon: float = Query(..., description="Longitude"),
+    lat: float = Query(..., description="Latitude"),
+    dataset_id: str = Query(..., alias="datasetId", description="Dataset id"),
+    date: Optional[str] = Query(None, description="Date"),
+    date_range: Optional[str] = Query(
+        None, alias="dateRange", description="Coma (',') delimited start,end dates"
+    ),
+    spotlight_id: Optional[str] = Query(
+        None, alias="spotlightId", description="Spotlight id"
+    ),
+):
+    """Handle /point requests."""
+    try:
+        query = PointRequest(
+            lon=lon,
+            lat=lat,
+            date=date,
+            date_range=date_range.split(",") if date_range else None,
+            dataset_id=dataset_id,
+            spotlight_id=spotlight_id,
+        )
+    except ValidationError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    dataset = utils.get_dataset_metadata(request, query)
+    url = utils.extract_s3_url(dataset)
+
+    if query.date:
+        return _get_point_value(
+            query, utils.insert_date(url, dataset, query.date), dataset
+        )
+
+    if not query.date_range:
+        raise HTTPException(
+            status_code=400, detail="Must provide a `date` or a `dateRange`"
+        )
+
+    values = []
+    results = timelapse_pool.map_as_completed(
+        lambda date: _get_point_value(
+            query, utils.insert_date(url, dataset, date), dataset
+        ),
+        utils.get_dates(dataset, query.date_range),
+        max_concurrency=TIMELAPSE_MAX_CONCURRENCY,
+    )
+    try:
+        for date, future in results:
+            try:
+                values.append({"date": date, **future.result()})
+            except HTTPException as e:
+                values.append({"date": date, "error": e.detail})
+
+    except WorkerPoolFull:
+        raise utils.worker_pool_full_error()
+
+    return sorted(values, key=lambda v: v["date"])
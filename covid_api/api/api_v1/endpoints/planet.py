@@ -5,12 +5,12 @@ from typing import Any, Dict
 from rio_tiler.utils import render
 
 from covid_api.api import utils
-from covid_api.db.memcache import CacheLayer
+from covid_api.db.tiered import TieredCacheLayer
 from covid_api.ressources.common import mimetype
 from covid_api.ressources.enums import ImageType
 from covid_api.ressources.responses import TileResponse
 
-from fastapi import APIRouter, Depends, Path, Query
+from fastapi import APIRouter, BackgroundTasks, Depends, Path, Query
 
 from starlette.concurrency import run_in_threadpool
 
@@ -42,7 +42,8 @@ async def tile(
     y: int = Path(..., description="Mercator tiles's row"),
     date: str = Query(..., description="date of site for detections"),
     site: str = Query(..., description="id of site for detections"),
-    cache_client: CacheLayer = Depends(utils.get_cache),
+    cache_client: TieredCacheLayer = Depends(utils.get_image_cache),
+    background_tasks: BackgroundTasks = None,
 ) -> TileResponse:
     """Handle /planet requests."""
     timings = []
@@ -55,22 +56,26 @@ async def tile(
     content = None
     if cache_client:
         try:
-            content, ext = cache_client.get_image_from_cache(tile_hash)
+            content, ext = await cache_client.get_image_from_cache(tile_hash)
             headers["X-Cache"] = "HIT"
         except Exception:
             content = None
 
     if not content:
-        with utils.Timer() as t:
-            tile, mask = await _tile(scenes, x, y, z)
-        timings.append(("Read", t.elapsed))
 
-        content = await _render(tile, mask)
+        async def _render_tile():
+            with utils.Timer() as t:
+                tile, mask = await _tile(scenes, x, y, z)
+            timings.append(("Read", t.elapsed))
 
-        timings.append(("Format", t.elapsed))
+            content = await _render(tile, mask)
 
-        if cache_client and content:
-            cache_client.set_image_cache(tile_hash, (content, ImageType.png))
+            timings.append(("Format", t.elapsed))
+            return content, ImageType.png
+
+        content, _ = await utils.get_or_render_image(
+            cache_client, tile_hash, _render_tile, background_tasks
+        )
 
     if timings:
         headers["X-Server-Timings"] = "; ".join(
@@ -2,10 +2,11 @@
 
 from covid_api.db.static.sites import SiteNames, sites
 from covid_api.models.static import Site, Sites
+from covid_api.ressources.responses import ETagRoute
 
 from fastapi import APIRouter
 
-router = APIRouter()
+router = APIRouter(route_class=ETagRoute)
 
 
 @router.get(
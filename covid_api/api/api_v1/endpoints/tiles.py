@@ -1,28 +1,122 @@
 """API tiles."""
 
+import asyncio
+import json
+import math
 import re
 from functools import partial
 from io import BytesIO
-from typing import Any, Dict, Optional, Union
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
 
+import mercantile
 import numpy
-from rio_tiler.colormap import get_colormap
-from rio_tiler.io import cogeo
-from rio_tiler.profiles import img_profiles
+from rio_tiler import reader
+from rio_tiler.errors import TileOutsideBounds
 from rio_tiler.utils import geotiff_options, render
 
 from covid_api.api import utils
-from covid_api.db.memcache import CacheLayer
-from covid_api.ressources.common import drivers, mimetype
-from covid_api.ressources.enums import ImageType
-from covid_api.ressources.responses import TileResponse
+from covid_api.core.config import TILE_ENCODE_PROFILE, TILES_BATCH_MAX_TILES
+from covid_api.core.workers import render_pool
+from covid_api.db.handles import open_dataset
+from covid_api.db.tiered import TieredCacheLayer
+from covid_api.ressources.common import drivers, encode_profiles, mimetype
+from covid_api.ressources.enums import EncodeProfile, ImageType
+from covid_api.ressources.responses import (
+    MultipartResponse,
+    NotModifiedResponse,
+    TileResponse,
+    etag_matches,
+)
 
-from fastapi import APIRouter, Depends, Path, Query
+from fastapi import (
+    APIRouter,
+    BackgroundTasks,
+    Depends,
+    Header,
+    HTTPException,
+    Path,
+    Query,
+)
 
 from starlette.concurrency import run_in_threadpool
+from starlette.responses import Response
+
+
+def _render_colormapped(
+    tile: numpy.ndarray,
+    mask: numpy.ndarray,
+    colormap: Optional[numpy.ndarray] = None,
+    indexed: bool = False,
+    img_format: str = "PNG",
+    **kwargs: Any,
+) -> bytes:
+    """Apply a colormap lookup table (if any) and encode a tile.
+
+    With `indexed`, colormapped 1 band PNG tiles are encoded as palette PNGs.
+
+    """
+    if colormap is not None:
+        if (
+            indexed
+            and img_format == "PNG"
+            and tile.shape[0] == 1
+            and tile.dtype == numpy.uint8
+        ):
+            content = utils.render_indexed_png(tile[0], mask, colormap, **kwargs)
+            if content:
+                return content
+
+        tile, mask = utils.apply_colormap_lut(tile, mask, colormap)
+    return render(tile, mask, img_format=img_format, **kwargs)
+
+
+def _render_rescaled(
+    tile: numpy.ndarray,
+    mask: numpy.ndarray,
+    in_range: Tuple[float, float],
+    colormap: numpy.ndarray,
+    img_format: str = "PNG",
+    **kwargs: Any,
+) -> bytes:
+    """Rescale, colormap and encode a 1 band tile in one pass.
+
+    PNG tiles are encoded as palette PNGs.
 
-_tile = partial(run_in_threadpool, cogeo.tile)
-_render = partial(run_in_threadpool, render)
+    """
+    if img_format == "PNG":
+        index = utils.rescale_index(tile, mask, in_range)
+        content = utils.render_indexed_png(index, mask, colormap, **kwargs)
+        if content:
+            return content
+
+    data, alpha = utils.rescale_colormap(tile, mask, in_range, colormap)
+    return render(data, alpha, img_format=img_format, **kwargs)
+
+
+def _postprocess_and_render(
+    tile: numpy.ndarray,
+    mask: numpy.ndarray,
+    rescale: Optional[str] = None,
+    color_formula: Optional[str] = None,
+    colormap: Optional[numpy.ndarray] = None,
+    **kwargs: Any,
+) -> bytes:
+    """Post-process and encode a tile."""
+    tile = utils.postprocess(tile, mask, rescale=rescale, color_formula=color_formula)
+    return _render_colormapped(
+        tile, mask, colormap, indexed=not color_formula, **kwargs
+    )
+
+
+def _get_rescale_range(rescale: str) -> Tuple[float, float]:
+    """Return the first Min,Max of a rescale parameter."""
+    in_min, in_max = map(float, rescale.split(",")[:2])
+    return in_min, in_max
+
+
+_tile = partial(run_in_threadpool, utils.tile)
+_render = partial(run_in_threadpool, _render_colormapped)
+_render_fused = partial(run_in_threadpool, _render_rescaled)
 _postprocess = partial(run_in_threadpool, utils.postprocess)
 
 
@@ -44,6 +138,187 @@ tile_routes_params: Dict[str, Any] = dict(
 )
 
 
+def _format_timings(timings: List[Tuple[str, float]], size: int) -> str:
+    """Format the timings (ms) and the size (bytes) of the response body."""
+    return "; ".join(
+        ["{} - {:0.2f}".format(name, time * 1000) for (name, time) in timings]
+        + [f"Size - {size}"]
+    )
+
+
+def _get_tile_hash(z: int, x: int, y: int, **params: Any) -> str:
+    """Create hash from a tile and its render params."""
+    return utils.get_hash(**dict(z=z, x=x, y=y, **params))
+
+
+def _get_read_options(
+    bidx: Optional[str], nodata: Optional[Union[str, int, float]]
+) -> Dict[str, Any]:
+    """Parse band indexes and nodata, as the tile reader expects them."""
+    indexes = tuple(int(s) for s in re.findall(r"\d+", bidx)) if bidx else None
+    if nodata is not None:
+        nodata = numpy.nan if nodata == "nan" else float(nodata)
+    return dict(indexes=indexes, nodata=nodata)
+
+
+def _get_colormap(color_map: Optional[utils.ColorMapName]) -> Optional[numpy.ndarray]:
+    """Return the lookup table of a rio-tiler or custom colormap."""
+    return utils.get_colormap_lut(color_map.value) if color_map else None
+
+
+async def _format_tile(
+    tile: numpy.ndarray,
+    mask: numpy.ndarray,
+    x: int,
+    y: int,
+    z: int,
+    tilesize: int,
+    ext: Optional[ImageType],
+    rescale: Optional[str],
+    color_formula: Optional[str],
+    colormap: Optional[numpy.ndarray],
+    profile: EncodeProfile,
+    timings: List[Tuple[str, float]],
+) -> Tuple[bytes, ImageType]:
+    """Post-process and encode a tile read from a COG.
+
+    Fully masked PNG tiles aren't encoded: the shared empty tile is returned.
+
+    """
+    if ext in (None, ImageType.png) and not mask.any():
+        return utils.empty_tile(tilesize), ImageType.png
+
+    ext = ext or (ImageType.jpg if mask.all() else ImageType.png)
+
+    if ext == ImageType.npy:
+        options: Dict[str, Any] = {}
+    elif ext == ImageType.tif:
+        options = geotiff_options(x, y, z, tilesize=tilesize)
+    else:
+        options = encode_profiles[profile.value].get(drivers[ext.value].lower(), {})
+
+    # single band tiles rescaled and colormapped (most datasets) skip postprocess
+    fused = (
+        rescale
+        and colormap is not None
+        and not color_formula
+        and tile.shape[0] == 1
+        and ext != ImageType.npy
+    )
+
+    if ext != ImageType.npy and render_pool.accepts(tilesize):
+        with utils.Timer() as t:
+            if fused:
+                content = await render_pool.run(
+                    _render_rescaled,
+                    tile,
+                    mask,
+                    in_range=_get_rescale_range(rescale),
+                    colormap=colormap,
+                    img_format=drivers[ext.value],
+                    **options,
+                )
+            else:
+                content = await render_pool.run(
+                    _postprocess_and_render,
+                    tile,
+                    mask,
+                    rescale=rescale,
+                    color_formula=color_formula,
+                    colormap=colormap,
+                    img_format=drivers[ext.value],
+                    **options,
+                )
+        timings.append((f"Format ({profile.value})", t.elapsed))
+        return content, ext
+
+    if fused:
+        with utils.Timer() as t:
+            content = await _render_fused(
+                tile,
+                mask,
+                _get_rescale_range(rescale),
+                colormap,
+                img_format=drivers[ext.value],
+                **options,
+            )
+        timings.append((f"Format ({profile.value})", t.elapsed))
+        return content, ext
+
+    with utils.Timer() as t:
+        tile = await _postprocess(
+            tile, mask, rescale=rescale, color_formula=color_formula
+        )
+    timings.append(("Post-process", t.elapsed))
+
+    with utils.Timer() as t:
+        if ext == ImageType.npy:
+            sio = BytesIO()
+            numpy.save(sio, (tile, mask))
+            sio.seek(0)
+            content = sio.getvalue()
+        else:
+            content = await _render(
+                tile,
+                mask,
+                img_format=drivers[ext.value],
+                colormap=colormap,
+                indexed=not color_formula,
+                **options,
+            )
+    timings.append((f"Format ({profile.value})", t.elapsed))
+
+    return content, ext
+
+
+def _empty_tile_response(
+    ext: Optional[ImageType], tilesize: int, headers: Dict[str, str]
+) -> Response:
+    """Return the shared empty PNG tile, or no content for the other formats."""
+    if ext in (None, ImageType.png):
+        return TileResponse(
+            utils.empty_tile(tilesize), media_type=mimetype["png"], headers=headers
+        )
+    return Response(status_code=204, headers=headers)
+
+
+def _conditional(response: Response, if_none_match: Optional[str]) -> Response:
+    """Replace a response by a 304 if the client already has it."""
+    etag = response.headers.get("etag")
+    if etag_matches(if_none_match, etag):
+        headers = {
+            k: v
+            for k, v in response.headers.items()
+            if k in ("x-cache", "x-tile-empty")
+        }
+        return NotModifiedResponse(etag, headers=headers)
+    return response
+
+
+def _read_tiles(
+    url: str, tiles: List[Tuple[int, int, int]], tilesize: int, **kwargs: Any
+) -> List[Union[Tuple[numpy.ndarray, numpy.ndarray], Exception]]:
+    """Read several tiles from a COG, opening it once.
+
+    GDAL datasets can't be shared between threads, so the tiles are read one
+    after the other from the same handle (which also shares the blocks common
+    to neighbouring tiles).
+
+    """
+    results: List[Union[Tuple[numpy.ndarray, numpy.ndarray], Exception]] = []
+    with open_dataset(url) as src_dst:
+        utils.set_cog_bounds(url, src_dst)
+        for z, x, y in tiles:
+            try:
+                results.append(reader.tile(src_dst, x, y, z, tilesize, **kwargs))
+            except Exception as e:
+                results.append(e)
+    return results
+
+
+_read_tiles_async = partial(run_in_threadpool, _read_tiles)
+
+
 @router.get(r"/{z}/{x}/{y}", **tile_routes_params)
 @router.get(r"/{z}/{x}/{y}\.{ext}", **tile_routes_params)
 @router.get(r"/{z}/{x}/{y}@{scale}x", **tile_routes_params)
@@ -57,6 +332,10 @@ async def tile(
     ),
     ext: ImageType = Query(None, description="Output image type. Default is auto."),
     url: str = Query(..., description="Cloud Optimized GeoTIFF URL."),
+    profile: EncodeProfile = Query(
+        EncodeProfile(TILE_ENCODE_PROFILE),
+        description="Encoding speed/size trade-off (fast, balanced or small).",
+    ),
     bidx: Optional[str] = Query(None, description="Coma (',') delimited band indexes"),
     nodata: Optional[Union[str, int, float]] = Query(
         None, description="Overwrite internal Nodata value."
@@ -68,88 +347,299 @@ async def tile(
     color_map: Optional[utils.ColorMapName] = Query(
         None, title="rio-tiler color map name"
     ),
-    cache_client: CacheLayer = Depends(utils.get_cache),
-) -> TileResponse:
+    cache_client: TieredCacheLayer = Depends(utils.get_image_cache),
+    background_tasks: BackgroundTasks = None,
+    if_none_match: Optional[str] = Header(None),
+) -> Response:
     """Handle /tiles requests."""
-    timings = []
+    timings: List[Tuple[str, float]] = []
     headers: Dict[str, str] = {}
 
-    tile_hash = utils.get_hash(
-        **dict(
-            z=z,
-            x=x,
-            y=y,
-            ext=ext,
-            scale=scale,
-            url=url,
-            bidx=bidx,
-            nodata=nodata,
-            rescale=rescale,
-            color_formula=color_formula,
-            color_map=color_map.value if color_map else "",
-        )
+    tile_hash = _get_tile_hash(
+        z,
+        x,
+        y,
+        ext=ext,
+        scale=scale,
+        url=url,
+        bidx=bidx,
+        nodata=nodata,
+        rescale=rescale,
+        color_formula=color_formula,
+        color_map=color_map.value if color_map else "",
+        profile=profile.value,
     )
     tilesize = scale * 256
 
+    if utils.tile_outside_bounds(url, x, y, z):
+        headers["X-Tile-Empty"] = "outside-bounds"
+        return _conditional(_empty_tile_response(ext, tilesize, headers), if_none_match)
+
     content = None
     if cache_client:
+        if if_none_match:
+            etag = await cache_client.get_etag(tile_hash)
+            if etag_matches(if_none_match, etag):
+                return NotModifiedResponse(etag, headers={"X-Cache": "HIT"})
+
         try:
-            content, ext = cache_client.get_image_from_cache(tile_hash)
+            content, ext = await cache_client.get_image_from_cache(tile_hash)
             headers["X-Cache"] = "HIT"
         except Exception:
             content = None
 
     if not content:
-        indexes = tuple(int(s) for s in re.findall(r"\d+", bidx)) if bidx else None
 
-        if nodata is not None:
-            nodata = numpy.nan if nodata == "nan" else float(nodata)
+        async def _render_tile():
+            with utils.Timer() as t:
+                tile, mask = await _tile(
+                    url, x, y, z, tilesize=tilesize, **_get_read_options(bidx, nodata)
+                )
+            timings.append(("Read", t.elapsed))
 
-        with utils.Timer() as t:
-            tile, mask = await _tile(
-                url, x, y, z, indexes=indexes, tilesize=tilesize, nodata=nodata
+            return await _format_tile(
+                tile,
+                mask,
+                x,
+                y,
+                z,
+                tilesize,
+                ext,
+                rescale,
+                color_formula,
+                _get_colormap(color_map),
+                profile,
+                timings,
             )
-        timings.append(("Read", t.elapsed))
 
-        if not ext:
-            ext = ImageType.jpg if mask.all() else ImageType.png
+        try:
+            content, ext = await utils.get_or_render_image(
+                cache_client, tile_hash, _render_tile, background_tasks
+            )
+        except TileOutsideBounds:
+            headers["X-Tile-Empty"] = "outside-bounds"
+            return _conditional(
+                _empty_tile_response(ext, tilesize, headers), if_none_match
+            )
+
+    if timings:
+        headers["X-Server-Timings"] = _format_timings(timings, len(content))
+
+    return _conditional(
+        TileResponse(content, media_type=mimetype[ext.value], headers=headers),
+        if_none_match,
+    )
+
+
+def _parse_bbox(bbox: str) -> Tuple[float, float, float, float]:
+    """Parse a `west,south,east,north` bounding box (raises a 400 if invalid)."""
+    try:
+        west, south, east, north = map(float, bbox.split(","))
+    except ValueError:
+        raise HTTPException(
+            status_code=400, detail="bbox must be 4 coma (',') delimited numbers"
+        )
+
+    if not all(map(math.isfinite, (west, south, east, north))) or south > north:
+        raise HTTPException(status_code=400, detail=f"Invalid bbox: {bbox}")
+    return west, south, east, north
+
+
+def _get_tile_list(
+    tiles: Optional[str], bbox: Optional[str], zoom: Optional[int]
+) -> List[Tuple[int, int, int]]:
+    """Return the (z, x, y) tiles requested from /tiles/batch."""
+    if tiles:
+        tile_iter: Iterator[Tuple[int, int, int]] = (
+            (int(m.group(1)), int(m.group(2)), int(m.group(3)))
+            for m in re.finditer(r"(\d+)/(\d+)/(\d+)", tiles)
+        )
+    elif bbox and zoom is not None:
+        tile_iter = (
+            (t.z, t.x, t.y) for t in mercantile.tiles(*_parse_bbox(bbox), zooms=[zoom])
+        )
+    else:
+        raise HTTPException(
+            status_code=400, detail="Either tiles or bbox and zoom are required"
+        )
+
+    # stop at the first tile over the limit, a large bbox can cover billions
+    unique: Dict[Tuple[int, int, int], None] = {}
+    for tile in tile_iter:
+        unique[tile] = None
+        if len(unique) > TILES_BATCH_MAX_TILES:
+            break
+
+    tile_list = list(unique)
+    if not tile_list or len(tile_list) > TILES_BATCH_MAX_TILES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Between 1 and {TILES_BATCH_MAX_TILES} tiles can be requested",
+        )
+    return tile_list
+
+
+@router.get(
+    r"/tiles/batch",
+    responses={
+        200: {
+            "content": {"multipart/mixed": {}},
+            "description": "Return the tiles, one part per tile.",
+        }
+    },
+    tags=["tiles"],
+    response_class=MultipartResponse,
+)
+async def tiles_batch(
+    url: str = Query(..., description="Cloud Optimized GeoTIFF URL."),
+    tiles: Optional[str] = Query(
+        None, description="Coma (',') delimited z/x/y tiles, e.g. 8/87/48,8/88/48"
+    ),
+    bbox: Optional[str] = Query(
+        None, description="Coma (',') delimited minx,miny,maxx,maxy (EPSG:4326)"
+    ),
+    zoom: Optional[int] = Query(
+        None, ge=0, le=30, description="Zoom level of the tiles covering bbox"
+    ),
+    scale: int = Query(
+        1, gt=0, lt=4, description="Tile size scale. 1=256x256, 2=512x512..."
+    ),
+    ext: ImageType = Query(None, description="Output image type. Default is auto."),
+    profile: EncodeProfile = Query(
+        EncodeProfile(TILE_ENCODE_PROFILE),
+        description="Encoding speed/size trade-off (fast, balanced or small).",
+    ),
+    bidx: Optional[str] = Query(None, description="Coma (',') delimited band indexes"),
+    nodata: Optional[Union[str, int, float]] = Query(
+        None, description="Overwrite internal Nodata value."
+    ),
+    rescale: Optional[str] = Query(
+        None, description="Coma (',') delimited Min,Max bounds"
+    ),
+    color_formula: Optional[str] = Query(None, title="rio-color formula"),
+    color_map: Optional[utils.ColorMapName] = Query(
+        None, title="rio-tiler color map name"
+    ),
+    cache_client: TieredCacheLayer = Depends(utils.get_image_cache),
+    background_tasks: BackgroundTasks = None,
+) -> MultipartResponse:
+    """Handle /tiles/batch requests.
+
+    Each tile is returned as one part of a multipart/mixed response, with its
+    `z/x/y` in the `Content-Location` header. Tiles outside of the COG bounds
+    are returned as an empty PNG (or as an error with the other formats), and
+    the ones which couldn't be rendered as a JSON error part.
+
+    """
+    tile_list = _get_tile_list(tiles, bbox, zoom)
+    timings: List[Tuple[str, float]] = []
+    tilesize = scale * 256
+    outside = {
+        (z, x, y) for z, x, y in tile_list if utils.tile_outside_bounds(url, x, y, z)
+    }
+    tile_hashes = {
+        (z, x, y): _get_tile_hash(
+            z,
+            x,
+            y,
+            ext=ext,
+            scale=scale,
+            url=url,
+            bidx=bidx,
+            nodata=nodata,
+            rescale=rescale,
+            color_formula=color_formula,
+            color_map=color_map.value if color_map else "",
+            profile=profile.value,
+        )
+        for z, x, y in tile_list
+        if (z, x, y) not in outside
+    }
 
+    with utils.Timer() as t:
+        cached = await cache_client.get_images_from_cache(tile_hashes.values())
+    timings.append(("Cache", t.elapsed))
+
+    bodies: Dict[Tuple[int, int, int], Union[Tuple[bytes, ImageType], Exception]] = {
+        tile: cached[tile_hash]
+        for tile, tile_hash in tile_hashes.items()
+        if tile_hash in cached
+    }
+
+    for tile in outside:
+        bodies[tile] = (
+            (utils.empty_tile(tilesize), ImageType.png)
+            if ext in (None, ImageType.png)
+            else TileOutsideBounds(f"Tile {tile} is outside of the COG bounds")
+        )
+
+    missing = [tile for tile in tile_list if tile not in bodies]
+    if missing:
         with utils.Timer() as t:
-            tile = await _postprocess(
-                tile, mask, rescale=rescale, color_formula=color_formula
+            read = await _read_tiles_async(
+                url, missing, tilesize, **_get_read_options(bidx, nodata)
             )
-        timings.append(("Post-process", t.elapsed))
+        timings.append(("Read", t.elapsed))
 
-        if color_map:
-            if color_map.value.startswith("custom_"):
-                color_map = utils.get_custom_cmap(color_map.value)  # type: ignore
-            else:
-                color_map = get_colormap(color_map.value)  # type: ignore
+        colormap = _get_colormap(color_map)
+
+        async def _format(z, x, y, data):
+            if isinstance(data, Exception):
+                return data
+            tile, mask = data
+            try:
+                return await _format_tile(
+                    tile,
+                    mask,
+                    x,
+                    y,
+                    z,
+                    tilesize,
+                    ext,
+                    rescale,
+                    color_formula,
+                    colormap,
+                    profile,
+                    [],
+                )
+            except Exception as e:
+                return e
 
         with utils.Timer() as t:
-            if ext == ImageType.npy:
-                sio = BytesIO()
-                numpy.save(sio, (tile, mask))
-                sio.seek(0)
-                content = sio.getvalue()
-            else:
-                driver = drivers[ext.value]
-                options = img_profiles.get(driver.lower(), {})
-                if ext == ImageType.tif:
-                    options = geotiff_options(x, y, z, tilesize=tilesize)
+            rendered = await asyncio.gather(
+                *[_format(z, x, y, data) for (z, x, y), data in zip(missing, read)]
+            )
+        timings.append((f"Format ({profile.value})", t.elapsed))
 
-                content = await _render(
-                    tile, mask, img_format=driver, colormap=color_map, **options
+        for tile, body in zip(missing, rendered):
+            if isinstance(body, TileOutsideBounds) and ext in (None, ImageType.png):
+                body = (utils.empty_tile(tilesize), ImageType.png)
+            bodies[tile] = body
+            if not isinstance(body, Exception) and body[0]:
+                background_tasks.add_task(
+                    cache_client.set_image_cache, tile_hashes[tile], body
                 )
 
-        timings.append(("Format", t.elapsed))
-
-        if cache_client and content:
-            cache_client.set_image_cache(tile_hash, (content, ext))
+    parts = []
+    for z, x, y in tile_list:
+        body = bodies[(z, x, y)]
+        headers = {"Content-Location": f"{z}/{x}/{y}"}
+        if isinstance(body, Exception):
+            headers["Content-Type"] = "application/json"
+            parts.append((headers, json.dumps({"detail": str(body)}).encode()))
+            continue
 
-    if timings:
-        headers["X-Server-Timings"] = "; ".join(
-            ["{} - {:0.2f}".format(name, time * 1000) for (name, time) in timings]
-        )
+        content, tile_ext = body
+        headers["Content-Type"] = mimetype[tile_ext.value]
+        if tile_hashes.get((z, x, y)) in cached:
+            headers["X-Cache"] = "HIT"
+        parts.append((headers, content))
 
-    return TileResponse(content, media_type=mimetype[ext.value], headers=headers)
+    return MultipartResponse(
+        parts,
+        headers={
+            "X-Server-Timings": _format_timings(
+                timings, sum(len(content) for _, content in parts)
+            )
+        },
+    )
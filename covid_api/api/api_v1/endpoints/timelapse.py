@@ -1,20 +1,26 @@
 """API metadata."""
-import re
-from concurrent import futures
-from datetime import datetime, timedelta
-from typing import List, Union
-
-from dateutil.relativedelta import relativedelta
-
-from covid_api.api.utils import get_zonal_stat
-from covid_api.core.config import API_VERSION_STR
-from covid_api.db.static.datasets import datasets as _datasets
-from covid_api.db.static.errors import InvalidIdentifier
-from covid_api.db.static.sites import sites
+import itertools
+from typing import Dict, Iterator, List, Optional, Union
+
+from shapely.geometry import shape
+
+from covid_api.api import utils
+from covid_api.core.config import TIMELAPSE_MAX_CONCURRENCY
+from covid_api.core.workers import timelapse_pool
+from covid_api.db.lru import LocalCacheLayer
+from covid_api.db.memcache import CacheLayer
+from covid_api.db.zonal_stats import STORED_STATS
+from covid_api.db.zonal_stats import store as zonal_stats_store
+from covid_api.errors import WorkerPoolFull
 from covid_api.models.static import Dataset
-from covid_api.models.timelapse import TimelapseRequest, TimelapseValue
+from covid_api.models.timelapse import (
+    TimelapseBatchRequest,
+    TimelapseRequest,
+    TimelapseValue,
+)
+from covid_api.ressources.responses import NDJSONResponse
 
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Response
 
 from starlette.requests import Request
 
@@ -22,164 +28,335 @@ router = APIRouter()
 
 
 # TODO: validate inputs with typing/pydantic models
-def _get_mean_median(query, url, dataset):
-
-    # format S3 URL template with spotlightId, if dataset is
-    # spotlight specific
-    if "{spotlightId}" in url:
-        if not query.spotlight_id:
-            raise HTTPException(
-                status_code=400,
-                detail=f"Must provide a `spotlight_id` for dataset: {dataset.id}",
-            )
-        url = _insert_spotlight_id(url, query.spotlight_id)
+def _get_precomputed_mean_median(query, url, dataset, geometry_hash, max_pixels):
+
+    # the store is computed as a date range query, and without histogram
+    geometry = query.geojson.geometry.dict()
+    if (
+        max_pixels != utils.get_max_pixels([geometry], date_range=True)
+        or not set(query.stats) <= STORED_STATS
+    ):
+        return None
+
+    try:
+        url = utils.format_spotlight_url(query, url, dataset)
+    except HTTPException:
+        # reported by the live computation
+        return None
+
+    content = zonal_stats_store.get(geometry_hash, url)
+    if not content:
+        return None
+
+    return {
+        k: v
+        for k, v in content.items()
+        if k in ["mean", "median", "resolution", *query.stats]
+    }
+
+
+def _get_mean_median(query, url, dataset, max_pixels):
+
+    url = utils.format_spotlight_url(query, url, dataset)
     try:
-        mean, median = get_zonal_stat(query.geojson, url)
-        return dict(mean=mean, median=median)
+        return utils.get_zonal_stat(
+            query.geojson,
+            url,
+            max_pixels=max_pixels,
+            stats=query.stats,
+            histogram_bins=query.histogram_bins,
+        )
 
     except Exception:
-        raise HTTPException(
-            status_code=400,
-            detail=(
-                "Unable to calculate mean/median values. This either due to a bounding box "
-                "extending beyond the edges of the COG or there are no COGs available for the "
-                "requested date range."
-            ),
+        raise _zonal_stat_error()
+
+
+def _get_batch_mean_median(query, url, dataset, features, max_pixels):
+
+    url = utils.format_spotlight_url(query, url, dataset)
+    try:
+        return utils.get_zonal_stats(
+            [shape(feature.geometry.dict()) for feature in features],
+            url,
+            max_pixels=max_pixels,
+            stats=query.stats,
+            histogram_bins=query.histogram_bins,
         )
 
+    except Exception:
+        raise _zonal_stat_error()
+
+
+def _get_max_pixels(query):
+    if isinstance(query, TimelapseBatchRequest):
+        geometries = [feature.geometry.dict() for feature in query.geojson.features]
+    else:
+        geometries = [query.geojson.geometry.dict()]
+
+    return utils.get_max_pixels(
+        geometries,
+        date_range=bool(query.date_range),
+        full_resolution=query.full_resolution,
+    )
+
+
+def _zonal_stat_error():
+    return HTTPException(
+        status_code=400,
+        detail=(
+            "Unable to calculate mean/median values. This either due to a bounding box "
+            "extending beyond the edges of the COG or there are no COGs available for the "
+            "requested date range."
+        ),
+    )
+
 
 @router.post(
     "/timelapse",
-    responses={200: {"description": "Return timelapse values for a given geometry"}},
+    responses={
+        200: {
+            "description": "Return timelapse values for a given geometry",
+            "content": {"application/x-ndjson": {}},
+        }
+    },
     response_model=Union[List[TimelapseValue], TimelapseValue],
     response_model_exclude_none=True,
 )
-def timelapse(request: Request, query: TimelapseRequest):
+def timelapse(
+    request: Request,
+    response: Response,
+    query: TimelapseRequest,
+    cache_client: Union[CacheLayer, LocalCacheLayer] = Depends(utils.get_stats_cache),
+):
     """Handle /timelapse requests."""
 
     # get dataset metadata for the requested dataset
     # will be used to validate other parts of the query
-    dataset = _get_dataset_metadata(request, query)
+    dataset = utils.get_dataset_metadata(request, query)
 
     # extract S3 URL template from dataset metadata info
-    url = _extract_s3_url(dataset)
+    url = utils.extract_s3_url(dataset)
+
+    geometry_hash = utils.get_geometry_hash(query.geojson.geometry.dict())
+    max_pixels = _get_max_pixels(query)
 
     if query.date:
 
         # format S3 URL template with date object
-        url = _insert_date(url, dataset, query.date)
-        return _get_mean_median(query, url, dataset)
-
-    if query.date_range:
-
-        if dataset.time_unit == "day":
-            # Get start and end dates
-            start = _validate_query_date(dataset, query.date_range[0])
-            end = _validate_query_date(dataset, query.date_range[1])
-
-            # Populate all days in between Add 1 to days to ensure it contains the end date as well
-            dates = [
-                datetime.strftime((start + timedelta(days=x)), "%Y_%m_%d")
-                for x in range(0, (end - start).days + 1)
-            ]
-
-        if dataset.time_unit == "month":
-            start = datetime.strptime(query.date_range[0], "%Y%m")
-            end = datetime.strptime(query.date_range[1], "%Y%m")
-
-            num_months = (end.year - start.year) * 12 + (end.month - start.month)
+        url = utils.insert_date(url, dataset, query.date)
 
-            dates = [
-                datetime.strftime((start + relativedelta(months=+x)), "%Y%m")
-                for x in range(0, num_months + 1)
-            ]
+        stats_hash = _get_stats_hash(query, geometry_hash, query.date, max_pixels)
+        content = cache_client.get_zonal_stats_from_cache([stats_hash]).get(stats_hash)
+        if content:
+            response.headers["X-Cache"] = "HIT"
+        else:
+            # spotlight polygons statistics are precomputed
+            content = _get_precomputed_mean_median(
+                query, url, dataset, geometry_hash, max_pixels
+            ) or _get_mean_median(query, url, dataset, max_pixels)
+            cache_client.set_zonal_stats_cache(stats_hash, content)
 
-        with futures.ThreadPoolExecutor(max_workers=10) as executor:
-            future_stats_queries = {
-                executor.submit(
-                    _get_mean_median, query, _insert_date(url, dataset, date), dataset
-                ): date
-                for date in dates
-            }
+        return content
 
-        stats = []
+    if query.date_range:
 
-        for future in futures.as_completed(future_stats_queries):
-            date = future_stats_queries[future]
-            try:
-                stats.append({"date": date, **future.result()})
-            except HTTPException as e:
-                stats.append({"date": date, "error": e.detail})
+        dates = utils.get_dates(dataset, query.date_range)
+
+        # only compute the statistics of the dates that aren't cached yet
+        stats_hashes = {
+            date: _get_stats_hash(query, geometry_hash, date, max_pixels)
+            for date in dates
+        }
+        cached = cache_client.get_zonal_stats_from_cache(stats_hashes.values())
+
+        stats = [
+            {"date": date, **cached[stats_hash]}
+            for date, stats_hash in stats_hashes.items()
+            if stats_hash in cached
+        ]
+        dates = [date for date in dates if stats_hashes[date] not in cached]
+        if not dates:
+            response.headers["X-Cache"] = "HIT"
+
+        # spotlight polygons statistics are precomputed
+        precomputed = {
+            date: _get_precomputed_mean_median(
+                query,
+                utils.insert_date(url, dataset, date),
+                dataset,
+                geometry_hash,
+                max_pixels,
+            )
+            for date in dates
+        }
+        for date, content in precomputed.items():
+            if content:
+                cache_client.set_zonal_stats_cache(stats_hashes[date], content)
+                stats.append({"date": date, **content})
+        dates = [date for date in dates if not precomputed[date]]
+
+        results = _iter_mean_median(
+            query, url, dataset, dates, stats_hashes, cache_client, max_pixels
+        )
+        try:
+            # start the computation (and get the first value) before sending
+            # anything, so a full worker pool is still reported as a 503
+            first = list(itertools.islice(results, 1))
+        except WorkerPoolFull:
+            raise utils.worker_pool_full_error()
+
+        if "application/x-ndjson" in request.headers.get("accept", ""):
+            # emit the values as soon as they are available, in any order
+            return NDJSONResponse(
+                itertools.chain(stats, first, results), headers=dict(response.headers),
+            )
 
+        stats.extend(first)
+        stats.extend(results)
         return sorted(stats, key=lambda s: s["date"])
 
 
-def _get_dataset_metadata(request: Request, query: TimelapseRequest):
-
-    scheme = request.url.scheme
-    host = request.headers["host"]
-
-    if API_VERSION_STR:
-        host += API_VERSION_STR
-
-    dataset = list(
-        filter(
-            lambda d: d.id == query.dataset_id,
-            _datasets.get_all(api_url=f"{scheme}://{host}").datasets,
-        )
+def _iter_mean_median(
+    query: TimelapseRequest,
+    url: str,
+    dataset: Dataset,
+    dates: List[str],
+    stats_hashes: Dict[str, str],
+    cache_client: Union[CacheLayer, LocalCacheLayer],
+    max_pixels: Optional[int],
+) -> Iterator[Dict]:
+    """Yield the mean/median values of each date, in order of completion."""
+    results = timelapse_pool.map_as_completed(
+        lambda date: _get_mean_median(
+            query, utils.insert_date(url, dataset, date), dataset, max_pixels
+        ),
+        dates,
+        max_concurrency=TIMELAPSE_MAX_CONCURRENCY,
     )
+    for date, future in results:
+        try:
+            content = future.result()
+        except HTTPException as e:
+            yield {"date": date, "error": e.detail}
+            continue
 
-    if not dataset:
-        raise HTTPException(
-            status_code=404, detail=f"No dataset found for id: {query.dataset_id}"
-        )
-
-    dataset = dataset[0]
-
-    if dataset.source.type != "raster":
-        raise HTTPException(
-            status_code=400,
-            detail=f"Dataset {query.dataset_id} is not a raster-type dataset",
-        )
-
-    return dataset
-
+        cache_client.set_zonal_stats_cache(stats_hashes[date], content)
+        yield {"date": date, **content}
 
-def _extract_s3_url(dataset: Dataset):
-    url_search = re.search(r"url=([^&\s]*)", dataset.source.tiles[0])
-    if not url_search:
-        raise HTTPException(status_code=500)
-
-    return url_search.group(1)
 
+@router.post(
+    "/timelapse/batch",
+    responses={
+        200: {"description": "Return timelapse values for each feature of a collection"}
+    },
+    response_model=Dict[str, Union[List[TimelapseValue], TimelapseValue]],
+    response_model_exclude_none=True,
+)
+def timelapse_batch(
+    request: Request,
+    response: Response,
+    query: TimelapseBatchRequest,
+    cache_client: Union[CacheLayer, LocalCacheLayer] = Depends(utils.get_stats_cache),
+):
+    """Handle /timelapse/batch requests.
+
+    Each COG is opened once per date for all the features, and the values are
+    returned by feature id (or by index, for the features without id).
+
+    """
+    dataset = utils.get_dataset_metadata(request, query)
+    url = utils.extract_s3_url(dataset)
+
+    features = dict(zip(query.geojson.ids(), query.geojson.features))
+    geometry_hashes = {
+        feature_id: utils.get_geometry_hash(feature.geometry.dict())
+        for feature_id, feature in features.items()
+    }
+
+    dates = [query.date] if query.date else utils.get_dates(dataset, query.date_range)
+    max_pixels = _get_max_pixels(query)
+
+    # only compute the statistics of the features/dates that aren't cached yet
+    stats_hashes = {
+        (feature_id, date): _get_stats_hash(query, geometry_hash, date, max_pixels)
+        for feature_id, geometry_hash in geometry_hashes.items()
+        for date in dates
+    }
+    cached = cache_client.get_zonal_stats_from_cache(stats_hashes.values())
+
+    stats: Dict[str, Dict[str, Dict]] = {feature_id: {} for feature_id in features}
+    missing: Dict[str, List[str]] = {date: [] for date in dates}
+    for (feature_id, date), stats_hash in stats_hashes.items():
+        if stats_hash in cached:
+            stats[feature_id][date] = cached[stats_hash]
+        else:
+            missing[date].append(feature_id)
+
+    dates_to_compute = [date for date in dates if missing[date]]
+    if not dates_to_compute:
+        response.headers["X-Cache"] = "HIT"
+
+    results = timelapse_pool.map_as_completed(
+        lambda date: _get_batch_mean_median(
+            query,
+            utils.insert_date(url, dataset, date),
+            dataset,
+            [features[feature_id] for feature_id in missing[date]],
+            max_pixels,
+        ),
+        dates_to_compute,
+        max_concurrency=TIMELAPSE_MAX_CONCURRENCY,
+    )
+    try:
+        for date, future in results:
+            try:
+                contents = future.result()
+            except HTTPException as e:
+                if query.date:
+                    raise
+                for feature_id in missing[date]:
+                    stats[feature_id][date] = {"error": e.detail}
+                continue
 
-def _insert_date(url: str, dataset: Dataset, date: str):
-    _validate_query_date(dataset, date)
-    return url.replace("{date}", date)
+            for feature_id, content in zip(missing[date], contents):
+                cache_client.set_zonal_stats_cache(
+                    stats_hashes[(feature_id, date)], content
+                )
+                stats[feature_id][date] = content
 
+    except WorkerPoolFull:
+        raise utils.worker_pool_full_error()
 
-def _validate_query_date(dataset: Dataset, date: str):
-    date_format = "%Y_%m_%d" if dataset.time_unit == "day" else "%Y%m"
-    try:
-        return datetime.strptime(date, date_format)
-    except ValueError:
-        raise HTTPException(
-            status_code=400,
-            detail=(
-                f"Invalid date format. {date} should be like "
-                f"{'YYYYMM' if dataset.time_unit == 'month' else 'YYYY_MM_DD'}"
-            ),
-        )
+    if query.date:
+        return {feature_id: values[query.date] for feature_id, values in stats.items()}
 
+    return {
+        feature_id: [{"date": date, **values[date]} for date in dates]
+        for feature_id, values in stats.items()
+    }
 
-def _insert_spotlight_id(url: str, spotlight_id: str):
-    if not spotlight_id:
-        raise HTTPException(status_code=400, detail="Missing spotlightId")
-    try:
-        sites.get(spotlight_id)
-    except InvalidIdentifier:
-        raise HTTPException(
-            status_code=404, detail=f"No spotlight found for id: {spotlight_id}"
-        )
 
-    return url.replace("{spotlightId}", spotlight_id)
+@router.get(
+    "/timelapse/workers",
+    responses={200: {"description": "Return the timelapse worker pool usage"}},
+)
+def timelapse_workers():
+    """Handle /timelapse/workers requests."""
+    return timelapse_pool.stats()
+
+
+def _get_stats_hash(
+    query: Union[TimelapseRequest, TimelapseBatchRequest],
+    geometry_hash: str,
+    date: str,
+    max_pixels: Optional[int],
+) -> str:
+    return utils.get_hash(
+        geometry=geometry_hash,
+        dataset_id=query.dataset_id,
+        spotlight_id=query.spotlight_id,
+        date=date,
+        max_pixels=max_pixels,
+        stats=sorted(set(query.stats)),
+        histogram_bins=query.histogram_bins if "histogram" in query.stats else None,
+    )
@@ -1,38 +1,96 @@
 """covid_api.api.utils."""
 
+import asyncio
 import csv
 import hashlib
 import json
 import math
 import random
 import re
+import sys
+import threading
 import time
+from contextlib import ExitStack
+from datetime import datetime, timedelta
 from enum import Enum
+from functools import lru_cache
 from io import BytesIO
-from typing import Any, Dict, Optional, Tuple
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
 
 import mercantile
 import numpy as np
 
 # Temporary
-import rasterio
 import requests
+from affine import Affine
+from area import area
+from dateutil.relativedelta import relativedelta
 from rasterio import features
 from rasterio.io import MemoryFile
+from rasterio.transform import rowcol
+from rasterio.warp import transform as transform_coords
 from rasterio.warp import transform_bounds
+from rasterio.windows import Window
 from rasterstats.io import bounds_window
 from rio_color.operations import parse_operations
 from rio_color.utils import scale_dtype, to_math_type
-from rio_tiler import constants
+from rio_tiler import constants, reader
+from rio_tiler.colormap import cmap, make_lut
 from rio_tiler.mercator import get_zooms
-from rio_tiler.utils import _chunks, has_alpha_band, has_mask_band, linear_rescale
+from rio_tiler.profiles import img_profiles
+from rio_tiler.utils import (
+    _chunks,
+    has_alpha_band,
+    has_mask_band,
+    linear_rescale,
+    render,
+)
 from shapely.geometry import box, shape
-
-from covid_api.core.config import INDICATOR_BUCKET, PLANET_API_KEY
+from shapely.geometry.polygon import orient
+
+from covid_api.core.config import (
+    API_VERSION_STR,
+    COG_BOUNDS_CACHE_SIZE,
+    DATASET_HANDLES_TTL,
+    INDICATOR_BUCKET,
+    PLANET_API_KEY,
+    POINT_BLOCK_CACHE_SIZE,
+    TILE_LOCK_TIMEOUT,
+    TIMELAPSE_MAX_AREA,
+    ZONAL_COVERAGE_CACHE_BYTES,
+    ZONAL_STATS_MAX_PIXELS,
+)
+from covid_api.core.singleflight import tile_flights
+from covid_api.db.handles import open_dataset
+from covid_api.db.lru import LocalCacheLayer, LRUCache
 from covid_api.db.memcache import CacheLayer
+from covid_api.db.static.datasets import datasets
+from covid_api.db.static.errors import InvalidIdentifier
+from covid_api.db.static.sites import sites
+from covid_api.db.tiered import TieredCacheLayer
 from covid_api.db.utils import s3_get
-from covid_api.models.timelapse import Feature
-
+from covid_api.models.static import Dataset
+from covid_api.models.timelapse import (
+    Feature,
+    PointRequest,
+    TimelapseBatchRequest,
+    TimelapseRequest,
+)
+from covid_api.ressources.enums import ImageType
+
+from fastapi import HTTPException
+
+from starlette.background import BackgroundTasks
 from starlette.requests import Request
 
 
@@ -41,11 +99,102 @@ def get_cache(request: Request) -> CacheLayer:
     return request.state.cache
 
 
+def get_image_cache(request: Request) -> TieredCacheLayer:
+    """Get image cache layer (in-process, then memcached)."""
+    return request.state.image_cache
+
+
+def get_stats_cache(request: Request) -> Union[CacheLayer, LocalCacheLayer]:
+    """Get zonal statistics cache layer (memcached or in-process)."""
+    return request.state.cache or request.state.local_cache
+
+
 def get_hash(**kwargs: Any) -> str:
     """Create hash from kwargs."""
     return hashlib.sha224(json.dumps(kwargs, sort_keys=True).encode()).hexdigest()
 
 
+async def get_or_render_image(
+    cache_client: TieredCacheLayer,
+    img_hash: str,
+    render: Callable[[], Awaitable[Tuple[bytes, ImageType]]],
+    background_tasks: Optional[BackgroundTasks] = None,
+    poll_interval: float = 0.1,
+) -> Tuple[bytes, ImageType]:
+    """Render an image missing from the cache, once for all concurrent requests.
+
+    Identical requests in this process share the same render. Across workers,
+    a short lock in the cache lets the first one render the image while the
+    others wait for it to show up in the cache (up to `TILE_LOCK_TIMEOUT`
+    seconds, after which they render it themselves).
+
+    With `background_tasks`, the image is put in the cache (and the lock
+    released) after the response is sent.
+
+    """
+
+    async def _store(body: Tuple[bytes, ImageType], locked: bool) -> None:
+        try:
+            if body[0]:
+                await cache_client.set_image_cache(img_hash, body)
+        finally:
+            if locked:
+                await cache_client.release_lock(img_hash)
+
+    async def _render() -> Tuple[bytes, ImageType]:
+        locked = await cache_client.acquire_lock(img_hash, TILE_LOCK_TIMEOUT)
+        if not locked:
+            deadline = time.monotonic() + TILE_LOCK_TIMEOUT
+            while time.monotonic() < deadline:
+                await asyncio.sleep(poll_interval)
+                try:
+                    return await cache_client.get_image_from_cache(img_hash)
+                except Exception:
+                    continue
+
+        try:
+            body = await render()
+        except Exception:
+            if locked:
+                await cache_client.release_lock(img_hash)
+            raise
+
+        if background_tasks is not None:
+            background_tasks.add_task(_store, body, locked)
+        else:
+            await _store(body, locked)
+        return body
+
+    body, _ = await tile_flights.do(img_hash, _render)
+    return body
+
+
+def get_geometry_hash(geometry: Dict) -> str:
+    """Create hash from a (Multi)Polygon geometry.
+
+    The hash doesn't depend on the orientation of the rings, on their starting
+    vertex nor on the order of the interior rings/polygons, so that the same
+    area drawn twice gets the same hash.
+
+    """
+    geom = shape(geometry)
+    polygons = geom.geoms if hasattr(geom, "geoms") else [geom]
+
+    def _ring(ring) -> List:
+        coords = [[round(v, 9) for v in c[:2]] for c in ring.coords[:-1]]
+        start = coords.index(min(coords))
+        return coords[start:] + coords[:start]
+
+    canonical = []
+    for polygon in polygons:
+        polygon = orient(polygon, sign=1.0)
+        canonical.append(
+            [_ring(polygon.exterior), *sorted(_ring(r) for r in polygon.interiors)]
+        )
+
+    return get_hash(polygons=sorted(canonical))
+
+
 def postprocess(
     tile: np.ndarray,
     mask: np.ndarray,
@@ -79,6 +228,20 @@ def postprocess(
     return tile
 
 
+# WGS84 bounds of the COGs read, to answer the tiles outside of them without I/O.
+# They expire like the dataset handles (the COG may have been replaced).
+_cog_bounds = LRUCache(COG_BOUNDS_CACHE_SIZE, ttl=DATASET_HANDLES_TTL)
+
+
+def set_cog_bounds(address: str, src_dst) -> Tuple[float, float, float, float]:
+    """Return the WGS84 bounds of an open COG, and add them to the bounds index."""
+    bounds = transform_bounds(
+        src_dst.crs, constants.WGS84_CRS, *src_dst.bounds, densify_pts=21
+    )
+    _cog_bounds.set(address, bounds)
+    return bounds
+
+
 # from rio-tiler 2.0a5
 def info(address: str) -> Dict:
     """
@@ -94,11 +257,9 @@ def info(address: str) -> Dict:
     out : dict.
 
     """
-    with rasterio.open(address) as src_dst:
+    with open_dataset(address) as src_dst:
         minzoom, maxzoom = get_zooms(src_dst)
-        bounds = transform_bounds(
-            src_dst.crs, constants.WGS84_CRS, *src_dst.bounds, densify_pts=21
-        )
+        bounds = set_cog_bounds(address, src_dst)
         center = [(bounds[0] + bounds[2]) / 2, (bounds[1] + bounds[3]) / 2, minzoom]
 
         def _get_descr(ix):
@@ -154,6 +315,81 @@ def info(address: str) -> Dict:
 # Modified work Copyright 2016 American Red Cross
 # Modified work Copyright 2016-2017 Humanitarian OpenStreetMap Team
 # Modified work Copyright 2017 Mapzen
+def spatial_info(address: str) -> Dict:
+    """Return COG bounds, center and zooms (`rio_tiler.io.cogeo.spatial_info`)."""
+    with open_dataset(address) as src_dst:
+        minzoom, maxzoom = get_zooms(src_dst)
+        bounds = set_cog_bounds(address, src_dst)
+    center = [(bounds[0] + bounds[2]) / 2, (bounds[1] + bounds[3]) / 2, minzoom]
+    return dict(
+        address=address, bounds=bounds, center=center, minzoom=minzoom, maxzoom=maxzoom
+    )
+
+
+def bounds(address: str) -> Dict:
+    """Return COG bounds (`rio_tiler.io.cogeo.bounds`)."""
+    with open_dataset(address) as src_dst:
+        bounds = set_cog_bounds(address, src_dst)
+    return dict(address=address, bounds=bounds)
+
+
+def metadata(
+    address: str,
+    pmin: float = 2.0,
+    pmax: float = 98.0,
+    hist_options: Dict = {},
+    **kwargs: Any,
+) -> Dict:
+    """Return COG statistics (`rio_tiler.io.cogeo.metadata`)."""
+    with open_dataset(address) as src_dst:
+        meta = reader.metadata(
+            src_dst, percentiles=(pmin, pmax), hist_options=hist_options, **kwargs
+        )
+    return dict(address=address, **meta)
+
+
+def tile(
+    address: str, tile_x: int, tile_y: int, tile_z: int, tilesize: int = 256, **kwargs
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Read a mercator tile from a COG (`rio_tiler.io.cogeo.tile`)."""
+    with open_dataset(address) as src_dst:
+        if _cog_bounds.get(address) is None:
+            set_cog_bounds(address, src_dst)
+        return reader.tile(src_dst, tile_x, tile_y, tile_z, tilesize, **kwargs)
+
+
+def tile_outside_bounds(address: str, tile_x: int, tile_y: int, tile_z: int) -> bool:
+    """Check if a mercator tile is known to be outside of a COG, without any I/O.
+
+    Only the COGs whose bounds were read before (by `info`, `bounds`,
+    `spatial_info` or `tile`) are checked: False is returned for the others.
+
+    """
+    cog_bounds = _cog_bounds.get(address)
+    # unknown, or crossing the antimeridian
+    if cog_bounds is None or cog_bounds[0] > cog_bounds[2]:
+        return False
+
+    west, south, east, north = mercantile.bounds(tile_x, tile_y, tile_z)
+    return (
+        west > cog_bounds[2]
+        or east < cog_bounds[0]
+        or south > cog_bounds[3]
+        or north < cog_bounds[1]
+    )
+
+
+@lru_cache()
+def empty_tile(tilesize: int = 256) -> bytes:
+    """Return a fully transparent PNG tile, encoded once per tile size."""
+    return render(
+        np.zeros((1, tilesize, tilesize), dtype="uint8"),
+        np.zeros((tilesize, tilesize), dtype="uint8"),
+        img_format="PNG",
+        **img_profiles["png"],
+    )
+
+
 class Timer(object):
     """Time a code block."""
 
@@ -178,24 +414,10 @@ def _rasterize_geom(geom, shape, affinetrans, all_touched):
     return rv_array
 
 
-def rasterize_pctcover(geom, atrans, shape):
-    """Rasterize features. Rasters can only be read in rectangles so the src.data
-    window corresponds to the bounding box of the requested geometry. In order
-    to avoid calculating zonal stats for data that is within the bounding box, but
-    outside of the shape itself, we create a mask the represents the percentage
-    of each raster cell that is covered by the geometry to use as weights when
-    calculating the mean.
-
-    Eg: the weights (pctcover values) for a circular geometry (within a square
-    raster) might look like:
-
-    0.0 0.1 0.3 0.1 0.0
-    0.0 0.5 1.0 0.5 0.0
-    0.0 1.0 1.0 1.0 0.0
-    0.0 0.5 1.0 0.5 0.0
-    0.0 0.1 0.3 0.1 0.0
-
-    """
+def _rasterize_pctcover_shapely(geom, atrans, shape):
+    """Reference implementation of `rasterize_pctcover`, intersecting every
+    exterior cell with the geometry one at a time. Kept to validate and
+    benchmark the vectorized version."""
     alltouched = _rasterize_geom(geom, shape, atrans, all_touched=True)
     exterior = _rasterize_geom(geom.exterior, shape, atrans, all_touched=True)
 
@@ -229,24 +451,427 @@ def rasterize_pctcover(geom, atrans, shape):
     return pctcover
 
 
-def get_zonal_stat(geojson: Feature, raster: str) -> Tuple[float, float]:
+def _polygon_rings(geom) -> List:
+    """Return the rings of a (Multi)Polygon, exteriors counter-clockwise and
+    interiors clockwise."""
+    polygons = geom.geoms if hasattr(geom, "geoms") else [geom]
+    rings = []
+    for polygon in polygons:
+        polygon = orient(polygon, sign=1.0)
+        rings.extend([polygon.exterior, *polygon.interiors])
+    return rings
+
+
+def _mean_clamp(sa: np.ndarray, sb: np.ndarray) -> np.ndarray:
+    """Mean of `clip(s, 0, 1)` along segments where `s` varies linearly from
+    `sa` to `sb`."""
+
+    def _integral(s):
+        # antiderivative of clip(s, 0, 1)
+        return np.where(s <= 0, 0, np.where(s >= 1, s - 0.5, s * s / 2))
+
+    ds = sb - sa
+    flat = np.abs(ds) < 1e-12
+    return np.where(
+        flat,
+        np.clip(sa, 0, 1),
+        (_integral(sb) - _integral(sa)) / np.where(flat, 1, ds),
+    )
+
+
+def rasterize_pctcover(geom, atrans, shape):
+    """Rasterize features. Rasters can only be read in rectangles so the src.data
+    window corresponds to the bounding box of the requested geometry. In order
+    to avoid calculating zonal stats for data that is within the bounding box, but
+    outside of the shape itself, we create a mask the represents the percentage
+    of each raster cell that is covered by the geometry to use as weights when
+    calculating the mean.
+
+    Eg: the weights (pctcover values) for a circular geometry (within a square
+    raster) might look like:
+
+    0.0 0.1 0.3 0.1 0.0
+    0.0 0.5 1.0 0.5 0.0
+    0.0 1.0 1.0 1.0 0.0
+    0.0 0.5 1.0 0.5 0.0
+    0.0 0.1 0.3 0.1 0.0
+
+    The exact covered area of every cell is computed at once from the polygon
+    edges (Green's theorem): each edge is split at the column boundaries and
+    every piece adds the area lying between itself and the rows above it. Rows
+    entirely above a piece receive a constant contribution (accumulated with a
+    cumulative sum), only the few rows a piece crosses are computed explicitly.
+
+    """
+    height, width = shape
+    inv = ~atrans
+
+    x0, y0, x1, y1 = [], [], [], []
+    for ring in _polygon_rings(geom):
+        xs, ys = np.asarray(ring.coords)[:, :2].T
+        # work in pixel space, where every cell is a unit square
+        cols = inv.a * xs + inv.b * ys + inv.c
+        rows = inv.d * xs + inv.e * ys + inv.f
+        x0.append(cols[:-1])
+        y0.append(rows[:-1])
+        x1.append(cols[1:])
+        y1.append(rows[1:])
+
+    x0, y0, x1, y1 = (np.concatenate(v) for v in (x0, y0, x1, y1))
+
+    # vertical edges don't contribute
+    keep = x0 != x1
+    x0, y0, x1, y1 = x0[keep], y0[keep], x1[keep], y1[keep]
+
+    # split edges at column boundaries (only the columns within the grid)
+    xmin = np.minimum(x0, x1)
+    xmax = np.maximum(x0, x1)
+    col_start = np.clip(np.floor(xmin), 0, width).astype(np.int64)
+    col_stop = np.clip(np.ceil(xmax), 0, width).astype(np.int64)
+    ncols = col_stop - col_start
+
+    edge = np.repeat(np.arange(ncols.size), ncols)
+    cols = np.repeat(col_start, ncols) + (
+        np.arange(edge.size) - np.repeat(np.cumsum(ncols) - ncols, ncols)
+    )
+
+    slope = ((y1 - y0) / (x1 - x0))[edge]
+    xa = np.maximum(xmin[edge], cols)
+    xb = np.minimum(xmax[edge], cols + 1)
+    ya = y0[edge] + (xa - x0[edge]) * slope
+    yb = y0[edge] + (xb - x0[edge]) * slope
+    dx = (xb - xa) * np.sign(x1 - x0)[edge]
+
+    lo = np.minimum(ya, yb)
+    hi = np.maximum(ya, yb)
+
+    # rows entirely above a piece are fully spanned by it
+    row_start = np.clip(np.floor(lo), 0, height).astype(np.int64)
+    above = np.bincount(
+        row_start * width + cols, weights=dx, minlength=(height + 1) * width
+    ).reshape(height + 1, width)
+    pctcover = above[::-1].cumsum(axis=0)[::-1][1:]
+
+    # rows crossed by a piece
+    row_stop = np.clip(np.ceil(hi), 0, height).astype(np.int64)
+    nrows = np.maximum(row_stop - row_start, 0)
+
+    piece = np.repeat(np.arange(nrows.size), nrows)
+    rows = np.repeat(row_start, nrows) + (
+        np.arange(piece.size) - np.repeat(np.cumsum(nrows) - nrows, nrows)
+    )
+    partial = dx[piece] * _mean_clamp(ya[piece] - rows, yb[piece] - rows)
+    pctcover = pctcover + np.bincount(
+        rows * width + cols[piece], weights=partial, minlength=height * width
+    ).reshape(height, width)
+
+    # counter-clockwise rings are clockwise in pixel space for north-up rasters
+    if inv.determinant > 0:
+        pctcover = -pctcover
+
+    return np.clip(pctcover, 0, 1)
+
+
+_pctcovers = LRUCache(
+    sys.maxsize, maxbytes=ZONAL_COVERAGE_CACHE_BYTES, sizeof=lambda a: a.nbytes
+)
+# one lock per coverage being computed, with the number of threads using it
+_pctcover_locks: Dict[Tuple, List] = {}
+_pctcover_locks_lock = threading.Lock()
+
+
+def get_pctcover(geom, atrans: Affine, shape: Tuple[int, int]) -> np.ndarray:
+    """Return the (read-only) coverage weights of a geometry on a grid.
+
+    All the COGs of a dataset usually share the same grid, so the weights are
+    cached per (geometry, window transform, window shape) and computed only
+    once for all the dates of a timelapse query. Concurrent queries for the
+    same coverage wait for the first computation instead of repeating it, the
+    other coverages are computed in parallel.
+
+    """
+    key = (geom.wkb, atrans, tuple(shape))
+    pctcover = _pctcovers.get(key)
+    if pctcover is not None:
+        return pctcover
+
+    with _pctcover_locks_lock:
+        entry = _pctcover_locks.setdefault(key, [threading.Lock(), 0])
+        entry[1] += 1
+
+    try:
+        with entry[0]:
+            pctcover = _pctcovers.get(key)
+            if pctcover is None:
+                pctcover = rasterize_pctcover(geom, atrans=atrans, shape=shape)
+                # shared between requests
+                pctcover.setflags(write=False)
+                _pctcovers.set(key, pctcover)
+            return pctcover
+    finally:
+        with _pctcover_locks_lock:
+            entry[1] -= 1
+            if not entry[1]:
+                del _pctcover_locks[key]
+
+
+def get_max_pixels(
+    geometries: Sequence[Dict], date_range: bool, full_resolution: bool = False
+) -> Optional[int]:
+    """Return the pixel budget of zonal statistics (None for full resolution).
+
+    AOIs larger than `TIMELAPSE_MAX_AREA` (in total) queried with a date range
+    are computed from the COG overviews, unless `full_resolution` is asked for.
+    Everything else is computed at full resolution.
+
+    """
+    if full_resolution or not date_range:
+        return None
+
+    total_area = sum(area(geometry) for geometry in geometries) / (1000 * 1000)
+    return ZONAL_STATS_MAX_PIXELS if total_area > TIMELAPSE_MAX_AREA else None
+
+
+def get_zonal_stat(
+    geojson: Feature,
+    raster: str,
+    max_pixels: Optional[int] = None,
+    stats: Sequence[str] = (),
+    histogram_bins: int = 20,
+) -> Dict[str, Any]:
     """Return zonal statistics."""
     geom = shape(geojson.geometry.dict())
-    with rasterio.open(raster) as src:
+    return get_zonal_stats(
+        [geom],
+        raster,
+        max_pixels=max_pixels,
+        stats=stats,
+        histogram_bins=histogram_bins,
+    )[0]
 
-        # read the raster data matching the geometry bounds
-        window = bounds_window(geom.bounds, src.transform)
-        # store our window information & read
-        window_affine = src.window_transform(window)
-        data = src.read(window=window, masked=True)
 
-        # calculate the coverage of pixels for weighting
-        pctcover = rasterize_pctcover(geom, atrans=window_affine, shape=data.shape[1:])
+# Geometries of a batch are read with a single window, unless that window would
+# be this many times larger than the windows of the geometries themselves.
+ZONAL_BATCH_MAX_OVERREAD = 4
+
+
+def _window_size(window) -> int:
+    (row_start, row_stop), (col_start, col_stop) = window
+    return (row_stop - row_start) * (col_stop - col_start)
+
+
+def _get_zonal_windows(src, geoms: List) -> Tuple[List, Optional[Tuple]]:
+    """Return the window of each geometry and, if they should be read at once,
+    the window covering all of them."""
+    windows = [bounds_window(geom.bounds, src.transform) for geom in geoms]
+    union = (
+        (min(w[0][0] for w in windows), max(w[0][1] for w in windows)),
+        (min(w[1][0] for w in windows), max(w[1][1] for w in windows)),
+    )
+    (row_start, row_stop), (col_start, col_stop) = union
+
+    if (
+        row_start >= 0
+        and col_start >= 0
+        and row_stop <= src.height
+        and col_stop <= src.width
+        and _window_size(union)
+        <= ZONAL_BATCH_MAX_OVERREAD * sum(_window_size(w) for w in windows)
+    ):
+        return windows, union
+
+    return windows, None
+
+
+def _get_overview_level(src, geoms: List, max_pixels: int) -> Optional[int]:
+    """Return the first overview level from which the geometries can be read
+    with less than `max_pixels` pixels (None for the full resolution)."""
+    windows, union = _get_zonal_windows(src, geoms)
+    pixels = _window_size(union) if union else sum(map(_window_size, windows))
+    if pixels <= max_pixels:
+        return None
+
+    overviews = src.overviews(1)
+    for level, factor in enumerate(overviews):
+        if pixels / factor ** 2 <= max_pixels:
+            return level
+
+    # read as little as we can
+    return len(overviews) - 1 if overviews else None
+
+
+def zonal_statistics(
+    data: np.ma.MaskedArray,
+    pctcover: np.ndarray,
+    stats: Sequence[str] = (),
+    histogram_bins: int = 20,
+) -> Dict[str, Any]:
+    """Return the mean, median and requested statistics of an array.
+
+    The mean, std, count and histogram are weighted by the coverage of each
+    pixel, while the median and percentiles are the ones of all the valid
+    pixels (as `np.ma.median`). The valid pixels are extracted once and sorted
+    once, whatever the number of statistics.
 
-        return (
-            np.ma.average(data[0], weights=pctcover),
-            np.ma.median(data[0]),
+    """
+    valid = ~np.ma.getmaskarray(data)
+    values = data.data[valid]
+    weights = pctcover[valid]
+    total = weights.sum()
+    if not values.size or not total:
+        return dict(mean=None, median=None)
+
+    mean = float(np.dot(values, weights) / total)
+    values_sorted = np.sort(values)
+
+    def _percentile(q: float) -> float:
+        # linear interpolation, as np.percentile
+        rank = (values_sorted.size - 1) * q / 100
+        lower = values_sorted[int(math.floor(rank))]
+        upper = values_sorted[int(math.ceil(rank))]
+        return float(lower + (upper - lower) * (rank - math.floor(rank)))
+
+    middle = values_sorted.size // 2
+    if values_sorted.size % 2:
+        median = float(values_sorted[middle])
+    else:
+        median = float(values_sorted[middle - 1 : middle + 1].mean())
+
+    result: Dict[str, Any] = dict(mean=mean, median=median)
+    for stat in stats:
+        if stat == "p10":
+            result["p10"] = _percentile(10)
+        elif stat == "p90":
+            result["p90"] = _percentile(90)
+        elif stat == "std":
+            variance = np.dot((values - mean) ** 2, weights) / total
+            result["std"] = float(math.sqrt(variance))
+        elif stat == "count":
+            result["count"] = int(np.count_nonzero(weights))
+        elif stat == "histogram":
+            counts, edges = np.histogram(
+                values,
+                bins=histogram_bins,
+                range=(values_sorted[0], values_sorted[-1]),
+                weights=weights,
+            )
+            result["histogram"] = [counts.tolist(), edges.tolist()]
+
+    return result
+
+
+def _get_zonal_stats(
+    src, geoms: List, stats: Sequence[str] = (), histogram_bins: int = 20
+) -> List[Dict[str, Any]]:
+    windows, union = _get_zonal_windows(src, geoms)
+    if union:
+        (row_start, _), (col_start, _) = union
+        data = src.read(1, window=union, masked=True)
+        arrays = [
+            data[
+                w[0][0] - row_start : w[0][1] - row_start,
+                w[1][0] - col_start : w[1][1] - col_start,
+            ]
+            for w in windows
+        ]
+    else:
+        arrays = [src.read(1, window=w, masked=True) for w in windows]
+
+    results = []
+    for geom, window, data in zip(geoms, windows, arrays):
+        # calculate the coverage of pixels for weighting
+        pctcover = get_pctcover(
+            geom, atrans=src.window_transform(window), shape=data.shape
         )
+        results.append(
+            dict(
+                zonal_statistics(
+                    data, pctcover, stats=stats, histogram_bins=histogram_bins
+                ),
+                resolution=src.res[0],
+            )
+        )
+
+    return results
+
+
+def get_zonal_stats(
+    geoms: List,
+    raster: str,
+    max_pixels: Optional[int] = None,
+    stats: Sequence[str] = (),
+    histogram_bins: int = 20,
+) -> List[Dict[str, Any]]:
+    """Return zonal statistics of several geometries, opening the raster once.
+
+    When the geometries are close to each other, the data covering all of them
+    is read at once and the weighted mean and median of each geometry are
+    computed from its own part of that array, so the values are the same as
+    the ones returned by `get_zonal_stat` for each geometry.
+
+    With `max_pixels`, the data is read from the first COG overview for which
+    no more than `max_pixels` pixels are needed (or the smallest one). The
+    resolution of the data used is returned with the statistics.
+
+    """
+    with open_dataset(raster) as src:
+        level = _get_overview_level(src, geoms, max_pixels) if max_pixels else None
+        if level is None:
+            return _get_zonal_stats(src, geoms, stats, histogram_bins)
+
+    with open_dataset(raster, overview_level=level) as src:
+        return _get_zonal_stats(src, geoms, stats, histogram_bins)
+
+
+# COG metadata and blocks read by `get_point_value`, shared between requests
+# and expiring like the dataset handles (the COG may have been replaced)
+_point_metadata = LRUCache(1024, ttl=DATASET_HANDLES_TTL)
+_point_blocks = LRUCache(POINT_BLOCK_CACHE_SIZE, ttl=DATASET_HANDLES_TTL)
+
+
+def get_point_value(lon: float, lat: float, raster: str) -> Optional[float]:
+    """Return the value of the pixel at a lon/lat (None if masked).
+
+    Only the internal block of the COG containing the pixel is read. It is
+    kept in memory with the COG metadata, so the values of neighbouring points
+    are returned without opening the COG again.
+
+    """
+    with ExitStack() as stack:
+        src = None
+        metadata = _point_metadata.get(raster)
+        if metadata is None:
+            src = stack.enter_context(open_dataset(raster))
+            metadata = dict(
+                crs=src.crs,
+                transform=src.transform,
+                width=src.width,
+                height=src.height,
+                block_shape=src.block_shapes[0],
+            )
+            _point_metadata.set(raster, metadata)
+
+        xs, ys = transform_coords("epsg:4326", metadata["crs"], [lon], [lat])
+        row, col = rowcol(metadata["transform"], xs[0], ys[0])
+        if not (0 <= row < metadata["height"] and 0 <= col < metadata["width"]):
+            raise ValueError(f"Point ({lon}, {lat}) is outside of {raster}")
+
+        block_height, block_width = metadata["block_shape"]
+        block_row, block_col = row // block_height, col // block_width
+        block = _point_blocks.get((raster, block_row, block_col))
+        if block is None:
+            src = src or stack.enter_context(open_dataset(raster))
+            window = Window(
+                block_col * block_width,
+                block_row * block_height,
+                min(block_width, metadata["width"] - block_col * block_width),
+                min(block_height, metadata["height"] - block_row * block_height),
+            )
+            block = src.read(1, window=window, masked=True)
+            _point_blocks.set((raster, block_row, block_col), block)
+
+    value = block[row % block_height, col % block_width]
+    return None if value is np.ma.masked else float(value)
 
 
 # from https://gitlab.com/zfasnacht/global_mapping/-/blob/master/global_mapping.py#L231
@@ -708,6 +1333,180 @@ COLOR_MAP_NAMES = [
 ColorMapName = Enum("ColorMapNames", [(a, a) for a in COLOR_MAP_NAMES])  # type: ignore
 
 
+@lru_cache(maxsize=None)
+def get_colormap_lut(name: str) -> np.ndarray:
+    """Return the (256, 4) uint8 lookup table of a rio-tiler or custom colormap.
+
+    Tables are built once per colormap and shared (read-only) by all requests.
+
+    """
+    colormap = get_custom_cmap(name) if name.startswith("custom_") else cmap.get(name)
+    lut = np.ascontiguousarray(make_lut(colormap), dtype=np.uint8)
+    lut.setflags(write=False)
+    return lut
+
+
+def apply_colormap_lut(
+    tile: np.ndarray, mask: Optional[np.ndarray], lut: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Colormap a 1 band uint8 tile, returning RGB data and the alpha band.
+
+    Same as `rio_tiler.colormap.apply_cmap`, with a single lookup in a
+    precomputed table. The colormap alpha is combined with the tile mask.
+
+    """
+    if tile.shape[0] > 1:
+        raise Exception("Source data must be 1 band")
+
+    rgba = np.transpose(lut[tile[0]], [2, 0, 1])
+    alpha = rgba[3] if mask is None else np.minimum(mask, rgba[3])
+    return rgba[:3], alpha
+
+
+_buffers = threading.local()
+
+
+def _get_buffer(name: str, shape: Tuple[int, ...], dtype: Any) -> np.ndarray:
+    """Return a buffer of this thread, reused by the tiles of the same shape."""
+    buffers = getattr(_buffers, "arrays", None)
+    if buffers is None:
+        buffers = _buffers.arrays = {}
+
+    key = (name, shape, np.dtype(dtype).str)
+    if key not in buffers:
+        buffers[key] = np.empty(shape, dtype=dtype)
+    return buffers[key]
+
+
+@lru_cache(maxsize=64)
+def _get_rescale_lut(dtype: str, in_min: float, in_max: float) -> np.ndarray:
+    """Return the colormap index of every value of an 8 or 16 bits integer dtype.
+
+    The table is indexed by the unsigned view of the values, and computed as
+    `postprocess` rescales them.
+
+    """
+    itemsize = np.dtype(dtype).itemsize
+    values = np.arange(2 ** (8 * itemsize)).astype(f"u{itemsize}").view(dtype)
+    lut = linear_rescale(values, in_range=(in_min, in_max), out_range=[0, 255])
+    lut = lut.astype(np.uint8)
+    lut.setflags(write=False)
+    return lut
+
+
+def rescale_index(
+    tile: np.ndarray,
+    mask: np.ndarray,
+    in_range: Tuple[float, float],
+    block_rows: int = 64,
+) -> np.ndarray:
+    """Return the colormap indexes (0 where masked) of a rescaled 1 band tile.
+
+    Same as `postprocess` without full size intermediate arrays: integer values
+    are looked up in a precomputed rescale table, `block_rows` rows at a time,
+    float ones are rescaled in place in a float32 buffer. The array returned is
+    a buffer of the calling thread, only valid until its next call.
+
+    """
+    if tile.shape[0] > 1:
+        raise Exception("Source data must be 1 band")
+
+    data = tile[0]
+    shape = data.shape
+    index = _get_buffer("index", shape, np.uint8)
+    if data.dtype.kind in "iu" and data.dtype.itemsize <= 2:
+        rescale_lut = _get_rescale_lut(data.dtype.str, *in_range)
+        unsigned = data.view(f"u{data.dtype.itemsize}")
+        for row in range(0, shape[0], block_rows):
+            block = slice(row, row + block_rows)
+            index[block] = rescale_lut[unsigned[block]]
+    else:
+        in_min, in_max = in_range
+        values = _get_buffer("values", shape, np.float32)
+        np.clip(data, in_min, in_max, out=values, casting="unsafe")
+        values -= in_min
+        values /= np.float32(in_max - in_min)
+        values *= 255
+        np.copyto(index, values, casting="unsafe")
+
+    masked = _get_buffer("masked", shape, np.bool_)
+    np.equal(mask, 0, out=masked)
+    np.copyto(index, 0, where=masked)
+    return index
+
+
+def rescale_colormap(
+    tile: np.ndarray,
+    mask: np.ndarray,
+    in_range: Tuple[float, float],
+    lut: np.ndarray,
+    block_rows: int = 64,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Rescale and colormap a 1 band tile, returning RGB data and the alpha band.
+
+    Same as `postprocess` followed by `apply_colormap_lut`, with the indexes of
+    `rescale_index` and the RGBA colors looked up as packed 32 bits values,
+    `block_rows` rows at a time. The arrays returned are buffers of the calling
+    thread, only valid until its next call.
+
+    """
+    index = rescale_index(tile, mask, in_range, block_rows)
+    shape = index.shape
+
+    packed_lut = np.ascontiguousarray(lut).view(np.uint32)[:, 0]
+    packed = _get_buffer("packed", shape, np.uint32)
+    for row in range(0, shape[0], block_rows):
+        block = slice(row, row + block_rows)
+        packed[block] = packed_lut[index[block]]
+
+    rgba = _get_buffer("rgba", (4, *shape), np.uint8)
+    np.copyto(rgba, packed.view(np.uint8).reshape(*shape, 4).transpose(2, 0, 1))
+    np.minimum(rgba[3], mask, out=rgba[3])
+    return rgba[:3], rgba[3]
+
+
+def render_indexed_png(
+    index: np.ndarray,
+    mask: Optional[np.ndarray],
+    lut: np.ndarray,
+    **creation_options: Any,
+) -> Optional[bytes]:
+    """Encode colormap indexes as a palette PNG, with a tRNS chunk for the alpha.
+
+    The masked pixels use an entry of the palette which isn't used by the
+    tile, made transparent. None is returned when all the 256 entries are used
+    (the tile has to be encoded as RGBA).
+
+    """
+    palette = np.array(lut, dtype=np.uint8)
+    if mask is not None and not mask.all():
+        valid = mask != 0
+        free = np.flatnonzero(np.bincount(index[valid], minlength=256) == 0)
+        if not len(free):
+            return None
+
+        transparent = free[palette[free, 3] == 0]
+        nodata = transparent[0] if len(transparent) else free[0]
+        palette[nodata] = 0
+        index = np.where(valid, index, np.uint8(nodata))
+
+    height, width = index.shape
+    with MemoryFile() as memfile:
+        with memfile.open(
+            driver="PNG",
+            dtype="uint8",
+            count=1,
+            height=height,
+            width=width,
+            **creation_options,
+        ) as dst:
+            dst.write(index, indexes=1)
+            dst.write_colormap(
+                1, {i: tuple(color) for i, color in enumerate(palette.tolist())}
+            )
+        return memfile.read()
+
+
 def modis_tile(x, y, z, date):
     """Fetches a MODIS_Terra tiles (background for detections-contrail dataset"""
 
@@ -776,3 +1575,131 @@ def site_date_to_scenes(site: str, date: str):
     # deduplicate scene list (in case multiple datasets contains the same
     # scene id)
     return list(set(site_date_to_scenes_dict[f"{site}-{date}"]))
+
+
+def get_dataset_metadata(
+    request: Request,
+    query: Union[TimelapseRequest, TimelapseBatchRequest, PointRequest],
+):
+    """Return the raster dataset of a query."""
+    scheme = request.url.scheme
+    host = request.headers["host"]
+
+    if API_VERSION_STR:
+        host += API_VERSION_STR
+
+    dataset = list(
+        filter(
+            lambda d: d.id == query.dataset_id,
+            datasets.get_all(api_url=f"{scheme}://{host}").datasets,
+        )
+    )
+
+    if not dataset:
+        raise HTTPException(
+            status_code=404, detail=f"No dataset found for id: {query.dataset_id}"
+        )
+
+    dataset = dataset[0]
+
+    if dataset.source.type != "raster":
+        raise HTTPException(
+            status_code=400,
+            detail=f"Dataset {query.dataset_id} is not a raster-type dataset",
+        )
+
+    return dataset
+
+
+def extract_s3_url(dataset: Dataset):
+    """Return the COG URL template of a dataset."""
+    url_search = re.search(r"url=([^&\s]*)", dataset.source.tiles[0])
+    if not url_search:
+        raise HTTPException(status_code=500)
+
+    return url_search.group(1)
+
+
+def get_dates(dataset: Dataset, date_range: List[str]) -> List[str]:
+    """Return all the dates of a date range, in the format of the dataset."""
+    if dataset.time_unit == "day":
+        # Get start and end dates
+        start = validate_query_date(dataset, date_range[0])
+        end = validate_query_date(dataset, date_range[1])
+
+        # Populate all days in between Add 1 to days to ensure it contains the end date as well
+        return [
+            datetime.strftime((start + timedelta(days=x)), "%Y_%m_%d")
+            for x in range(0, (end - start).days + 1)
+        ]
+
+    if dataset.time_unit == "month":
+        start = datetime.strptime(date_range[0], "%Y%m")
+        end = datetime.strptime(date_range[1], "%Y%m")
+
+        num_months = (end.year - start.year) * 12 + (end.month - start.month)
+
+        return [
+            datetime.strftime((start + relativedelta(months=+x)), "%Y%m")
+            for x in range(0, num_months + 1)
+        ]
+
+    return []
+
+
+def insert_date(url: str, dataset: Dataset, date: str):
+    """Insert a date in a dataset URL."""
+    validate_query_date(dataset, date)
+    return url.replace("{date}", date)
+
+
+def validate_query_date(dataset: Dataset, date: str):
+    """Parse a date in the format of the dataset."""
+    date_format = "%Y_%m_%d" if dataset.time_unit == "day" else "%Y%m"
+    try:
+        return datetime.strptime(date, date_format)
+    except ValueError:
+        raise HTTPException(
+            status_code=400,
+            detail=(
+                f"Invalid date format. {date} should be like "
+                f"{'YYYYMM' if dataset.time_unit == 'month' else 'YYYY_MM_DD'}"
+            ),
+        )
+
+
+def format_spotlight_url(query, url, dataset):
+    """Insert the spotlight id of a query in a dataset URL, if needed."""
+    # format S3 URL template with spotlightId, if dataset is
+    # spotlight specific
+    if "{spotlightId}" in url:
+        if not query.spotlight_id:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Must provide a `spotlight_id` for dataset: {dataset.id}",
+            )
+        url = insert_spotlight_id(url, query.spotlight_id)
+    return url
+
+
+def insert_spotlight_id(url: str, spotlight_id: str):
+    """Insert a spotlight id in a dataset URL."""
+    if not spotlight_id:
+        raise HTTPException(status_code=400, detail="Missing spotlightId")
+    try:
+        sites.get(spotlight_id)
+    except InvalidIdentifier:
+        raise HTTPException(
+            status_code=404, detail=f"No spotlight found for id: {spotlight_id}"
+        )
+
+    return url.replace("{spotlightId}", spotlight_id)
+
+
+def worker_pool_full_error():
+    """Return the error of a request rejected by a full worker pool."""
+    return HTTPException(
+        status_code=503,
+        detail="Too many timelapse requests, please try again later",
+        headers={"Retry-After": "1"},
+    )
@@ -17,6 +17,10 @@ MEMCACHE_HOST = os.environ.get("MEMCACHE_HOST")
 MEMCACHE_PORT = int(os.environ.get("MEMCACHE_PORT", 11211))
 MEMCACHE_USERNAME = os.environ.get("MEMCACHE_USERNAME")
 MEMCACHE_PASSWORD = os.environ.get("MEMCACHE_PASSWORD")
+# Open memcached connections kept between requests, and how long (seconds) one
+# can stay unused (e.g. while a Lambda is frozen) before being reopened
+MEMCACHE_POOL_SIZE = int(os.environ.get("MEMCACHE_POOL_SIZE", 10))
+MEMCACHE_MAX_IDLE = int(os.environ.get("MEMCACHE_MAX_IDLE", 60))
 
 INDICATOR_BUCKET = os.environ.get("INDICATOR_BUCKET", "covid-eo-data")
 
@@ -28,8 +32,96 @@ DATASET_METADATA_GENERATOR_FUNCTION_NAME = os.environ.get(
     "DATASET_METADATA_GENERATOR_FUNCTION_NAME", "dev-dataset-metadata-generator"
 )
 
+# Precomputed zonal statistics of the spotlight polygons, and how often (seconds)
+# they are reloaded
+ZONAL_STATS_STORE_FILENAME = os.environ.get(
+    "ZONAL_STATS_STORE_FILENAME", "dev-zonal-stats.npz"
+)
+ZONAL_STATS_STORE_TTL = int(os.environ.get("ZONAL_STATS_STORE_TTL", 3600))
+
+# The zonal statistics job saves the store every N new statistics, and stops
+# starting new ones when the Lambda has less than this many seconds left
+ZONAL_STATS_CHECKPOINT_ROWS = int(os.environ.get("ZONAL_STATS_CHECKPOINT_ROWS", 256))
+ZONAL_STATS_TIME_MARGIN = int(os.environ.get("ZONAL_STATS_TIME_MARGIN", 120))
+
 DT_FORMAT = "%Y-%m-%d"
 MT_FORMAT = "%Y%m"
 PLANET_API_KEY = os.environ.get("PLANET_API_KEY")
 
+# Largest AOI of full resolution timelapse queries with a date range
 TIMELAPSE_MAX_AREA = 200000  # km^2
+TIMELAPSE_BATCH_MAX_FEATURES = int(os.environ.get("TIMELAPSE_BATCH_MAX_FEATURES", 100))
+
+# Threads shared by all the timelapse requests
+TIMELAPSE_MAX_WORKERS = int(os.environ.get("TIMELAPSE_MAX_WORKERS", 20))
+# Dates allowed to wait for a thread before new requests are rejected (503)
+TIMELAPSE_MAX_QUEUE = int(os.environ.get("TIMELAPSE_MAX_QUEUE", 180))
+# Dates computed at the same time for a single request
+TIMELAPSE_MAX_CONCURRENCY = int(os.environ.get("TIMELAPSE_MAX_CONCURRENCY", 10))
+
+# Size (bytes) and lifetime (seconds) of the in-process tile cache, checked before
+# memcached. 0 disables it.
+TILE_CACHE_MAX_BYTES = int(os.environ.get("TILE_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+TILE_CACHE_TTL = int(os.environ.get("TILE_CACHE_TTL", 3600))
+
+# COG datasets kept open between requests, and for how long (seconds)
+DATASET_HANDLES_MAX_OPEN = int(os.environ.get("DATASET_HANDLES_MAX_OPEN", 64))
+DATASET_HANDLES_TTL = int(os.environ.get("DATASET_HANDLES_TTL", 300))
+
+# Number of COG bounds kept in memory, to answer the tiles outside of them (empty)
+# without opening the COG
+COG_BOUNDS_CACHE_SIZE = int(os.environ.get("COG_BOUNDS_CACHE_SIZE", 4096))
+
+# Directory where the first bytes (header and IFDs) of the remote COGs are kept,
+# so that opening a COG seen before doesn't need any request. Disabled if unset.
+COG_HEADER_CACHE_DIR = os.environ.get("COG_HEADER_CACHE_DIR")
+COG_HEADER_CACHE_SIZE = int(os.environ.get("COG_HEADER_CACHE_SIZE", 65536))
+COG_HEADER_CACHE_TTL = int(os.environ.get("COG_HEADER_CACHE_TTL", 86400))
+COG_HEADER_CACHE_MAX_ENTRIES = int(os.environ.get("COG_HEADER_CACHE_MAX_ENTRIES", 1024))
+# Cached headers older than this (seconds) are checked against the COG size and
+# ETag before use, in case the COG was replaced at the same url
+COG_HEADER_CACHE_VALIDATE_TTL = int(
+    os.environ.get("COG_HEADER_CACHE_VALIDATE_TTL", DATASET_HANDLES_TTL)
+)
+COG_HEADER_REQUEST_TIMEOUT = float(os.environ.get("COG_HEADER_REQUEST_TIMEOUT", 10))
+
+# Default tile encoding profile: fast, balanced or small (see ressources.common)
+TILE_ENCODE_PROFILE = os.environ.get("TILE_ENCODE_PROFILE", "balanced")
+
+# Processes encoding the tiles of at least RENDER_PROCESSES_MIN_TILESIZE pixels
+# (e.g. 512 for the @2x tiles), so a worker isn't limited to one core by the GIL.
+# 0 renders all the tiles in the threadpool.
+RENDER_PROCESSES = int(os.environ.get("RENDER_PROCESSES", 0))
+RENDER_PROCESSES_MIN_TILESIZE = int(
+    os.environ.get("RENDER_PROCESSES_MIN_TILESIZE", 512)
+)
+
+# Responses smaller than this (bytes) aren't compressed, nor the image tiles.
+# Brotli is used when installed and accepted by the client, gzip otherwise.
+COMPRESSION_MINIMUM_SIZE = int(os.environ.get("COMPRESSION_MINIMUM_SIZE", 1024))
+GZIP_LEVEL = int(os.environ.get("GZIP_LEVEL", 6))
+BROTLI_LEVEL = int(os.environ.get("BROTLI_LEVEL", 4))
+
+# Most tiles requested at once from /tiles/batch
+TILES_BATCH_MAX_TILES = int(os.environ.get("TILES_BATCH_MAX_TILES", 64))
+
+# Identical tiles rendered at the same time by several workers wait (up to this
+# many seconds) for the first one to put it in memcached.
+TILE_LOCK_TIMEOUT = int(os.environ.get("TILE_LOCK_TIMEOUT", 10))
+
+# Number of zonal statistics results kept in memory when memcached isn't available
+ZONAL_STATS_CACHE_SIZE = int(os.environ.get("ZONAL_STATS_CACHE_SIZE", 10000))
+
+# Total size (bytes) of the zonal statistics coverage grids (one per
+# geometry/grid) kept in memory
+ZONAL_COVERAGE_CACHE_BYTES = int(
+    os.environ.get("ZONAL_COVERAGE_CACHE_BYTES", 64 * 1024 * 1024)
+)
+
+# Zonal statistics of the AOIs larger than TIMELAPSE_MAX_AREA queried with a date
+# range are computed from the COG overviews when the full resolution data has more
+# pixels than this (the other queries are computed at full resolution)
+ZONAL_STATS_MAX_PIXELS = int(os.environ.get("ZONAL_STATS_MAX_PIXELS", 4194304))
+
+# Number of COG blocks (e.g 512x512 pixels) kept in memory for /point requests
+POINT_BLOCK_CACHE_SIZE = int(os.environ.get("POINT_BLOCK_CACHE_SIZE", 64))
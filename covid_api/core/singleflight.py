@@ -0,0 +1,57 @@
+"""covid_api.core.singleflight: coalesce concurrent identical calls."""
+
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Tuple
+
+
+class SingleFlight(object):
+    """Run at most one call per key at a time, in the current process.
+
+    Callers asking for a key which is already in flight wait for the running
+    call and get its result (or exception) instead of running it again. If the
+    running call is cancelled, the waiting callers run it again themselves.
+
+    """
+
+    def __init__(self):
+        """Init single flight group."""
+        self._calls: Dict[str, asyncio.Future] = {}
+
+    def __len__(self) -> int:
+        """Number of calls in flight."""
+        return len(self._calls)
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """Return the result of `fn()` and whether it was shared with another call."""
+        future = self._calls.get(key)
+        if future is not None:
+            try:
+                return await asyncio.shield(future), True
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    # this caller was cancelled
+                    raise
+                # the call was cancelled with its caller (e.g. the client
+                # disconnected), not this one: run it again
+                return await self.do(key, fn)
+
+        future = asyncio.get_event_loop().create_future()
+        self._calls[key] = future
+        try:
+            result = await fn()
+        except Exception as e:
+            future.set_exception(e)
+            # mark the exception as retrieved, in case no one else is waiting
+            future.exception()
+            raise
+        except BaseException:
+            future.cancel()
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            del self._calls[key]
+
+
+tile_flights = SingleFlight()
@@ -0,0 +1,238 @@
+"""covid_api.core.workers: worker pools shared by all requests."""
+
+import asyncio
+import itertools
+import multiprocessing
+import threading
+from concurrent import futures
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from covid_api.core import config
+from covid_api.errors import WorkerPoolFull
+
+
+class WorkerPool(object):
+    """Thread pool shared by all requests, with bounded admission.
+
+    Each call to `map_as_completed` reserves up to `max_concurrency` slots out
+    of `max_workers + max_queue`: at most `max_workers` tasks run at the same
+    time, the others wait in the queue. When no slot is left the call fails
+    right away with `WorkerPoolFull` instead of piling up more work.
+
+    """
+
+    def __init__(self, max_workers: int, max_queue: int = 0, name: str = "worker"):
+        """Init worker pool."""
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._executor = futures.ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix=name
+        )
+        self._lock = threading.Lock()
+        self._reserved = 0
+        self._queued = 0
+        self._running = 0
+        self._completed = 0
+        self._rejected = 0
+
+    def _reserve(self, slots: int) -> int:
+        """Reserve up to `slots` slots, at least one."""
+        with self._lock:
+            free = self.max_workers + self.max_queue - self._reserved
+            if free <= 0:
+                self._rejected += 1
+                raise WorkerPoolFull(
+                    f"All {self.max_workers + self.max_queue} worker slots are in use"
+                )
+            slots = min(slots, free)
+            self._reserved += slots
+            return slots
+
+    def _release(self, slots: int = 1) -> None:
+        with self._lock:
+            self._reserved -= slots
+
+    def _run(self, fn: Callable, item: Any) -> Any:
+        with self._lock:
+            self._queued -= 1
+            self._running += 1
+        try:
+            return fn(item)
+        finally:
+            with self._lock:
+                self._running -= 1
+                self._completed += 1
+
+    def map_as_completed(
+        self, fn: Callable, items: Iterable, max_concurrency: int
+    ) -> Iterator[Tuple[Any, futures.Future]]:
+        """Run `fn` on every item, yielding `(item, future)` as they complete.
+
+        No more than `max_concurrency` items of this call are submitted at the
+        same time, the next ones are submitted as the previous ones complete.
+
+        """
+        items = list(items)
+        if not items:
+            return
+
+        slots = self._reserve(min(max_concurrency, len(items)))
+        pending = iter(items)
+        in_flight: Dict[futures.Future, Any] = {}
+
+        def _submit(item):
+            with self._lock:
+                self._queued += 1
+            in_flight[self._executor.submit(self._run, fn, item)] = item
+
+        try:
+            for item in itertools.islice(pending, slots):
+                _submit(item)
+
+            while in_flight:
+                done, _ = futures.wait(in_flight, return_when=futures.FIRST_COMPLETED)
+                for future in done:
+                    item = in_flight.pop(future)
+                    for next_item in itertools.islice(pending, 1):
+                        _submit(next_item)
+                    yield item, future
+
+        finally:
+            # The caller stopped early: drop the tasks that haven't started and
+            # keep the slots of the running ones until they complete.
+            for future in in_flight:
+                if future.cancel():
+                    with self._lock:
+                        self._queued -= 1
+                    self._release()
+                else:
+                    future.add_done_callback(lambda f: self._release())
+            self._release(slots - len(in_flight))
+
+    def stats(self) -> Dict:
+        """Return pool usage."""
+        with self._lock:
+            return dict(
+                max_workers=self.max_workers,
+                max_queue=self.max_queue,
+                running=self._running,
+                queued=self._queued,
+                reserved=self._reserved,
+                completed=self._completed,
+                rejected=self._rejected,
+                utilization=self._running / self.max_workers,
+            )
+
+
+timelapse_pool = WorkerPool(
+    max_workers=config.TIMELAPSE_MAX_WORKERS,
+    max_queue=config.TIMELAPSE_MAX_QUEUE,
+    name="timelapse",
+)
+
+
+def _shared_memory():
+    """Return `multiprocessing.shared_memory` (Python >= 3.8), or None."""
+    try:
+        from multiprocessing import shared_memory
+    except ImportError:
+        return None
+    return shared_memory
+
+
+def _run_shared(fn: Callable, arrays: List[Tuple[str, Tuple, str]], kwargs: Dict):
+    """Call `fn` with arrays read from shared memory blocks (in a pool process)."""
+    shared_memory = _shared_memory()
+    blocks = [shared_memory.SharedMemory(name=name) for name, _, _ in arrays]
+    views: Optional[List[np.ndarray]] = None
+    try:
+        views = [
+            np.ndarray(shape, dtype=dtype, buffer=block.buf)
+            for block, (_, shape, dtype) in zip(blocks, arrays)
+        ]
+        return fn(*views, **kwargs)
+    finally:
+        views = None
+        for block in blocks:
+            try:
+                block.close()
+            except BufferError:
+                # still referenced (e.g. by a traceback): unmapped at exit
+                pass
+
+
+class RenderPool(object):
+    """Process pool encoding large tiles, so rendering isn't bound to one core.
+
+    PNG/WebP encoding and rio-color operations hold the GIL for parts of the
+    work. Tiles of at least `min_tilesize` pixels are rendered by `fn` in one
+    of `max_workers` processes instead: their arrays are copied once into
+    shared memory blocks (instead of being pickled), and only the encoded bytes
+    come back. With `max_workers=0`, or on Python < 3.8 (no shared memory),
+    nothing is offloaded.
+
+    """
+
+    def __init__(self, max_workers: int, min_tilesize: int = 512):
+        """Init render pool (the processes are started on first use)."""
+        self.max_workers = max_workers
+        self.min_tilesize = min_tilesize
+        self._executor: Optional[futures.ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def accepts(self, tilesize: int) -> bool:
+        """Check if tiles of this size are rendered in the pool."""
+        return (
+            self.max_workers > 0
+            and tilesize >= self.min_tilesize
+            and _shared_memory() is not None
+        )
+
+    def _get_executor(self) -> futures.ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # GDAL isn't fork-safe once threads are running
+                self._executor = futures.ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            return self._executor
+
+    async def run(self, fn: Callable, *arrays: np.ndarray, **kwargs: Any) -> Any:
+        """Call `fn(*arrays, **kwargs)` in a pool process (`fn` must be picklable)."""
+        shared_memory = _shared_memory()
+        blocks: List = []
+        try:
+            specs = []
+            for array in arrays:
+                block = shared_memory.SharedMemory(
+                    create=True, size=max(array.nbytes, 1)
+                )
+                blocks.append(block)
+                np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[
+                    ...
+                ] = array
+                specs.append((block.name, array.shape, array.dtype.str))
+
+            future = self._get_executor().submit(_run_shared, fn, specs, kwargs)
+            return await asyncio.wrap_future(future)
+
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+
+    def shutdown(self) -> None:
+        """Stop the pool processes."""
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+
+render_pool = RenderPool(
+    max_workers=config.RENDER_PROCESSES,
+    min_tilesize=config.RENDER_PROCESSES_MIN_TILESIZE,
+)
@@ -0,0 +1,236 @@
+"""covid_api.db.cog_headers: cache of the first bytes of remote COGs.
+
+Opening a COG on S3 costs a few range requests to read its header and IFDs,
+which GDAL only keeps for the life of the process. The first bytes of each COG
+are kept on disk (and in memcached, to share them between workers) and the
+COG is opened through a GDAL `/vsisparse/` file, reading these bytes from disk
+and everything else from the COG itself.
+
+A COG may be replaced at the same url (e.g. regenerated daily): a cached header
+is only used as is for `validate_ttl` seconds, then after checking that the
+size and ETag of the COG haven't changed. The directory keeps at most
+`max_entries` COGs, none older than `ttl`.
+
+"""
+
+import hashlib
+import json
+import os
+import re
+import time
+from typing import Dict, List, Optional, Tuple
+from xml.sax.saxutils import escape
+
+import requests
+
+from covid_api.core.config import (
+    COG_HEADER_CACHE_DIR,
+    COG_HEADER_CACHE_MAX_ENTRIES,
+    COG_HEADER_CACHE_SIZE,
+    COG_HEADER_CACHE_TTL,
+    COG_HEADER_CACHE_VALIDATE_TTL,
+    COG_HEADER_REQUEST_TIMEOUT,
+)
+from covid_api.db.memcache import CacheLayer
+from covid_api.db.utils import s3
+
+
+def _vsi_path(url: str) -> str:
+    """Return the GDAL virtual file system path of a COG url."""
+    if url.startswith("s3://"):
+        return "/vsis3/" + url[len("s3://") :]
+    return "/vsicurl/" + url
+
+
+def _total_size(content_range: str) -> int:
+    """Return the file size from a `Content-Range: bytes 0-1/1234` header."""
+    return int(re.search(r"/(\d+)$", content_range).group(1))
+
+
+# (size, ETag) of a COG, to check if a cached header is still the COG's
+Validator = Tuple[int, Optional[str]]
+
+
+class COGHeaderCache(object):
+    """Header bytes of remote COGs, kept in a local directory and memcached."""
+
+    def __init__(
+        self,
+        directory: Optional[str],
+        size: int = 65536,
+        ttl: int = 86400,
+        remote: Optional[CacheLayer] = None,
+        validate_ttl: int = 300,
+        timeout: float = 10,
+        max_entries: int = 1024,
+    ):
+        """Init header cache."""
+        self.directory = directory
+        self.size = size
+        self.ttl = ttl
+        self.remote = remote
+        self.validate_ttl = validate_ttl
+        self.timeout = timeout
+        self.max_entries = max_entries
+
+    def _fetch(self, url: str) -> Tuple[bytes, int, Optional[str]]:
+        """Read the first bytes of a COG, its size and ETag."""
+        byte_range = f"bytes=0-{self.size - 1}"
+        if url.startswith("s3://"):
+            bucket, key = url[len("s3://") :].split("/", 1)
+            response = s3.get_object(Bucket=bucket, Key=key, Range=byte_range)
+            return (
+                response["Body"].read(),
+                _total_size(response["ContentRange"]),
+                response.get("ETag"),
+            )
+
+        # stream: a server ignoring the range would send the whole COG
+        with requests.get(
+            url, headers={"Range": byte_range}, timeout=self.timeout, stream=True
+        ) as response:
+            response.raise_for_status()
+            if response.status_code != 206:
+                raise ValueError(f"Range requests aren't supported for {url}")
+
+            return (
+                response.raw.read(self.size),
+                _total_size(response.headers["Content-Range"]),
+                response.headers.get("ETag"),
+            )
+
+    def _stat(self, url: str) -> Validator:
+        """Return the current size and ETag of a COG."""
+        if url.startswith("s3://"):
+            bucket, key = url[len("s3://") :].split("/", 1)
+            response = s3.head_object(Bucket=bucket, Key=key)
+            return response["ContentLength"], response.get("ETag")
+
+        response = requests.head(url, timeout=self.timeout, allow_redirects=True)
+        response.raise_for_status()
+        return int(response.headers["Content-Length"]), response.headers.get("ETag")
+
+    def _write(
+        self,
+        url: str,
+        header: bytes,
+        total: int,
+        etag: Optional[str],
+        sparse_path: str,
+    ) -> None:
+        """Write the header, its validator and the `/vsisparse/` description."""
+        header_path = sparse_path[: -len(".xml")] + ".bin"
+        validator_path = sparse_path[: -len(".xml")] + ".json"
+        regions = [(header_path, 0, len(header))]
+        if total > len(header):
+            regions.append((_vsi_path(url), len(header), total - len(header)))
+
+        xml = "".join(
+            f'<SubfileRegion><Filename relative="0">{escape(filename)}</Filename>'
+            f"<DestinationOffset>{offset}</DestinationOffset>"
+            f"<SourceOffset>{offset}</SourceOffset>"
+            f"<RegionLength>{length}</RegionLength></SubfileRegion>"
+            for filename, offset, length in regions
+        )
+        xml = f"<VSISparseFile><Length>{total}</Length>{xml}</VSISparseFile>"
+
+        # other processes may read these files: replace them atomically, the
+        # description last (its mtime is the age of the entry)
+        for path, content in (
+            (header_path, header),
+            (validator_path, json.dumps([total, etag]).encode()),
+            (sparse_path, xml.encode()),
+        ):
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(content)
+            os.replace(tmp, path)
+
+    def _prune(self) -> None:
+        """Remove the expired entries, then the oldest ones over `max_entries`."""
+        entries: Dict[str, List[Tuple[float, str]]] = {}
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                mtime = os.path.getmtime(path)
+            except OSError:
+                continue
+            entries.setdefault(name.split(".", 1)[0], []).append((mtime, path))
+
+        now = time.time()
+        by_age = []
+        for files in entries.values():
+            descriptions = [mtime for mtime, path in files if path.endswith(".xml")]
+            # the description is written last: leftovers of an interrupted write
+            # expire like the other entries
+            mtime = descriptions[0] if descriptions else min(files)[0]
+            by_age.append((mtime, files))
+        by_age.sort(key=lambda entry: entry[0])
+
+        over = max(len(by_age) - self.max_entries, 0)
+        for i, (mtime, files) in enumerate(by_age):
+            if i >= over and now - mtime < self.ttl:
+                continue
+            for _, path in files:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def _is_valid(self, sparse_path: str, validator: Validator) -> bool:
+        """Check if a cached header was read from the current COG."""
+        try:
+            with open(sparse_path[: -len(".xml")] + ".json") as f:
+                total, etag = json.load(f)
+        except (OSError, ValueError):
+            return False
+        return (total, etag) == validator
+
+    def path(self, url: str) -> str:
+        """Return the path to open a COG with, from the cache if possible."""
+        if not self.directory or not url.startswith(("s3://", "http://", "https://")):
+            return url
+
+        url_hash = hashlib.sha224(url.encode()).hexdigest()
+        sparse_path = os.path.join(self.directory, f"{url_hash}.xml")
+        try:
+            age: Optional[float] = time.time() - os.path.getmtime(sparse_path)
+        except OSError:
+            age = None
+
+        if age is not None and age < self.validate_ttl:
+            return f"/vsisparse/{sparse_path}"
+
+        try:
+            validator = self._stat(url)
+            if age is not None and age < self.ttl:
+                if self._is_valid(sparse_path, validator):
+                    os.utime(sparse_path)
+                    return f"/vsisparse/{sparse_path}"
+
+            body = (
+                self.remote.get_cog_header_from_cache(url_hash) if self.remote else None
+            )
+            if not body or tuple(body[1:]) != validator:
+                body = self._fetch(url)
+                if self.remote:
+                    self.remote.set_cog_header_cache(url_hash, body, timeout=self.ttl)
+
+            os.makedirs(self.directory, exist_ok=True)
+            self._write(url, *body, sparse_path)
+            if age is None:
+                self._prune()
+        except Exception:
+            return url
+
+        return f"/vsisparse/{sparse_path}"
+
+
+cog_headers = COGHeaderCache(
+    COG_HEADER_CACHE_DIR,
+    size=COG_HEADER_CACHE_SIZE,
+    ttl=COG_HEADER_CACHE_TTL,
+    validate_ttl=COG_HEADER_CACHE_VALIDATE_TTL,
+    timeout=COG_HEADER_REQUEST_TIMEOUT,
+    max_entries=COG_HEADER_CACHE_MAX_ENTRIES,
+)
@@ -0,0 +1,125 @@
+"""covid_api.db.handles: cache of open COG dataset handles."""
+
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Dict, Hashable, Iterator
+
+import rasterio
+from rasterio.errors import RasterioIOError
+from rasterio.io import DatasetReader
+
+from covid_api.core.config import DATASET_HANDLES_MAX_OPEN, DATASET_HANDLES_TTL
+from covid_api.db.cog_headers import cog_headers
+
+
+class _Handle(object):
+    """Open dataset, with its expiration time and whether it is in use."""
+
+    def __init__(self, dataset: DatasetReader, expires: float):
+        self.dataset = dataset
+        self.expires = expires
+        self.in_use = True
+        self.evicted = False
+
+
+class DatasetHandles(object):
+    """Process-wide LRU of open rasterio datasets.
+
+    Opening a COG fetches its header and IFDs, which for a COG on S3 takes a
+    few requests. Handles are kept open and reused by the next reads of the
+    same url, until they expire (the COG may have been replaced) or the least
+    recently used ones are closed to keep at most `maxsize` open files.
+
+    GDAL datasets can't be used by several threads at once, so handles are
+    cached by (url, options, thread) and a handle is never closed while in use:
+    it is closed when released instead.
+
+    """
+
+    def __init__(self, maxsize: int = 64, ttl: float = 300):
+        """Init dataset handles cache."""
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._handles: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        """Number of open datasets."""
+        return len(self._handles)
+
+    def _evict(self, key: Hashable) -> None:
+        handle = self._handles.pop(key)
+        handle.evicted = True
+        if not handle.in_use:
+            handle.dataset.close()
+
+    def _evict_expired_and_lru(self) -> None:
+        now = time.monotonic()
+        for key in [k for k, h in self._handles.items() if h.expires < now]:
+            self._evict(key)
+
+        idle = [k for k, h in self._handles.items() if not h.in_use]
+        while len(self._handles) > self.maxsize and idle:
+            self._evict(idle.pop(0))
+
+    @contextmanager
+    def open(self, url: str, **kwargs: Any) -> Iterator[DatasetReader]:
+        """Open a dataset, or reuse the one opened by a previous call."""
+        key = (url, tuple(sorted(kwargs.items())), threading.get_ident())
+        cache = True
+        with self._lock:
+            handle = self._handles.get(key)
+            if handle is not None and handle.in_use:
+                # nested call for the same dataset: open another one
+                handle, cache = None, False
+            elif handle is not None and handle.expires < time.monotonic():
+                self._evict(key)
+                handle = None
+
+            if handle is not None:
+                handle.in_use = True
+                self._handles.move_to_end(key)
+
+        if handle is None:
+            dataset = rasterio.open(cog_headers.path(url), **kwargs)
+            handle = _Handle(dataset, time.monotonic() + self.ttl)
+            with self._lock:
+                if cache:
+                    self._handles[key] = handle
+                    self._evict_expired_and_lru()
+                else:
+                    handle.evicted = True
+
+        try:
+            yield handle.dataset
+        except RasterioIOError:
+            # the dataset may be unusable (e.g. the COG was deleted)
+            with self._lock:
+                if self._handles.get(key) is handle:
+                    self._evict(key)
+            raise
+        finally:
+            with self._lock:
+                handle.in_use = False
+                if handle.evicted:
+                    handle.dataset.close()
+
+    def clear(self) -> None:
+        """Close all the datasets not in use."""
+        with self._lock:
+            for key in list(self._handles):
+                self._evict(key)
+
+    def stats(self) -> Dict[str, int]:
+        """Return the number of open datasets."""
+        with self._lock:
+            return dict(
+                open=len(self._handles),
+                in_use=sum(h.in_use for h in self._handles.values()),
+            )
+
+
+dataset_handles = DatasetHandles(DATASET_HANDLES_MAX_OPEN, DATASET_HANDLES_TTL)
+open_dataset = dataset_handles.open
@@ -0,0 +1,176 @@
+"""covid_api.db.lru: in-process cache layer."""
+
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Iterable, Optional, Tuple
+
+from covid_api.ressources.enums import ImageType
+from covid_api.ressources.responses import get_etag
+
+
+class LRUCache(object):
+    """Thread-safe Least Recently Used cache, with optional expiration.
+
+    With `maxbytes`, the cache is also bounded by the total size of its values,
+    as returned by `sizeof`.
+
+    """
+
+    def __init__(
+        self,
+        maxsize: int,
+        ttl: Optional[float] = None,
+        maxbytes: Optional[int] = None,
+        sizeof: Callable[[Any], int] = len,
+    ):
+        """Init LRU cache."""
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.nbytes = 0
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _pop(self, key: Hashable) -> None:
+        _, _, size = self._data.pop(key)
+        self.nbytes -= size
+
+    def __len__(self) -> int:
+        """Number of (possibly expired) entries."""
+        return len(self._data)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Get a value, marking it as most recently used."""
+        with self._lock:
+            try:
+                value, expires, _ = self._data[key]
+            except KeyError:
+                return default
+
+            if expires is not None and expires < time.monotonic():
+                self._pop(key)
+                return default
+
+            self._data.move_to_end(key)
+            return value
+
+    def get_multi(self, keys: Iterable[Hashable]) -> Dict:
+        """Get the values found in the cache for a list of keys."""
+        sentinel = object()
+        values = {key: self.get(key, sentinel) for key in keys}
+        return {k: v for k, v in values.items() if v is not sentinel}
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        """Set a value, evicting the least recently used ones if full."""
+        ttl = ttl if ttl is not None else self.ttl
+        expires = time.monotonic() + ttl if ttl else None
+        size = self.sizeof(value) if self.maxbytes is not None else 0
+        with self._lock:
+            if key in self._data:
+                self._pop(key)
+            if self.maxbytes is not None and size > self.maxbytes:
+                return
+
+            self._data[key] = (value, expires, size)
+            self.nbytes += size
+            while len(self._data) > self.maxsize or (
+                self.maxbytes is not None and self.nbytes > self.maxbytes
+            ):
+                self._pop(next(iter(self._data)))
+
+    def delete(self, key: Hashable) -> None:
+        """Remove a value."""
+        with self._lock:
+            if key in self._data:
+                self._pop(key)
+
+    def clear(self) -> None:
+        """Remove all values."""
+        with self._lock:
+            self._data.clear()
+            self.nbytes = 0
+
+
+class LocalCacheLayer(object):
+    """In-process cache layer."""
+
+    def __init__(
+        self,
+        stats_maxsize: int = 10000,
+        images_maxbytes: int = 0,
+        images_ttl: Optional[float] = None,
+    ):
+        """Init Cache Layer."""
+        self.stats = LRUCache(stats_maxsize)
+        self.images = LRUCache(
+            maxsize=sys.maxsize,
+            ttl=images_ttl,
+            maxbytes=images_maxbytes,
+            sizeof=lambda body: len(body[0]),
+        )
+
+    def get_image_from_cache(self, img_hash: str) -> Tuple[bytes, ImageType]:
+        """Get image body from cache layer (raises KeyError if not found)."""
+        body = self.images.get(img_hash)
+        if body is None:
+            raise KeyError(img_hash)
+        return body
+
+    def set_image_cache(
+        self,
+        img_hash: str,
+        body: Tuple[bytes, ImageType],
+        timeout: Optional[int] = None,
+    ) -> bool:
+        """Set image body in cache layer."""
+        self.images.set(img_hash, body, ttl=timeout)
+        return True
+
+    async def get_image_from_cache_async(
+        self, img_hash: str
+    ) -> Tuple[bytes, ImageType]:
+        """Get image body from cache layer (no I/O, safe on the event loop)."""
+        return self.get_image_from_cache(img_hash)
+
+    async def get_images_from_cache_async(
+        self, img_hashes: Iterable[str]
+    ) -> Dict[str, Tuple[bytes, ImageType]]:
+        """Get the image bodies found in cache layer, by hash."""
+        return self.images.get_multi(img_hashes)
+
+    async def set_image_cache_async(
+        self,
+        img_hash: str,
+        body: Tuple[bytes, ImageType],
+        timeout: Optional[int] = None,
+    ) -> bool:
+        """Set image body in cache layer (no I/O, safe on the event loop)."""
+        return self.set_image_cache(img_hash, body, timeout)
+
+    async def get_etag_async(self, img_hash: str) -> Optional[str]:
+        """Get the ETag of a cached image (computed from its body)."""
+        body = self.images.get(img_hash)
+        return get_etag(body[0]) if body else None
+
+    async def acquire_lock_async(self, key: str, timeout: int = 10) -> bool:
+        """In-process calls are coalesced by `covid_api.core.singleflight`."""
+        return True
+
+    async def release_lock_async(self, key: str) -> None:
+        """Release lock (no-op)."""
+
+    def get_zonal_stats_from_cache(
+        self, stats_hashes: Iterable[str]
+    ) -> Dict[str, Dict]:
+        """Get zonal statistics found in cache layer, by hash."""
+        return self.stats.get_multi(stats_hashes)
+
+    def set_zonal_stats_cache(
+        self, stats_hash: str, body: Dict, timeout: int = 432000
+    ) -> bool:
+        """Set zonal statistics in cache layer."""
+        self.stats.set(stats_hash, body, ttl=timeout)
+        return True
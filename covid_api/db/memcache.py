@@ -1,11 +1,101 @@
 """covid_api.cache.memcache: memcached layer."""
 
-from typing import Dict, Optional, Tuple, Union
+import queue
+import select
+import time
+from contextlib import contextmanager
+from functools import partial
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional, Tuple, Union
 
 from bmemcached import Client
+from bmemcached.exceptions import MemcachedException
 
 from covid_api.models.static import Datasets
 from covid_api.ressources.enums import ImageType
+from covid_api.ressources.responses import get_etag
+
+from starlette.concurrency import run_in_threadpool
+
+
+def _is_stale(client: Client) -> bool:
+    """Check if any open connection of a client was closed by the server.
+
+    An idle memcached connection should never be readable: it is either closed
+    (EOF) or has leftovers of an interrupted response.
+
+    """
+    sockets = [s.connection for s in client.servers if s.connection is not None]
+    if not sockets:
+        return False
+
+    try:
+        readable, _, _ = select.select(sockets, [], [], 0)
+    except (OSError, ValueError):
+        return True
+    return bool(readable)
+
+
+def _in_threadpool(method: Callable) -> Callable:
+    """Make an async method calling a blocking one in the threadpool."""
+
+    async def wrapper(self, *args: Any, **kwargs: Any) -> Any:
+        return await run_in_threadpool(method, self, *args, **kwargs)
+
+    wrapper.__name__ = f"{method.__name__}_async"
+    wrapper.__doc__ = f"Call `{method.__name__}` in the threadpool."
+    return wrapper
+
+
+class ClientPool(object):
+    """Thread-safe pool of memcached clients, whose connections stay open
+    between requests.
+
+    bmemcached clients hold one socket per server and can't be shared between
+    threads, so each call reserves a client for itself. Connections closed by
+    the server, left unused for more than `max_idle` seconds (e.g. while a
+    Lambda is frozen) or which failed are reopened on next use.
+
+    """
+
+    def __init__(
+        self, factory: Callable[[], Client], maxsize: int = 10, max_idle: float = 60
+    ):
+        """Init pool."""
+        self.factory = factory
+        self.maxsize = maxsize
+        self.max_idle = max_idle
+        self._clients: queue.LifoQueue = queue.LifoQueue()
+
+    @contextmanager
+    def reserve(self) -> Iterator[Client]:
+        """Reserve a client, opening a new one if they are all in use."""
+        try:
+            client, last_used = self._clients.get_nowait()
+        except queue.Empty:
+            client, last_used = self.factory(), time.monotonic()
+
+        if time.monotonic() - last_used > self.max_idle or _is_stale(client):
+            client.disconnect_all()
+
+        try:
+            yield client
+        except (OSError, MemcachedException):
+            client.disconnect_all()
+            raise
+        finally:
+            if self._clients.qsize() < self.maxsize:
+                self._clients.put((client, time.monotonic()))
+            else:
+                client.disconnect_all()
+
+    def close(self) -> None:
+        """Close all the connections."""
+        while True:
+            try:
+                client, _ = self._clients.get_nowait()
+            except queue.Empty:
+                return
+            client.disconnect_all()
 
 
 class CacheLayer(object):
@@ -17,9 +107,15 @@ class CacheLayer(object):
         port: int = 11211,
         user: Optional[str] = None,
         password: Optional[str] = None,
+        pool_size: int = 10,
+        max_idle: float = 60,
     ):
         """Init Cache Layer."""
-        self.client = Client((f"{host}:{port}",), user, password)
+        self.pool = ClientPool(
+            partial(Client, (f"{host}:{port}",), user, password),
+            maxsize=pool_size,
+            max_idle=max_idle,
+        )
 
     def get_image_from_cache(self, img_hash: str) -> Tuple[bytes, ImageType]:
         """
@@ -38,7 +134,9 @@ class CacheLayer(object):
                 image ext
 
         """
-        content, ext = self.client.get(img_hash)
+        with self.pool.reserve() as client:
+            body = client.get(img_hash)
+        content, ext = body
         return content, ext
 
     def set_image_cache(
@@ -59,19 +157,115 @@ class CacheLayer(object):
 
         """
         try:
-            return self.client.set(img_hash, body, time=timeout)
+            with self.pool.reserve() as client:
+                return not client.set_multi(
+                    {img_hash: body, f"etag:{img_hash}": get_etag(body[0])},
+                    time=timeout,
+                )
+        except Exception:
+            return False
+
+    def get_etag(self, img_hash: str) -> Optional[str]:
+        """Get the ETag of a cached image, without fetching its body."""
+        try:
+            with self.pool.reserve() as client:
+                return client.get(f"etag:{img_hash}")
+        except Exception:
+            return None
+
+    def acquire_lock(self, key: str, timeout: int = 10) -> bool:
+        """Acquire a lock shared by all the workers, for `timeout` seconds.
+
+        Returns True when memcached can't be reached, so the caller doesn't wait
+        for a lock nobody holds.
+
+        """
+        try:
+            with self.pool.reserve() as client:
+                return client.add(f"lock:{key}", 1, time=timeout)
+        except Exception:
+            return True
+
+    def release_lock(self, key: str) -> None:
+        """Release a lock acquired with `acquire_lock`."""
+        try:
+            with self.pool.reserve() as client:
+                client.delete(f"lock:{key}")
+        except Exception:
+            pass
+
+    def get_images_from_cache(
+        self, img_hashes: Iterable[str]
+    ) -> Dict[str, Tuple[bytes, ImageType]]:
+        """Get the image bodies found in cache layer, by hash."""
+        try:
+            with self.pool.reserve() as client:
+                return client.get_multi(list(img_hashes))
+        except Exception:
+            return {}
+
+    # async versions, run in the threadpool not to block the event loop
+    get_image_from_cache_async = _in_threadpool(get_image_from_cache)
+    get_images_from_cache_async = _in_threadpool(get_images_from_cache)
+    set_image_cache_async = _in_threadpool(set_image_cache)
+    get_etag_async = _in_threadpool(get_etag)
+    acquire_lock_async = _in_threadpool(acquire_lock)
+    release_lock_async = _in_threadpool(release_lock)
+
+    def get_cog_header_from_cache(
+        self, url_hash: str
+    ) -> Optional[Tuple[bytes, int, Optional[str]]]:
+        """Get COG header (first bytes, file size and ETag) from cache layer."""
+        try:
+            with self.pool.reserve() as client:
+                return client.get(url_hash)
+        except Exception:
+            return None
+
+    def set_cog_header_cache(
+        self,
+        url_hash: str,
+        body: Tuple[bytes, int, Optional[str]],
+        timeout: int = 86400,
+    ) -> bool:
+        """Set COG header (first bytes, file size and ETag) in cache layer."""
+        try:
+            with self.pool.reserve() as client:
+                return client.set(url_hash, body, time=timeout)
         except Exception:
             return False
 
     def get_dataset_from_cache(self, ds_hash: str) -> Union[Dict, bool]:
         """Get dataset response from cache layer"""
-        return self.client.get(ds_hash)
+        with self.pool.reserve() as client:
+            return client.get(ds_hash)
 
     def set_dataset_cache(
         self, ds_hash: str, body: Datasets, timeout: int = 3600
     ) -> bool:
         """Set dataset response in cache layer"""
         try:
-            return self.client.set(ds_hash, body.json(), time=timeout)
+            with self.pool.reserve() as client:
+                return client.set(ds_hash, body.json(), time=timeout)
+        except Exception:
+            return False
+
+    def get_zonal_stats_from_cache(
+        self, stats_hashes: Iterable[str]
+    ) -> Dict[str, Dict]:
+        """Get zonal statistics found in cache layer, by hash."""
+        try:
+            with self.pool.reserve() as client:
+                return client.get_multi(list(stats_hashes))
+        except Exception:
+            return {}
+
+    def set_zonal_stats_cache(
+        self, stats_hash: str, body: Dict, timeout: int = 432000
+    ) -> bool:
+        """Set zonal statistics in cache layer."""
+        try:
+            with self.pool.reserve() as client:
+                return client.set(stats_hash, body, time=timeout)
         except Exception:
             return False
@@ -1,7 +1,7 @@
 """ covid_api static datasets """
 import json
 import os
-from typing import List
+from typing import List, Optional
 
 import botocore
 
@@ -14,6 +14,7 @@ from covid_api.db.static.errors import InvalidIdentifier
 from covid_api.db.static.sites import sites
 from covid_api.db.utils import invoke_lambda, s3_get
 from covid_api.models.static import DatasetInternal, Datasets, GeoJsonSource
+from covid_api.ressources.enums import EncodeProfile
 
 data_dir = os.path.join(os.path.dirname(__file__))
 
@@ -120,7 +121,20 @@ class DatasetManager(object):
         """List all datasets"""
         return list(self._data().keys())
 
-    def _format_urls(self, tiles: List[str], api_url: str, spotlight_id: str = None):
+    def _format_urls(
+        self,
+        tiles: List[str],
+        api_url: str,
+        spotlight_id: str = None,
+        encode_profile: Optional[EncodeProfile] = None,
+    ):
+        if encode_profile:
+            tiles = [
+                f"{tile}&profile={encode_profile.value}"
+                if tile.startswith("{api_url}") and "profile=" not in tile
+                else tile
+                for tile in tiles
+            ]
         if spotlight_id:
             return [
                 tile.replace("{api_url}", api_url).replace(
@@ -167,7 +181,9 @@ class DatasetManager(object):
 
             # format url to contain the correct API host and
             # spotlight id (if a spotlight was requested)
-            format_url_params = dict(api_url=api_url)
+            format_url_params = dict(
+                api_url=api_url, encode_profile=dataset.encode_profile
+            )
             if spotlight_id:
                 if k == "nightlights-viirs" and spotlight_id in ["du", "gh"]:
                     spotlight_id = "EUPorts"
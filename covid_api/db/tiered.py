@@ -0,0 +1,129 @@
+"""covid_api.db.tiered: multi-tier image cache layer."""
+
+import threading
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+from covid_api.db.lru import LocalCacheLayer
+from covid_api.db.memcache import CacheLayer
+from covid_api.ressources.enums import ImageType
+
+Tier = Union[LocalCacheLayer, CacheLayer]
+
+
+class TieredCacheLayer(object):
+    """Image cache layer checking several cache layers in order.
+
+    Tiers are ordered from the fastest (e.g. in-process) to the slowest (e.g.
+    memcached). A tile found in a tier is promoted to all the faster ones, and
+    new tiles are set in every tier.
+
+    All the methods are coroutines: the tiers doing network I/O run it in the
+    threadpool, so a slow memcached doesn't block the event loop.
+
+    """
+
+    def __init__(self, tiers: Sequence[Tuple[str, Tier]]):
+        """Init Cache Layer with (name, cache layer) tiers."""
+        self.tiers = list(tiers)
+        self._lock = threading.Lock()
+        self._counters: Dict[str, Dict[str, int]] = {
+            name: dict(hits=0, misses=0, errors=0) for name, _ in self.tiers
+        }
+
+    def _count(self, name: str, counter: str) -> None:
+        with self._lock:
+            self._counters[name][counter] += 1
+
+    async def get_image_from_cache(self, img_hash: str) -> Tuple[bytes, ImageType]:
+        """Get image body from the first tier it is found in (raises KeyError)."""
+        missed: List[Tier] = []
+        for name, tier in self.tiers:
+            try:
+                content, ext = await tier.get_image_from_cache_async(img_hash)
+            except Exception:
+                content = None
+
+            if content:
+                self._count(name, "hits")
+                for faster_tier in missed:
+                    await faster_tier.set_image_cache_async(img_hash, (content, ext))
+                return content, ext
+
+            self._count(name, "misses")
+            missed.append(tier)
+
+        raise KeyError(img_hash)
+
+    async def get_images_from_cache(
+        self, img_hashes: Iterable[str]
+    ) -> Dict[str, Tuple[bytes, ImageType]]:
+        """Get the image bodies found in any tier, with one lookup per tier."""
+        found: Dict[str, Tuple[bytes, ImageType]] = {}
+        missing = list(img_hashes)
+        missed: List[Tier] = []
+        for name, tier in self.tiers:
+            if not missing:
+                break
+
+            try:
+                hits = await tier.get_images_from_cache_async(missing)
+            except Exception:
+                hits = {}
+
+            hits = {k: body for k, body in hits.items() if body and body[0]}
+            with self._lock:
+                self._counters[name]["hits"] += len(hits)
+                self._counters[name]["misses"] += len(missing) - len(hits)
+
+            for img_hash, body in hits.items():
+                for faster_tier in missed:
+                    await faster_tier.set_image_cache_async(img_hash, body)
+
+            found.update(hits)
+            missing = [k for k in missing if k not in hits]
+            missed.append(tier)
+
+        return found
+
+    async def get_etag(self, img_hash: str) -> Optional[str]:
+        """Get the ETag of an image from the first tier it is found in."""
+        for _, tier in self.tiers:
+            try:
+                etag = await tier.get_etag_async(img_hash)
+            except Exception:
+                etag = None
+            if etag:
+                return etag
+        return None
+
+    async def set_image_cache(
+        self, img_hash: str, body: Tuple[bytes, ImageType]
+    ) -> bool:
+        """Set image body in all the tiers."""
+        success = True
+        for name, tier in self.tiers:
+            if not await tier.set_image_cache_async(img_hash, body):
+                self._count(name, "errors")
+                success = False
+        return success
+
+    async def acquire_lock(self, key: str, timeout: int = 10) -> bool:
+        """Acquire the lock in every tier (False if any of them is held)."""
+        acquired: List[Tier] = []
+        for _, tier in self.tiers:
+            if not await tier.acquire_lock_async(key, timeout):
+                for held in acquired:
+                    await held.release_lock_async(key)
+                return False
+            acquired.append(tier)
+        return True
+
+    async def release_lock(self, key: str) -> None:
+        """Release the lock in every tier."""
+        for _, tier in self.tiers:
+            await tier.release_lock_async(key)
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """Return hit/miss counters, by tier."""
+        with self._lock:
+            return {name: dict(counters) for name, counters in self._counters.items()}
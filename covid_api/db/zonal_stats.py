@@ -0,0 +1,286 @@
+"""covid_api.db.zonal_stats: precomputed zonal statistics of the spotlight polygons.
+
+The statistics of every (spotlight polygon, raster dataset, date) are computed
+offline by `handler` and stored in the bucket as a single compressed `.npz`
+object, with one array per column. The API looks them up by geometry hash and
+COG url before reading any COG.
+
+"""
+
+import re
+import threading
+import time
+from concurrent import futures
+from datetime import datetime, timedelta
+from io import BytesIO
+from typing import Dict, List, Optional, Tuple
+
+import botocore
+import numpy as np
+from dateutil.relativedelta import relativedelta
+from rasterio.errors import RasterioIOError, WindowError
+from shapely.geometry import shape
+
+from covid_api.api import utils
+from covid_api.core.config import (
+    INDICATOR_BUCKET,
+    ZONAL_STATS_CHECKPOINT_ROWS,
+    ZONAL_STATS_STORE_FILENAME,
+    ZONAL_STATS_STORE_TTL,
+    ZONAL_STATS_TIME_MARGIN,
+)
+from covid_api.db.static.datasets import datasets
+from covid_api.db.static.sites import sites
+from covid_api.db.utils import s3, s3_get
+from covid_api.models.static import Dataset
+
+KEY_COLUMNS = ("geometry", "url")
+STATS_COLUMNS = ("mean", "median", "p10", "p90", "std", "count", "resolution")
+# statistics which can be requested on top of the mean and median
+STORED_STATS = {"p10", "p90", "std", "count"}
+# GDAL errors of a COG which doesn't exist (local file, S3 and HTTP)
+MISSING_COG_MESSAGES = (
+    "No such file or directory",
+    "does not exist",
+    "HTTP response code: 404",
+)
+
+
+class ZonalStatsStore(object):
+    """Precomputed zonal statistics, reloaded from S3 every `ttl` seconds."""
+
+    def __init__(self, bucket: str, key: str, ttl: float = 3600):
+        """Init store."""
+        self.bucket = bucket
+        self.key = key
+        self.ttl = ttl
+        self._columns: Dict[str, np.ndarray] = {}
+        self._index: Dict[Tuple[str, str], int] = {}
+        self._expires = 0.0
+        self._error: Optional[Exception] = None
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        """Number of statistics in the store."""
+        return len(self._index)
+
+    def _load(self) -> None:
+        self._error = None
+        try:
+            columns = loads(s3_get(bucket=self.bucket, key=self.key))
+        except Exception as e:
+            if not _is_missing(e):
+                print(f"Unable to load zonal statistics from {self.key}: {e}")
+                self._error = e
+            columns = {}
+
+        self._columns = columns
+        self._index = (
+            {key: row for row, key in enumerate(zip(*map(columns.get, KEY_COLUMNS)))}
+            if columns
+            else {}
+        )
+
+    def _refresh(self) -> None:
+        with self._lock:
+            if self._expires < time.monotonic():
+                self._load()
+                self._expires = time.monotonic() + self.ttl
+
+    def get(self, geometry_hash: str, url: str) -> Optional[Dict]:
+        """Get the statistics of a geometry (by hash) for a COG."""
+        self._refresh()
+        row = self._index.get((geometry_hash, url))
+        # rows without mean are the COGs that couldn't be read
+        if row is None or np.isnan(self._columns["mean"][row]):
+            return None
+
+        stats = {}
+        for column in STATS_COLUMNS:
+            value = self._columns[column][row]
+            if not np.isnan(value):
+                stats[column] = int(value) if column == "count" else float(value)
+        return stats
+
+    def rows(self) -> List[Dict]:
+        """Return all the statistics, as a list of rows.
+
+        Raises the load error if the store exists but couldn't be read, so it
+        isn't overwritten with an empty one.
+
+        """
+        self._refresh()
+        if self._error is not None:
+            raise self._error
+
+        columns = [*KEY_COLUMNS, *STATS_COLUMNS]
+        return [
+            {column: self._columns[column][row].item() for column in columns}
+            for row in self._index.values()
+        ]
+
+
+def _is_missing(error: Exception) -> bool:
+    """Check if an S3 error is a missing object (e.g. the store on first run)."""
+    return isinstance(error, botocore.exceptions.ClientError) and error.response[
+        "Error"
+    ]["Code"] in ("NoSuchKey", "404")
+
+
+def dumps(rows: List[Dict]) -> bytes:
+    """Encode zonal statistics rows as a compressed columnar `.npz` object."""
+    columns = {
+        column: np.array([row[column] for row in rows]) for column in KEY_COLUMNS
+    }
+    columns.update(
+        {
+            column: np.array(
+                [np.nan if row.get(column) is None else row[column] for row in rows],
+                dtype="float64",
+            )
+            for column in STATS_COLUMNS
+        }
+    )
+    buffer = BytesIO()
+    np.savez_compressed(buffer, **columns)
+    return buffer.getvalue()
+
+
+def loads(body: bytes) -> Dict[str, np.ndarray]:
+    """Decode a columnar `.npz` object."""
+    with np.load(BytesIO(body), allow_pickle=False) as npz:
+        return {column: npz[column] for column in npz.files}
+
+
+store = ZonalStatsStore(
+    INDICATOR_BUCKET, ZONAL_STATS_STORE_FILENAME, ttl=ZONAL_STATS_STORE_TTL
+)
+
+
+def _get_dates(dataset: Dataset) -> List[str]:
+    """Return the dates of a dataset, formatted as in its COG urls."""
+    date_format = "%Y%m" if dataset.time_unit == "month" else "%Y_%m_%d"
+    dates = [datetime.strptime(d, "%Y-%m-%dT%H:%M:%SZ") for d in dataset.domain]
+    if dataset.is_periodic and len(dates) == 2:
+        start, end = dates
+        dates = []
+        while start <= end:
+            dates.append(start)
+            if dataset.time_unit == "month":
+                start += relativedelta(months=+1)
+            else:
+                start += timedelta(days=1)
+
+    return [date.strftime(date_format) for date in dates]
+
+
+def _get_targets() -> List[Tuple[str, object, str, Optional[int]]]:
+    """Return the (geometry hash, geometry, COG url, pixel budget) to compute."""
+    targets = []
+    for site_id in sites.list():
+        site = sites.get(site_id)
+        if not site.polygon:
+            continue
+
+        geometry = site.polygon.dict()
+        geometry_hash = utils.get_geometry_hash(geometry)
+        # as computed by the date range timelapse queries
+        max_pixels = utils.get_max_pixels([geometry], date_range=True)
+        for dataset in datasets.get(site_id, api_url="").datasets:
+            if dataset.source.type != "raster":
+                continue
+
+            url_search = re.search(r"url=([^&\s]*)", dataset.source.tiles[0])
+            if not url_search or "{spotlightId}" in url_search.group(1):
+                continue
+
+            for date in _get_dates(dataset):
+                url = url_search.group(1).replace("{date}", date)
+                targets.append((geometry_hash, shape(geometry), url, max_pixels))
+
+    return targets
+
+
+def _save(rows: List[Dict]) -> None:
+    """Upload the store."""
+    print(f"Saving {len(rows)} zonal statistics to {store.key}")
+    s3.put_object(
+        Bucket=store.bucket,
+        Key=store.key,
+        Body=dumps(rows),
+        ContentType="application/octet-stream",
+    )
+
+
+def _is_missing_cog(error: Exception) -> bool:
+    """Check if a COG can't be read because it doesn't exist or doesn't cover
+    the geometry (rather than because of a transient error)."""
+    if isinstance(error, RasterioIOError):
+        return any(message in str(error) for message in MISSING_COG_MESSAGES)
+    return _is_missing(error) or isinstance(error, WindowError)
+
+
+def _compute(target: Tuple[str, object, str, Optional[int]]) -> Optional[Dict]:
+    """Compute the statistics of a geometry for a COG (None if it failed)."""
+    geometry_hash, geom, url, max_pixels = target
+    try:
+        stats = utils.get_zonal_stats(
+            [geom], url, max_pixels=max_pixels, stats=sorted(STORED_STATS)
+        )[0]
+    except Exception as e:
+        if _is_missing_cog(e):
+            # No COG for this date/spotlight or AOI outside of the COG: keep
+            # an empty row so it isn't computed again
+            return dict(geometry=geometry_hash, url=url)
+        # computed again by the next run
+        print(f"Unable to compute the zonal statistics of {url}: {e!r}")
+        return None
+    return dict(geometry=geometry_hash, url=url, **stats)
+
+
+def handler(event, context):
+    """
+    Compute the zonal statistics missing from the store and upload the new store.
+
+    The store is saved every `ZONAL_STATS_CHECKPOINT_ROWS` new statistics, and
+    no new statistics are started when the Lambda is about to time out: a run
+    which can't compute everything still makes progress for the next one.
+
+    Params:
+    -------
+    event (dict): `{"recompute": true}` drops the existing statistics (including
+        the COGs that couldn't be read) and computes everything again.
+    content (LambdaContext): used for the remaining execution time, if any.
+
+    Returns:
+    -------
+    (int): number of statistics in the store
+    """
+
+    # fails if the existing store can't be read, instead of starting over
+    rows = [] if event.get("recompute") else store.rows()
+    done = {(row["geometry"], row["url"]) for row in rows}
+    targets = [t for t in _get_targets() if (t[0], t[2]) not in done]
+    print(f"Computing zonal statistics of {len(targets)} geometry/COG pairs")
+
+    get_remaining_time = getattr(context, "get_remaining_time_in_millis", None)
+    with futures.ThreadPoolExecutor(max_workers=16) as executor:
+        for start in range(0, len(targets), ZONAL_STATS_CHECKPOINT_ROWS):
+            if (
+                get_remaining_time
+                and get_remaining_time() < ZONAL_STATS_TIME_MARGIN * 1000
+            ):
+                print("Stopping before the Lambda timeout, the job will resume")
+                break
+
+            batch = targets[start : start + ZONAL_STATS_CHECKPOINT_ROWS]
+            rows.extend(row for row in executor.map(_compute, batch) if row)
+            _save(rows)
+
+    if event.get("recompute") and not targets:
+        _save(rows)
+    return len(rows)
+
+
+if __name__ == "__main__":
+    handler(event={}, context={})
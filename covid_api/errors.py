@@ -3,3 +3,7 @@
 
 class TilerError(Exception):
     """Base exception class."""
+
+
+class WorkerPoolFull(TilerError):
+    """Raise when a worker pool can't accept more work."""
@@ -4,12 +4,16 @@ from typing import Any, Dict
 from covid_api import version
 from covid_api.api.api_v1.api import api_router
 from covid_api.core import config
+from covid_api.core.workers import render_pool
+from covid_api.db.cog_headers import cog_headers
+from covid_api.db.lru import LocalCacheLayer
 from covid_api.db.memcache import CacheLayer
+from covid_api.db.tiered import TieredCacheLayer
+from covid_api.middleware import CompressionMiddleware
 
 from fastapi import FastAPI
 
 from starlette.middleware.cors import CORSMiddleware
-from starlette.middleware.gzip import GZipMiddleware
 from starlette.requests import Request
 from starlette.responses import HTMLResponse
 from starlette.templating import Jinja2Templates
@@ -20,15 +24,33 @@ if config.MEMCACHE_HOST and not config.DISABLE_CACHE:
     kwargs: Dict[str, Any] = {
         k: v
         for k, v in zip(
-            ["port", "user", "password"],
-            [config.MEMCACHE_PORT, config.MEMCACHE_USERNAME, config.MEMCACHE_PASSWORD],
+            ["port", "user", "password", "pool_size", "max_idle"],
+            [
+                config.MEMCACHE_PORT,
+                config.MEMCACHE_USERNAME,
+                config.MEMCACHE_PASSWORD,
+                config.MEMCACHE_POOL_SIZE,
+                config.MEMCACHE_MAX_IDLE,
+            ],
         )
         if v
     }
     cache = CacheLayer(config.MEMCACHE_HOST, **kwargs)
+    cog_headers.remote = cache
 else:
     cache = None
 
+local_cache = LocalCacheLayer(
+    stats_maxsize=config.ZONAL_STATS_CACHE_SIZE,
+    images_maxbytes=config.TILE_CACHE_MAX_BYTES,
+    images_ttl=config.TILE_CACHE_TTL,
+)
+image_cache = TieredCacheLayer(
+    [("local", local_cache), ("memcached", cache)]
+    if cache
+    else [("local", local_cache)]
+)
+
 
 app = FastAPI(
     title=config.PROJECT_NAME,
@@ -48,17 +70,21 @@ if config.BACKEND_CORS_ORIGINS:
         allow_headers=["*"],
     )
 
-app.add_middleware(GZipMiddleware, minimum_size=0)
+app.add_middleware(
+    CompressionMiddleware,
+    minimum_size=config.COMPRESSION_MINIMUM_SIZE,
+    gzip_level=config.GZIP_LEVEL,
+    brotli_level=config.BROTLI_LEVEL,
+)
 
 
 @app.middleware("http")
 async def cache_middleware(request: Request, call_next):
     """Add cache layer."""
     request.state.cache = cache
-    response = await call_next(request)
-    if cache:
-        request.state.cache.client.disconnect_all()
-    return response
+    request.state.local_cache = local_cache
+    request.state.image_cache = image_cache
+    return await call_next(request)
 
 
 @app.get(
@@ -104,10 +130,22 @@ def simple(request: Request):
     )
 
 
+@app.on_event("shutdown")
+def shutdown():
+    """Stop the tile render processes."""
+    render_pool.shutdown()
+
+
 @app.get("/ping", description="Health Check")
 def ping():
     """Health check."""
     return {"ping": "pong!"}
 
 
+@app.get("/cache", description="Tile cache hit/miss counters, by tier")
+def cache_stats():
+    """Tile cache statistics."""
+    return image_cache.stats()
+
+
 app.include_router(api_router, prefix=config.API_VERSION_STR)
@@ -0,0 +1,222 @@
+"""covid_api.middleware: ASGI middlewares."""
+
+import time
+import zlib
+from typing import Any, Optional
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+try:
+    import brotli
+except ImportError:  # pragma: nocover
+    brotli = None
+
+# Media types which are already compressed (tiles) and aren't worth compressing
+INCOMPRESSIBLE_TYPES = (
+    "image/png",
+    "image/jpeg",
+    "image/jpg",
+    "image/webp",
+    "multipart/mixed",
+)
+
+
+class _GzipCompressor(object):
+    """Streaming gzip compressor (same interface as `brotli.Compressor`)."""
+
+    def __init__(self, level: int):
+        """Init compressor."""
+        self._compressobj = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+
+    def process(self, data: bytes) -> bytes:
+        """Compress data."""
+        return self._compressobj.compress(data)
+
+    def flush(self) -> bytes:
+        """Return the data compressed so far (the stream can continue)."""
+        return self._compressobj.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        """Return the remaining compressed data and end the stream."""
+        return self._compressobj.flush(zlib.Z_FINISH)
+
+
+def _accepted_encodings(accept_encoding: str) -> set:
+    """Return the content codings accepted by the client (with a non-zero q)."""
+    encodings = set()
+    for coding in accept_encoding.split(","):
+        name, _, params = coding.strip().partition(";")
+        q = params.strip()
+        if q.startswith("q="):
+            try:
+                if float(q[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        encodings.add(name.strip().lower())
+    return encodings
+
+
+def _weaken_etag(headers: MutableHeaders) -> None:
+    """Mark a strong ETag as weak: it identifies the body before encoding."""
+    etag = headers.get("ETag")
+    if etag and not etag.startswith("W/"):
+        headers["ETag"] = f"W/{etag}"
+
+
+class CompressionResponder(object):
+    """Compress the response body, unless it's small or already compressed.
+
+    Each chunk of a streaming response is flushed right away, so that small
+    streamed chunks (e.g NDJSON lines) reach the client as they are produced.
+    The time spent compressing a (non streamed) body is added to its
+    `X-Server-Timings` header.
+
+    """
+
+    def __init__(self, app: ASGIApp, encoding: str, level: int, minimum_size: int):
+        """Init responder."""
+        self.app = app
+        self.encoding = encoding
+        self.level = level
+        self.minimum_size = minimum_size
+        self.send: Send = _unattached_send
+        self.initial_message: Message = {}
+        self.started = False
+        self.compressor: Any = None
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        """Handle request."""
+        self.send = send
+        await self.app(scope, receive, self.send_compressed)
+
+    def _get_compressor(self):
+        if self.encoding == "br":
+            return brotli.Compressor(quality=self.level)
+        return _GzipCompressor(self.level)
+
+    def _skip(self, headers: MutableHeaders, body: bytes, more_body: bool) -> bool:
+        content_type = headers.get("Content-Type", "").split(";")[0].strip().lower()
+        return (
+            "Content-Encoding" in headers
+            or content_type in INCOMPRESSIBLE_TYPES
+            or (len(body) < self.minimum_size and not more_body)
+        )
+
+    async def send_compressed(self, message: Message) -> None:
+        """Compress and send a response message."""
+        message_type = message["type"]
+        if message_type == "http.response.start":
+            # Don't send the initial message until we've determined how to
+            # modify the outgoing headers correctly.
+            self.initial_message = message
+            return
+
+        if message_type != "http.response.body":
+            # e.g. "http.response.template", only sent to the test client
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if not self.started:
+            self.started = True
+            headers = MutableHeaders(raw=self.initial_message["headers"])
+            if self._skip(headers, body, more_body):
+                if (
+                    self.initial_message["status"] == 304
+                    and "Content-Type" in headers
+                    and not self._skip(headers, b"", True)
+                ):
+                    # the 200 response would have been compressed
+                    _weaken_etag(headers)
+                await self.send(self.initial_message)
+                await self.send(message)
+                return
+
+            self.compressor = self._get_compressor()
+            headers["Content-Encoding"] = self.encoding
+            headers.add_vary_header("Accept-Encoding")
+            _weaken_etag(headers)
+            if more_body:
+                del headers["Content-Length"]
+                message["body"] = (
+                    self.compressor.process(body) + self.compressor.flush()
+                )
+            else:
+                start = time.perf_counter()
+                body = self.compressor.process(body) + self.compressor.finish()
+                elapsed = time.perf_counter() - start
+                headers["Content-Length"] = str(len(body))
+                timing = "Compress ({} {}) - {:0.2f}".format(
+                    self.encoding, self.level, elapsed * 1000
+                )
+                timings = headers.get("X-Server-Timings")
+                headers["X-Server-Timings"] = (
+                    f"{timings}; {timing}" if timings else timing
+                )
+                message["body"] = body
+
+            await self.send(self.initial_message)
+            await self.send(message)
+
+        elif self.compressor is None:
+            await self.send(message)
+
+        else:
+            body = self.compressor.process(body)
+            if more_body:
+                body += self.compressor.flush()
+            else:
+                body += self.compressor.finish()
+            message["body"] = body
+            await self.send(message)
+
+
+class CompressionMiddleware(object):
+    """Content-type aware response compression, with brotli or gzip.
+
+    Brotli (if installed) is preferred when the client accepts it. Responses
+    smaller than `minimum_size` bytes and the image media types (tiles are
+    already compressed) are sent as they are.
+
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        minimum_size: int = 1024,
+        gzip_level: int = 6,
+        brotli_level: int = 4,
+    ) -> None:
+        """Init middleware."""
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_level = brotli_level
+
+    def _negotiate(self, accept_encoding: str) -> Optional[str]:
+        encodings = _accepted_encodings(accept_encoding)
+        if brotli is not None and "br" in encodings:
+            return "br"
+        if "gzip" in encodings:
+            return "gzip"
+        return None
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        """Handle request."""
+        if scope["type"] == "http":
+            headers = Headers(scope=scope)
+            encoding = self._negotiate(headers.get("Accept-Encoding", ""))
+            if encoding:
+                level = self.brotli_level if encoding == "br" else self.gzip_level
+                responder = CompressionResponder(
+                    self.app, encoding, level, self.minimum_size
+                )
+                await responder(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
+
+
+async def _unattached_send(message: Message) -> None:
+    raise RuntimeError("send awaitable not set")  # pragma: no cover
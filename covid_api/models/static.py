@@ -6,6 +6,8 @@ from geojson_pydantic.features import FeatureCollection
 from geojson_pydantic.geometries import Polygon
 from pydantic import BaseModel  # , validator
 
+from covid_api.ressources.enums import EncodeProfile
+
 # from pydantic.color import Color
 
 
@@ -120,6 +122,8 @@ class DatasetInternal(Dataset):
     """ Private dataset model (includes the dataset's location in s3) """
 
     s3_location: Optional[str]
+    # tile encoding profile (fast, balanced or small) added to the tile urls
+    encode_profile: Optional[EncodeProfile]
 
 
 class Datasets(BaseModel):
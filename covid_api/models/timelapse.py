@@ -1,14 +1,15 @@
 """Tilelapse models."""
 
 import re
-from typing import List, Optional
+from typing import List, Optional, Union
 
 from area import area
-from geojson_pydantic.features import Feature
-from geojson_pydantic.geometries import Polygon
+from geojson_pydantic.features import Feature, FeatureCollection
+from geojson_pydantic.geometries import MultiPolygon, Polygon
 from pydantic import BaseModel, validator
 
 from covid_api.core import config
+from covid_api.ressources.enums import ZonalStatistic
 
 
 def to_camel(s):
@@ -22,6 +23,25 @@ class PolygonFeature(Feature):
     geometry: Polygon
 
 
+class AreaFeature(Feature):
+    """Polygon or MultiPolygon Feature model."""
+
+    geometry: Union[Polygon, MultiPolygon]
+
+
+class AreaFeatureCollection(FeatureCollection):
+    """FeatureCollection model, of Polygon or MultiPolygon Features."""
+
+    features: List[AreaFeature]
+
+    def ids(self) -> List[str]:
+        """Return the id of each feature, or its index when it has none."""
+        return [
+            feature.id if feature.id is not None else str(ix)
+            for ix, feature in enumerate(self.features)
+        ]
+
+
 class TimelapseValue(BaseModel):
     """"Timelapse values model."""
 
@@ -31,6 +51,14 @@ class TimelapseValue(BaseModel):
     date: Optional[str]
     mean: Optional[float]
     median: Optional[float]
+    p10: Optional[float]
+    p90: Optional[float]
+    std: Optional[float]
+    count: Optional[int]
+    # [counts, bin edges]
+    histogram: Optional[List[List[float]]]
+    # pixel size of the data used, in the COG's CRS units
+    resolution: Optional[float]
     error: Optional[str]
 
 
@@ -41,24 +69,36 @@ class TimelapseRequest(BaseModel):
     # TODO: validate that exactly one of `date` or `date_range` is supplied
     date: Optional[str]
     date_range: Optional[List[str]]
+    full_resolution: bool = False
     geojson: PolygonFeature
     dataset_id: str
     spotlight_id: Optional[str]
+    stats: List[ZonalStatistic] = []
+    histogram_bins: int = 20
 
     @validator("geojson")
     def validate_query_area(cls, v, values):
-        """Ensure that requested AOI is is not larger than 200 000 km^2, otherwise
-        query takes too long"""
-        if area(v.geometry.dict()) / (
-            1000 * 1000
-        ) > config.TIMELAPSE_MAX_AREA and values.get("date_range"):
+        """Ensure that requested AOI is is not larger than 200 000 km^2 at full
+        resolution, otherwise query takes too long"""
+        if (
+            area(v.geometry.dict()) / (1000 * 1000) > config.TIMELAPSE_MAX_AREA
+            and values.get("date_range")
+            and values.get("full_resolution")
+        ):
 
             raise ValueError(
-                "AOI cannot exceed 200 000 km^2, when queried with a date range. "
-                "To query with this AOI please query with a single date"
+                "AOI cannot exceed 200 000 km^2, when queried with a date range at full "
+                "resolution. To query with this AOI please query with a single date"
             )
         return v
 
+    @validator("histogram_bins")
+    def validate_histogram_bins(cls, v):
+        """Validator"""
+        if not 1 <= v <= 256:
+            raise ValueError("Field `histogramBins` must be between 1 and 256")
+        return v
+
     @validator("date_range")
     def validate_date_objects(cls, v):
 
@@ -72,3 +112,92 @@ class TimelapseRequest(BaseModel):
         within the code"""
 
         alias_generator = to_camel
+
+
+class TimelapseBatchRequest(BaseModel):
+    """"Timelapse batch request model, for several features at once."""
+
+    date: Optional[str]
+    date_range: Optional[List[str]]
+    full_resolution: bool = False
+    geojson: AreaFeatureCollection
+    dataset_id: str
+    spotlight_id: Optional[str]
+    stats: List[ZonalStatistic] = []
+    histogram_bins: int = 20
+
+    @validator("geojson")
+    def validate_features(cls, v, values):
+        """Ensure that the features can be referenced by their id, and that
+        the requested AOIs are not too large"""
+        if not v.features:
+            raise ValueError("FeatureCollection must contain at least one feature")
+
+        if len(v.features) > config.TIMELAPSE_BATCH_MAX_FEATURES:
+            raise ValueError(
+                f"FeatureCollection cannot contain more than "
+                f"{config.TIMELAPSE_BATCH_MAX_FEATURES} features"
+            )
+
+        ids = v.ids()
+        if len(ids) != len(set(ids)):
+            raise ValueError("Feature ids must be unique")
+
+        if (
+            sum(area(feature.geometry.dict()) for feature in v.features) / (1000 * 1000)
+            > config.TIMELAPSE_MAX_AREA
+            and values.get("date_range")
+            and values.get("full_resolution")
+        ):
+
+            raise ValueError(
+                "Total AOI cannot exceed 200 000 km^2, when queried with a date range at "
+                "full resolution. To query with these AOIs please query with a single date"
+            )
+        return v
+
+    @validator("histogram_bins")
+    def validate_histogram_bins(cls, v):
+        """Validator"""
+        if not 1 <= v <= 256:
+            raise ValueError("Field `histogramBins` must be between 1 and 256")
+        return v
+
+    @validator("date_range")
+    def validate_date_objects(cls, v):
+        """Validator"""
+        if not len(v) == 2:
+            raise ValueError("Field `dateRange` must contain exactly 2 dates")
+        return v
+
+    class Config:
+        """Generate alias to convert `camelCase` requests to `snake_case` fields to be used
+        within the code"""
+
+        alias_generator = to_camel
+
+
+class PointValue(BaseModel):
+    """"Point values model."""
+
+    date: Optional[str]
+    value: Optional[float]
+    error: Optional[str]
+
+
+class PointRequest(BaseModel):
+    """"Point request model."""
+
+    lon: float
+    lat: float
+    date: Optional[str]
+    date_range: Optional[List[str]]
+    dataset_id: str
+    spotlight_id: Optional[str]
+
+    @validator("date_range")
+    def validate_date_objects(cls, v):
+        """Validator"""
+        if v is not None and not len(v) == 2:
+            raise ValueError("Field `dateRange` must contain exactly 2 dates")
+        return v
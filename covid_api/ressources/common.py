@@ -1,5 +1,6 @@
 """Commons."""
 
+from rio_tiler.profiles import img_profiles
 
 extensions = dict(JPEG="jpg", PNG="png", GTiff="tif", WEBP="webp")
 
@@ -12,3 +13,11 @@ mimetype = dict(
     jpg="image/jpg",
     webp="image/webp",
 )
+
+# GDAL creation options by encoding profile and driver: `fast` trades size for
+# encoding time (mostly for the @2x/@3x PNG tiles), `small` does the opposite.
+encode_profiles = dict(
+    fast=dict(png=dict(zlevel=1), jpeg=dict(quality=80), webp=dict(quality=70)),
+    balanced=dict(img_profiles),
+    small=dict(png=dict(zlevel=9), jpeg=dict(quality=75), webp=dict(quality=65)),
+)
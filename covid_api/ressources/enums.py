@@ -11,3 +11,21 @@ class ImageType(str, Enum):
     tif = "tif"
     jpg = "jpg"
     webp = "webp"
+
+
+class EncodeProfile(str, Enum):
+    """Tile encoding profiles Enums."""
+
+    fast = "fast"
+    balanced = "balanced"
+    small = "small"
+
+
+class ZonalStatistic(str, Enum):
+    """Optional zonal statistics Enums."""
+
+    p10 = "p10"
+    p90 = "p90"
+    std = "std"
+    count = "count"  # type: ignore
+    histogram = "histogram"
@@ -1,7 +1,15 @@
 """Common response models."""
 
+import hashlib
+import json
+import uuid
+from typing import Any, Callable, Coroutine, Dict, Iterable, Iterator, Optional, Tuple
+
+from fastapi.routing import APIRoute
+
 from starlette.background import BackgroundTask
-from starlette.responses import Response
+from starlette.requests import Request
+from starlette.responses import Response, StreamingResponse
 
 
 class XMLResponse(Response):
@@ -10,24 +18,137 @@ class XMLResponse(Response):
     media_type = "application/xml"
 
 
+class NDJSONResponse(StreamingResponse):
+    """Newline delimited JSON Response, streaming one JSON document per line."""
+
+    media_type = "application/x-ndjson"
+
+    def __init__(self, content: Iterable[Dict[str, Any]], **kwargs: Any) -> None:
+        """Init NDJSON response."""
+        super().__init__(self._encode(content), **kwargs)
+
+    @staticmethod
+    def _encode(content: Iterable[Dict[str, Any]]) -> Iterator[bytes]:
+        for item in content:
+            yield json.dumps(item, separators=(",", ":")).encode("utf-8") + b"\n"
+
+
+class MultipartResponse(Response):
+    """multipart/mixed Response, with one part per (headers, body)."""
+
+    def __init__(
+        self,
+        parts: Iterable[Tuple[Dict[str, str], bytes]],
+        boundary: Optional[str] = None,
+        **kwargs: Any,
+    ) -> None:
+        """Init multipart response."""
+        boundary = boundary or uuid.uuid4().hex
+        body = b"".join(
+            b"--%s\r\n%s\r\n\r\n%s\r\n"
+            % (
+                boundary.encode(),
+                "\r\n".join(f"{k}: {v}" for k, v in headers.items()).encode(),
+                content,
+            )
+            for headers, content in parts
+        )
+        body += b"--%s--\r\n" % boundary.encode()
+        super().__init__(
+            body, media_type=f"multipart/mixed; boundary={boundary}", **kwargs
+        )
+
+
 class TileResponse(Response):
-    """Tiler's response."""
+    """Tiler's response, with a strong ETag of its content."""
 
     def __init__(
         self,
         content: bytes,
         media_type: str,
         status_code: int = 200,
-        headers: dict = {},
+        headers: Optional[Dict[str, str]] = None,
         background: BackgroundTask = None,
         ttl: int = 3600,
+        etag: Optional[str] = None,
     ) -> None:
         """Init tiler response."""
+        headers = dict(headers or {})
         headers.update({"Content-Type": media_type})
+        headers.update({"ETag": etag or get_etag(content)})
         if ttl:
-            headers.update({"Cache-Control": "max-age=3600"})
+            headers.update({"Cache-Control": f"max-age={ttl}"})
         self.body = self.render(content)
-        self.status_code = 200
+        self.status_code = status_code
         self.media_type = media_type
         self.background = background
         self.init_headers(headers)
+
+
+class NotModifiedResponse(Response):
+    """304 response, for a conditional request matching the current ETag."""
+
+    def __init__(
+        self, etag: str, headers: Optional[Dict[str, str]] = None, ttl: int = 3600
+    ) -> None:
+        """Init not modified response."""
+        headers = dict(headers or {})
+        headers.update({"ETag": etag})
+        if ttl:
+            headers.update({"Cache-Control": f"max-age={ttl}"})
+        super().__init__(status_code=304, headers=headers)
+
+
+def get_etag(content: bytes) -> str:
+    """Return a strong ETag of a response body."""
+    return '"{}"'.format(hashlib.blake2b(content, digest_size=16).hexdigest())
+
+
+def etag_matches(if_none_match: Optional[str], etag: Optional[str]) -> bool:
+    """Check an If-None-Match header against an ETag (weak comparison)."""
+    if not if_none_match or not etag:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+
+    def _opaque(tag: str) -> str:
+        tag = tag.strip()
+        return tag[2:] if tag.startswith("W/") else tag
+
+    return _opaque(etag) in {_opaque(tag) for tag in if_none_match.split(",")}
+
+
+class ETagRoute(APIRoute):
+    """API route adding an ETag to the successful responses.
+
+    Conditional requests (`If-None-Match`) matching it are answered with a 304,
+    without body.
+
+    """
+
+    def get_route_handler(self) -> Callable[[Request], Coroutine[Any, Any, Response]]:
+        """Wrap the route handler."""
+        handler = super().get_route_handler()
+
+        async def etag_handler(request: Request) -> Response:
+            response = await handler(request)
+            if (
+                response.status_code != 200
+                or "etag" in response.headers
+                or not hasattr(response, "body")
+            ):
+                return response
+
+            etag = get_etag(response.body)
+            if etag_matches(request.headers.get("If-None-Match"), etag):
+                headers = {
+                    k: v
+                    for k, v in response.headers.items()
+                    if k in ("cache-control", "content-type", "x-cache")
+                }
+                return NotModifiedResponse(etag, headers=headers, ttl=0)
+
+            response.headers["ETag"] = etag
+            return response
+
+        return etag_handler
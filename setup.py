@@ -19,6 +19,7 @@ inst_reqs = [
     "geojson-pydantic",
     "requests",
     "mercantile",
+    "brotli",
 ]
 extra_reqs = {
     "dev": ["pytest", "pytest-cov", "pytest-asyncio", "pre-commit"],
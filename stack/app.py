@@ -51,6 +51,7 @@ class covidApiLambdaStack(core.Stack):
         id: str,
         dataset_metadata_filename: str,
         dataset_metadata_generator_function_name: str,
+        zonal_stats_filename: str,
         memory: int = 1024,
         timeout: int = 30,
         concurrent: int = 100,
@@ -128,13 +129,16 @@ class covidApiLambdaStack(core.Stack):
                 MEMCACHE_PORT=cache.attr_configuration_endpoint_port,
                 DATASET_METADATA_FILENAME=dataset_metadata_filename,
                 DATASET_METADATA_GENERATOR_FUNCTION_NAME=dataset_metadata_generator_function_name,
+                ZONAL_STATS_STORE_FILENAME=zonal_stats_filename,
+                COG_HEADER_CACHE_DIR="/tmp/cog-headers",
                 PLANET_API_KEY=os.environ["PLANET_API_KEY"],
             )
         )
 
+        code = self.create_package(code_dir)
         lambda_function_props = dict(
             runtime=aws_lambda.Runtime.PYTHON_3_7,
-            code=self.create_package(code_dir),
+            code=code,
             handler="handler.handler",
             memory_size=memory,
             timeout=core.Duration.seconds(timeout),
@@ -154,6 +158,32 @@ class covidApiLambdaStack(core.Stack):
         lambda_function.add_to_role_policy(logs_access)
         lambda_function.add_to_role_policy(ec2_network_access)
 
+        # precomputes the zonal statistics of the spotlight polygons, with the same
+        # package as the API
+        zonal_stats_function = aws_lambda.Function(
+            self,
+            f"{id}-zonal-stats-generator-lambda",
+            runtime=aws_lambda.Runtime.PYTHON_3_7,
+            code=code,
+            handler="covid_api.db.zonal_stats.handler",
+            memory_size=memory,
+            timeout=core.Duration.minutes(15),
+            environment=lambda_env,
+            security_groups=[lambda_function_security_group],
+            vpc=vpc,
+        )
+        zonal_stats_function.add_to_role_policy(s3_full_access_to_data_bucket)
+        zonal_stats_function.add_to_role_policy(logs_access)
+        zonal_stats_function.add_to_role_policy(ec2_network_access)
+
+        aws_events.Rule(
+            self,
+            f"{id}-zonal-stats-update-daily-trigger",
+            # triggers everyday
+            schedule=aws_events.Schedule.rate(duration=core.Duration.days(1)),
+            targets=[aws_events_targets.LambdaFunction(zonal_stats_function)],
+        )
+
         # defines an API Gateway Http API resource backed by our "dynamoLambda" function.
         apigw.HttpApi(
             self,
@@ -386,6 +416,7 @@ covidApiLambdaStack(
     concurrent=config.MAX_CONCURRENT,
     dataset_metadata_filename=f"{config.STAGE}-dataset-metadata.json",
     dataset_metadata_generator_function_name=f"{config.STAGE}-dataset-metadata-generator",
+    zonal_stats_filename=f"{config.STAGE}-zonal-stats.npz",
     env=dict(
         account=os.environ["CDK_DEFAULT_ACCOUNT"],
         region=os.environ["CDK_DEFAULT_REGION"],
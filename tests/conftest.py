@@ -16,12 +16,25 @@ def aws_credentials(monkeypatch):
     monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "rde")
 
 
+@pytest.fixture(autouse=True)
+def dataset_handles(aws_credentials):
+    """Close the COG datasets kept open by the previous test."""
+    from covid_api.db.handles import dataset_handles
+
+    dataset_handles.clear()
+    yield dataset_handles
+    dataset_handles.clear()
+
+
 @pytest.fixture
 def app() -> TestClient:
     """Make sure we use monkeypatch env."""
 
-    from covid_api.main import app
+    from covid_api.api.utils import _cog_bounds
+    from covid_api.main import app, local_cache
 
+    local_cache.images.clear()
+    _cog_bounds.clear()
     return TestClient(app)
 
 
@@ -128,3 +128,40 @@ def test_incorrect_dataset_id(app):
 
     response = app.get("/v1/datasets/NOT_A_VALID_DATASET")
     assert response.status_code == 404
+
+
+@mock_s3
+def test_datasets_encode_profile(app):
+    from covid_api.db.static.datasets import DatasetManager
+    from covid_api.ressources.enums import EncodeProfile
+
+    _setup_s3()
+    data = DatasetManager()._data()
+    data["co2"].encode_profile = EncodeProfile.fast
+    with patch.object(DatasetManager, "_data", return_value=data):
+        response = app.get("v1/datasets")
+
+    assert response.status_code == 200
+    co2 = next(d for d in response.json()["datasets"] if d["id"] == "co2")
+    assert co2["source"]["tiles"][0].endswith("&profile=fast")
+    assert co2["compare"]["source"]["tiles"][0].endswith("&profile=fast")
+    assert "encodeProfile" not in co2
+
+
+@mock_s3
+def test_datasets_conditional(app):
+    _setup_s3()
+    response = app.get("v1/datasets")
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+
+    response = app.get("v1/datasets", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+    assert not response.content
+
+    # ETags of compressed responses are weak, and compared as such
+    response = app.get(
+        "v1/datasets", headers={"If-None-Match": etag, "Accept-Encoding": "identity"},
+    )
+    assert response.status_code == 304
@@ -0,0 +1,77 @@
+"""Test /v1/point endpoints"""
+
+from unittest.mock import patch
+
+import pytest
+from moto import mock_s3
+
+from .test_timelapse import _setup_s3, cog  # noqa: F401
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    """Empty the in-process COG blocks cache."""
+    from covid_api.api import utils
+
+    utils._point_metadata.clear()
+    utils._point_blocks.clear()
+
+
+@mock_s3
+def test_point(app, cog):  # noqa: F811
+    from covid_api.api import utils
+    from covid_api.core.config import DATASET_HANDLES_TTL
+
+    _setup_s3()
+    with patch("covid_api.db.handles.rasterio") as rio:
+        rio.open.side_effect = cog
+
+        response = app.get(
+            "/v1/point",
+            params={
+                "lon": -77,
+                "lat": 38.9,
+                "datasetId": "co2",
+                "dateRange": "2020_01_01,2020_01_04",
+            },
+        )
+        assert response.status_code == 200
+        body = response.json()
+        assert body[:3] == [
+            {"date": "2020_01_01", "value": 1},
+            {"date": "2020_01_02", "value": 2},
+            {"date": "2020_01_03", "value": 3},
+        ]
+        assert body[3]["date"] == "2020_01_04"
+        assert body[3]["error"]
+
+        # neighbouring point, served from the cached blocks
+        rio.open.reset_mock()
+        response = app.get(
+            "/v1/point",
+            params={
+                "lon": -77.01,
+                "lat": 38.9,
+                "datasetId": "co2",
+                "date": "2020_01_02",
+            },
+        )
+        assert response.status_code == 200, response.text
+        assert response.json() == {"value": 2}
+        assert not rio.open.called
+
+        # the COG may be replaced at the same url
+        assert utils._point_blocks.ttl == DATASET_HANDLES_TTL
+
+        # outside of the COG
+        response = app.get(
+            "/v1/point",
+            params={"lon": -70, "lat": 38.9, "datasetId": "co2", "date": "2020_01_02"},
+        )
+        assert response.status_code == 400
+
+    response = app.get(
+        "/v1/point",
+        params={"lon": -70, "lat": 38.9, "datasetId": "co2", "dateRange": "2020_01_02"},
+    )
+    assert response.status_code == 400
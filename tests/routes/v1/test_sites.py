@@ -35,3 +35,16 @@ def test_site_id(app):
 
     response = app.get("/v1/sites/be")
     assert response.status_code == 200
+
+
+@mock_s3
+def test_sites_conditional(app):
+    _setup_s3()
+    response = app.get("/v1/sites/be")
+    etag = response.headers["ETag"]
+
+    response = app.get("/v1/sites/be", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+    response = app.get("/v1/sites/tk", headers={"If-None-Match": etag})
+    assert response.status_code == 200
@@ -1,10 +1,10 @@
 """test /v1/tiles endpoints."""
 
 from io import BytesIO
-from typing import Dict
+from typing import Dict, List, Tuple
 
 import numpy
-from mock import patch
+from mock import Mock, patch
 from rasterio.io import MemoryFile
 
 from ...conftest import mock_rio
@@ -16,7 +16,7 @@ def parse_img(content: bytes) -> Dict:
             return dst.meta
 
 
-@patch("covid_api.api.api_v1.endpoints.tiles.cogeo.rasterio")
+@patch("covid_api.db.handles.rasterio")
 def test_tile(rio, app):
     """test tile endpoints."""
     rio.open = mock_rio
@@ -28,6 +28,13 @@ def test_tile(rio, app):
     meta = parse_img(response.content)
     assert meta["width"] == 256
     assert meta["height"] == 256
+    assert "X-Cache" not in response.headers
+
+    # served from the in-process tile cache
+    response = app.get("/v1/8/87/48?url=https://myurl.com/cog.tif&rescale=0,1000")
+    assert response.status_code == 200
+    assert response.headers["X-Cache"] == "HIT"
+    assert app.get("/cache").json()["local"]["hits"] >= 1
 
     response = app.get(
         "/v1/8/87/48@2x?url=https://myurl.com/cog.tif&rescale=0,1000&color_formula=Gamma R 3"
@@ -76,3 +83,237 @@ def test_tile(rio, app):
     )
     assert response.status_code == 200
     assert response.headers["content-type"] == "image/png"
+    # colormapped: palette PNG
+    with MemoryFile(response.content) as mem:
+        with mem.open() as dst:
+            assert dst.count == 1
+            assert dst.colormap(1)
+
+    # color_formula: RGBA PNG
+    response = app.get(
+        "/v1/8/84/47?url=https://myurl.com/cog.tif&nodata=0&rescale=0,1000&color_map=viridis&color_formula=Gamma R 3"
+    )
+    assert response.status_code == 200
+    assert parse_img(response.content)["count"] == 4
+
+
+@patch("covid_api.db.handles.rasterio")
+def test_tile_empty(rio, app):
+    """Empty tiles should be served without reading or encoding them."""
+    from covid_api.api import utils
+
+    rio.open = Mock(side_effect=mock_rio)
+
+    from covid_api.core.config import DATASET_HANDLES_TTL
+
+    # the COG may be replaced (and extended) at the same url
+    assert utils._cog_bounds.ttl == DATASET_HANDLES_TTL
+
+    # bounds aren't known yet: the tile is read
+    response = app.get("/v1/8/0/0?url=https://myurl.com/cog.tif")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "image/png"
+    assert response.content == utils.empty_tile(256)
+    assert rio.open.call_count == 1
+
+    with patch("covid_api.api.utils.reader.tile") as tile:
+        response = app.get("/v1/8/1/0@2x?url=https://myurl.com/cog.tif")
+        assert response.status_code == 200
+        assert response.headers["X-Tile-Empty"] == "outside-bounds"
+        assert response.content == utils.empty_tile(512)
+        assert not tile.called
+
+        response = app.get("/v1/8/1/0.jpg?url=https://myurl.com/cog.tif")
+        assert response.status_code == 204
+        assert not tile.called
+
+    # fully masked tile, inside of the COG bounds
+    empty = (
+        numpy.zeros((1, 256, 256), dtype="uint16"),
+        numpy.zeros((256, 256), dtype="uint8"),
+    )
+    with patch("covid_api.api.utils.reader.tile", return_value=empty), patch(
+        "covid_api.api.api_v1.endpoints.tiles._render"
+    ) as render:
+        response = app.get("/v1/8/87/48?url=https://myurl.com/cog.tif")
+        assert response.status_code == 200
+        assert response.content == utils.empty_tile(256)
+        assert not render.called
+
+
+def parse_multipart(response) -> List[Tuple[Dict, bytes]]:
+    boundary = response.headers["content-type"].split("boundary=")[1].encode()
+    parts = []
+    for part in response.content.split(b"--" + boundary)[1:-1]:
+        head, body = part[2:-2].split(b"\r\n\r\n", 1)
+        headers = dict(line.split(": ", 1) for line in head.decode().split("\r\n"))
+        parts.append((headers, body))
+    return parts
+
+
+@patch("covid_api.db.handles.rasterio")
+def test_tiles_batch(rio, app):
+    """test /tiles/batch endpoint."""
+    from covid_api.api import utils
+
+    rio.open = Mock(side_effect=mock_rio)
+
+    response = app.get(
+        "/v1/tiles/batch?url=https://myurl.com/cog.tif&rescale=0,1000&tiles=8/87/48,8/84/47,8/0/0"
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("multipart/mixed")
+    assert rio.open.call_count == 1
+    parts = parse_multipart(response)
+    assert [h["Content-Location"] for h, _ in parts] == ["8/87/48", "8/84/47", "8/0/0"]
+    assert parts[0][0]["Content-Type"] == "image/jpg"
+    assert parse_img(parts[0][1])["width"] == 256
+    assert parts[1][0]["Content-Type"] == "image/png"
+    # outside of the COG
+    assert parts[2][0]["Content-Type"] == "image/png"
+    assert parts[2][1] == utils.empty_tile(256)
+
+    # same tiles as the single tile endpoint, read from the cache at once
+    response = app.get("/v1/8/87/48?url=https://myurl.com/cog.tif&rescale=0,1000")
+    assert response.headers["X-Cache"] == "HIT"
+    response = app.get(
+        "/v1/tiles/batch?url=https://myurl.com/cog.tif&rescale=0,1000&tiles=8/87/48,8/84/47"
+    )
+    assert rio.open.call_count == 1
+    assert [h["X-Cache"] for h, _ in parse_multipart(response)] == ["HIT", "HIT"]
+
+    response = app.get(
+        "/v1/tiles/batch?url=https://myurl.com/cog.tif&bbox=-55.5,73,-54.5,73.5&zoom=8"
+    )
+    assert response.status_code == 200
+    assert len(parse_multipart(response)) >= 1
+
+    response = app.get("/v1/tiles/batch?url=https://myurl.com/cog.tif")
+    assert response.status_code == 400
+
+    # too many tiles, rejected without listing them all
+    response = app.get(
+        "/v1/tiles/batch?url=https://myurl.com/cog.tif&bbox=-180,-85,180,85&zoom=20"
+    )
+    assert response.status_code == 400
+
+    for bbox in ("1,2,3", "a,b,c,d", "0,10,1,5", "0,nan,1,1"):
+        response = app.get(
+            f"/v1/tiles/batch?url=https://myurl.com/cog.tif&bbox={bbox}&zoom=8"
+        )
+        assert response.status_code == 400
+
+
+@patch("covid_api.db.handles.rasterio")
+def test_tile_render_pool(rio, app):
+    """Large tiles should be rendered in the process pool, with the same output."""
+    from covid_api.core.workers import RenderPool
+    from covid_api.main import local_cache
+
+    rio.open = mock_rio
+
+    urls = [
+        "/v1/8/87/48@2x.png?url=https://myurl.com/cog.tif&rescale=0,1000&color_map=viridis",
+        "/v1/8/84/47@2x?url=https://myurl.com/cog.tif&rescale=0,1000&color_formula=Gamma R 3",
+    ]
+    expected = [app.get(url).content for url in urls]
+    local_cache.images.clear()
+
+    pool = RenderPool(max_workers=1, min_tilesize=512)
+    try:
+        with patch("covid_api.api.api_v1.endpoints.tiles.render_pool", pool), patch(
+            "covid_api.api.api_v1.endpoints.tiles._render"
+        ) as render:
+            for url, content in zip(urls, expected):
+                response = app.get(url)
+                assert response.status_code == 200
+                assert response.content == content
+            assert not render.called
+    finally:
+        pool.shutdown()
+
+
+@patch("covid_api.db.handles.rasterio")
+def test_tile_encode_profile(rio, app):
+    """Tiles should be encoded with the requested profile."""
+    rio.open = mock_rio
+
+    url = "/v1/8/87/48@2x.png?url=https://myurl.com/cog.tif&rescale=0,1000"
+    fast = app.get(f"{url}&profile=fast")
+    assert fast.status_code == 200
+    assert "Format (fast)" in fast.headers["X-Server-Timings"]
+    assert f"Size - {len(fast.content)}" in fast.headers["X-Server-Timings"]
+
+    small = app.get(f"{url}&profile=small")
+    assert "Format (small)" in small.headers["X-Server-Timings"]
+    assert len(small.content) < len(fast.content)
+    assert parse_img(small.content)["width"] == 512
+
+    response = app.get(url)
+    assert "Format (balanced)" in response.headers["X-Server-Timings"]
+
+    # lossy formats: lower quality for the small profile
+    for ext in ("jpg", "webp"):
+        url = f"/v1/8/87/48@2x.{ext}?url=https://myurl.com/cog.tif&rescale=0,8000&color_map=viridis"
+        balanced = app.get(f"{url}&profile=balanced")
+        small = app.get(f"{url}&profile=small")
+        assert small.headers["content-type"] == f"image/{ext}"
+        assert len(small.content) < len(balanced.content)
+
+    response = app.get(f"{url}&profile=tiny")
+    assert response.status_code == 422
+
+
+@patch("covid_api.db.handles.rasterio")
+def test_tile_not_compressed(rio, app):
+    """Tiles are already compressed images."""
+    rio.open = mock_rio
+
+    response = app.get(
+        "/v1/8/87/48.png?url=https://myurl.com/cog.tif&rescale=0,1000",
+        headers={"Accept-Encoding": "gzip, br"},
+    )
+    assert response.status_code == 200
+    assert "content-encoding" not in response.headers
+
+
+@patch("covid_api.db.handles.rasterio")
+def test_tile_conditional(rio, app):
+    """Tiles the client already has should be answered with a 304."""
+    rio.open = mock_rio
+
+    url = "/v1/8/87/48.png?url=https://myurl.com/cog.tif&rescale=0,1000"
+    response = app.get(url)
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+    assert etag.startswith('"')
+    assert response.headers["Cache-Control"] == "max-age=3600"
+
+    with patch("covid_api.db.tiered.TieredCacheLayer.get_image_from_cache") as get:
+        response = app.get(url, headers={"If-None-Match": f'"other", {etag}'})
+        assert response.status_code == 304
+        assert response.headers["ETag"] == etag
+        assert response.headers["X-Cache"] == "HIT"
+        assert not response.content
+        # the ETag is found without fetching the tile
+        assert not get.called
+
+    response = app.get(url, headers={"If-None-Match": '"other"'})
+    assert response.status_code == 200
+    assert response.headers["ETag"] == etag
+    assert response.content
+
+
+def test_tile_response():
+    """TileResponse should honour its status code, headers and ttl."""
+    from covid_api.ressources.responses import TileResponse, get_etag
+
+    response = TileResponse(b"png", media_type="image/png", ttl=60, status_code=202)
+    assert response.status_code == 202
+    assert response.headers["Cache-Control"] == "max-age=60"
+    assert response.headers["ETag"] == get_etag(b"png")
+
+    headers = {"X-Cache": "HIT"}
+    response = TileResponse(b"png", media_type="image/png", headers=headers)
+    assert response.headers["X-Cache"] == "HIT"
+    assert headers == {"X-Cache": "HIT"}
@@ -0,0 +1,351 @@
+"""Test /v1/timelapse endpoints"""
+
+import json
+from unittest.mock import patch
+
+import boto3
+import numpy
+import pytest
+import rasterio
+from moto import mock_s3
+from rasterio.transform import from_origin
+
+from covid_api.core.config import INDICATOR_BUCKET
+
+DATASET_METADATA_FILENAME = "dev-dataset-metadata.json"
+
+GEOJSON = {
+    "type": "Feature",
+    "properties": {},
+    "geometry": {
+        "type": "Polygon",
+        "coordinates": [
+            [
+                [-77.05, 38.85],
+                [-76.95, 38.85],
+                [-76.95, 38.95],
+                [-77.05, 38.95],
+                [-77.05, 38.85],
+            ]
+        ],
+    },
+}
+
+
+@mock_s3
+def _setup_s3():
+    s3 = boto3.resource("s3")
+    bucket = s3.Bucket(INDICATOR_BUCKET)
+    bucket.create()
+    bucket.put_object(
+        Body=json.dumps(
+            {
+                "_all": {
+                    "co2": {"domain": ["2020-01-01T00:00:00Z", "2020-01-31T00:00:00Z"]}
+                }
+            }
+        ),
+        Key=DATASET_METADATA_FILENAME,
+    )
+    return bucket
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    """Empty the in-process zonal statistics cache."""
+    from covid_api.main import local_cache
+
+    local_cache.stats.clear()
+
+
+@pytest.fixture
+def cog(tmp_path):
+    """Create a small EPSG:4326 raster, with a different value for each date."""
+    cogs = {}
+    for day in range(1, 4):
+        path = str(tmp_path / f"xco2_16day_mean.2020_01_0{day}.tif")
+        with rasterio.open(
+            path,
+            "w",
+            driver="GTiff",
+            dtype="float32",
+            count=1,
+            width=100,
+            height=100,
+            crs="epsg:4326",
+            transform=from_origin(-77.5, 39.5, 0.01, 0.01),
+        ) as dst:
+            dst.write(numpy.full((1, 100, 100), day, dtype="float32"))
+        cogs[f"s3://covid-eo-data/xco2-mean/xco2_16day_mean.2020_01_0{day}.tif"] = path
+
+    def _open(url, *args, **kwargs):
+        if url not in cogs:
+            raise rasterio.errors.RasterioIOError(f"{url} not found")
+        return rasterio.open(cogs[url], *args, **kwargs)
+
+    return _open
+
+
+@mock_s3
+def test_timelapse_date(app, cog):
+    _setup_s3()
+    with patch("covid_api.db.handles.rasterio") as rio:
+        rio.open = cog
+
+        response = app.post(
+            "/v1/timelapse",
+            json={"date": "2020_01_02", "datasetId": "co2", "geojson": GEOJSON},
+        )
+        assert response.status_code == 200
+        assert response.json() == {"mean": 2, "median": 2, "resolution": 0.01}
+        assert "X-Cache" not in response.headers
+
+        response = app.post(
+            "/v1/timelapse",
+            json={"date": "2020_01_02", "datasetId": "co2", "geojson": GEOJSON},
+        )
+        assert response.status_code == 200
+        assert response.json() == {"mean": 2, "median": 2, "resolution": 0.01}
+        assert response.headers["X-Cache"] == "HIT"
+
+        response = app.post(
+            "/v1/timelapse",
+            json={
+                "date": "2020_01_02",
+                "datasetId": "co2",
+                "geojson": GEOJSON,
+                "stats": ["p10", "std", "count"],
+            },
+        )
+        assert response.status_code == 200
+        assert "X-Cache" not in response.headers
+        body = response.json()
+        assert body["p10"] == 2
+        assert body["std"] == 0
+        # 10 x 10 pixels, with partial coverage on the edges
+        assert 100 <= body["count"] <= 121
+        assert "histogram" not in body
+
+        response = app.post(
+            "/v1/timelapse",
+            json={"date": "2020_01_05", "datasetId": "co2", "geojson": GEOJSON},
+        )
+        assert response.status_code == 400
+
+
+@mock_s3
+def test_timelapse_date_range(app, cog):
+    from covid_api.api import utils
+
+    _setup_s3()
+    geojson = json.loads(json.dumps(GEOJSON))
+    # same polygon, drawn from another vertex
+    geojson["geometry"]["coordinates"][0] = [
+        [-76.95, 38.85],
+        [-76.95, 38.95],
+        [-77.05, 38.95],
+        [-77.05, 38.85],
+        [-76.95, 38.85],
+    ]
+    with patch("covid_api.db.handles.rasterio") as rio:
+        rio.open = cog
+
+        response = app.post(
+            "/v1/timelapse",
+            json={"date": "2020_01_01", "datasetId": "co2", "geojson": geojson},
+        )
+        assert response.status_code == 200
+
+        with patch(
+            "covid_api.api.utils.get_zonal_stat", wraps=utils.get_zonal_stat
+        ) as get_zonal_stat:
+            response = app.post(
+                "/v1/timelapse",
+                json={
+                    "dateRange": ["2020_01_01", "2020_01_04"],
+                    "datasetId": "co2",
+                    "geojson": GEOJSON,
+                },
+            )
+            # 2020_01_01 is cached
+            assert get_zonal_stat.call_count == 3
+
+    assert response.status_code == 200
+    body = response.json()
+    assert [s["date"] for s in body] == [
+        "2020_01_01",
+        "2020_01_02",
+        "2020_01_03",
+        "2020_01_04",
+    ]
+    assert body[0] == {"date": "2020_01_01", "mean": 1, "median": 1, "resolution": 0.01}
+    assert body[2] == {"date": "2020_01_03", "mean": 3, "median": 3, "resolution": 0.01}
+    assert body[3]["error"]
+
+
+@mock_s3
+def test_timelapse_date_range_ndjson(app, cog):
+    _setup_s3()
+    with patch("covid_api.db.handles.rasterio") as rio:
+        rio.open = cog
+
+        response = app.post(
+            "/v1/timelapse",
+            json={
+                "dateRange": ["2020_01_01", "2020_01_03"],
+                "datasetId": "co2",
+                "geojson": GEOJSON,
+            },
+            headers={"Accept": "application/x-ndjson"},
+        )
+
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    body = [json.loads(line) for line in response.text.splitlines()]
+    assert sorted(body, key=lambda s: s["date"]) == [
+        {"date": "2020_01_01", "mean": 1, "median": 1, "resolution": 0.01},
+        {"date": "2020_01_02", "mean": 2, "median": 2, "resolution": 0.01},
+        {"date": "2020_01_03", "mean": 3, "median": 3, "resolution": 0.01},
+    ]
+
+
+@mock_s3
+def test_timelapse_pool_full(app):
+    from covid_api.errors import WorkerPoolFull
+
+    _setup_s3()
+    with patch(
+        "covid_api.api.api_v1.endpoints.timelapse.timelapse_pool.map_as_completed",
+        side_effect=WorkerPoolFull("full"),
+    ):
+        response = app.post(
+            "/v1/timelapse",
+            json={
+                "dateRange": ["2020_01_01", "2020_01_03"],
+                "datasetId": "co2",
+                "geojson": GEOJSON,
+            },
+        )
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+
+
+@mock_s3
+def test_timelapse_batch(app, cog):
+    from covid_api.api import utils
+
+    _setup_s3()
+    other = json.loads(json.dumps(GEOJSON))
+    other["id"] = "other"
+    other["geometry"]["coordinates"][0] = [
+        [-77.2, 38.85],
+        [-77.1, 38.85],
+        [-77.1, 38.95],
+        [-77.2, 38.95],
+        [-77.2, 38.85],
+    ]
+    collection = {"type": "FeatureCollection", "features": [GEOJSON, other]}
+    with patch("covid_api.db.handles.rasterio") as rio:
+        rio.open = cog
+
+        # cached by the single feature endpoint
+        response = app.post(
+            "/v1/timelapse",
+            json={"date": "2020_01_01", "datasetId": "co2", "geojson": GEOJSON},
+        )
+        assert response.status_code == 200
+
+        with patch(
+            "covid_api.api.utils.get_zonal_stats", wraps=utils.get_zonal_stats
+        ) as get_zonal_stats:
+            response = app.post(
+                "/v1/timelapse/batch",
+                json={
+                    "dateRange": ["2020_01_01", "2020_01_04"],
+                    "datasetId": "co2",
+                    "geojson": collection,
+                },
+            )
+            # the dates are computed concurrently: key the calls by date
+            geometries = {
+                args[1].split(".")[-2]: len(args[0])
+                for args, _ in get_zonal_stats.call_args_list
+            }
+            # only "other" isn't cached for 2020_01_01
+            assert geometries == {
+                "2020_01_01": 1,
+                "2020_01_02": 2,
+                "2020_01_03": 2,
+                "2020_01_04": 2,
+            }
+
+        assert response.status_code == 200
+        # key the values by feature id and date
+        values = {
+            feature_id: {value.pop("date"): value for value in feature_values}
+            for feature_id, feature_values in response.json().items()
+        }
+        assert sorted(values) == ["0", "other"]
+        assert values["0"]["2020_01_01"] == {
+            "mean": 1,
+            "median": 1,
+            "resolution": 0.01,
+        }
+        assert values["other"]["2020_01_03"] == {
+            "mean": 3,
+            "median": 3,
+            "resolution": 0.01,
+        }
+        assert values["other"]["2020_01_04"]["error"]
+
+        response = app.post(
+            "/v1/timelapse/batch",
+            json={"date": "2020_01_02", "datasetId": "co2", "geojson": collection},
+        )
+        assert response.status_code == 200
+        assert response.headers["X-Cache"] == "HIT"
+        assert response.json() == {
+            "0": {"mean": 2, "median": 2, "resolution": 0.01},
+            "other": {"mean": 2, "median": 2, "resolution": 0.01},
+        }
+
+
+@mock_s3
+def test_timelapse_max_pixels(app):
+    """Only large AOIs queried with a date range should read the COG overviews."""
+    from covid_api.core.config import ZONAL_STATS_MAX_PIXELS
+
+    _setup_s3()
+    large = json.loads(json.dumps(GEOJSON))
+    large["geometry"]["coordinates"][0] = [
+        [-80, 30],
+        [-70, 30],
+        [-70, 40],
+        [-80, 40],
+        [-80, 30],
+    ]
+    stats = {"mean": 1, "median": 1, "resolution": 0.01}
+    with patch("covid_api.api.utils.get_zonal_stat", return_value=stats) as get:
+        for query, max_pixels in [
+            ({"date": "2020_01_01", "geojson": large}, None),
+            ({"dateRange": ["2020_01_01", "2020_01_02"], "geojson": GEOJSON}, None),
+            (
+                {"dateRange": ["2020_01_01", "2020_01_02"], "geojson": large},
+                ZONAL_STATS_MAX_PIXELS,
+            ),
+            (
+                {
+                    "dateRange": ["2020_01_01", "2020_01_02"],
+                    "geojson": large,
+                    "fullResolution": True,
+                },
+                "invalid",
+            ),
+        ]:
+            get.reset_mock()
+            response = app.post("/v1/timelapse", json={"datasetId": "co2", **query})
+            if max_pixels == "invalid":
+                assert response.status_code == 422
+                continue
+            assert response.status_code == 200
+            assert get.call_args[1]["max_pixels"] == max_pixels
@@ -0,0 +1,68 @@
+"""Test covid_api.db.lru and covid_api.db.tiered."""
+
+import asyncio
+
+import pytest
+
+
+def test_lru_maxbytes():
+    """Values should be evicted when the cache is over its size in bytes."""
+    from covid_api.db.lru import LRUCache
+
+    cache = LRUCache(maxsize=10, maxbytes=10)
+    cache.set("a", b"1234")
+    cache.set("b", b"1234")
+    assert cache.nbytes == 8
+    cache.get("a")
+    cache.set("c", b"1234")
+    assert cache.get("b") is None
+    assert cache.get("a") == b"1234"
+    assert cache.nbytes == 8
+
+    # too large to be cached
+    cache.set("d", b"12345678901")
+    assert cache.get("d") is None
+    assert cache.nbytes == 8
+
+    cache.delete("a")
+    assert cache.nbytes == 4
+
+
+def test_lru_ttl():
+    """Expired values should be removed."""
+    from covid_api.db.lru import LRUCache
+
+    cache = LRUCache(maxsize=10, maxbytes=10, ttl=-1)
+    cache.set("a", b"1234")
+    assert cache.get("a") is None
+    assert cache.nbytes == 0
+
+
+def test_tiered_cache():
+    """Hits should be promoted to the faster tiers."""
+    from covid_api.db.lru import LocalCacheLayer
+    from covid_api.db.tiered import TieredCacheLayer
+
+    local = LocalCacheLayer(images_maxbytes=100)
+    remote = LocalCacheLayer(images_maxbytes=100)
+    cache = TieredCacheLayer([("local", local), ("remote", remote)])
+    run = asyncio.get_event_loop().run_until_complete
+
+    with pytest.raises(KeyError):
+        run(cache.get_image_from_cache("tile"))
+    assert cache.stats() == {
+        "local": {"hits": 0, "misses": 1, "errors": 0},
+        "remote": {"hits": 0, "misses": 1, "errors": 0},
+    }
+
+    remote.set_image_cache("tile", (b"png", "png"))
+    assert run(cache.get_image_from_cache("tile")) == (b"png", "png")
+    assert local.get_image_from_cache("tile") == (b"png", "png")
+    assert run(cache.get_image_from_cache("tile")) == (b"png", "png")
+    assert cache.stats() == {
+        "local": {"hits": 1, "misses": 2, "errors": 0},
+        "remote": {"hits": 1, "misses": 1, "errors": 0},
+    }
+
+    assert run(cache.set_image_cache("other", (b"jpg", "jpg")))
+    assert remote.get_image_from_cache("other") == (b"jpg", "jpg")
@@ -0,0 +1,160 @@
+"""Test covid_api.db.cog_headers."""
+
+import hashlib
+import os
+import time
+
+import boto3
+import numpy
+import rasterio
+from mock import patch
+from moto import mock_s3
+
+PREFIX = os.path.join(os.path.dirname(__file__), "fixtures")
+COG = os.path.join(PREFIX, "cog.tif")
+URL = "s3://covid-eo-data/cog.tif"
+
+
+class FakeCacheLayer(object):
+    def __init__(self):
+        self.headers = {}
+
+    def get_cog_header_from_cache(self, url_hash):
+        return self.headers.get(url_hash)
+
+    def set_cog_header_cache(self, url_hash, body, timeout=None):
+        self.headers[url_hash] = body
+        return True
+
+
+@mock_s3
+def test_cog_headers(tmp_path):
+    """COGs should be opened with the header read from the cache."""
+    from covid_api.db.cog_headers import COGHeaderCache
+    from covid_api.db.utils import s3
+
+    bucket = boto3.resource("s3").Bucket("covid-eo-data")
+    bucket.create()
+    bucket.upload_file(COG, "cog.tif")
+
+    remote = FakeCacheLayer()
+    headers = COGHeaderCache(str(tmp_path / "a"), size=16384, remote=remote)
+    assert headers.path(COG) == COG
+
+    # GDAL can't read the mocked bucket, read the rest of the COG from disk
+    with patch("covid_api.db.cog_headers._vsi_path", return_value=COG), patch.object(
+        s3, "get_object", wraps=s3.get_object
+    ) as get_object:
+        path = headers.path(URL)
+        assert path.startswith("/vsisparse/")
+        assert get_object.call_count == 1
+        assert headers.path(URL) == path
+        assert get_object.call_count == 1
+
+        # another worker
+        other = COGHeaderCache(str(tmp_path / "b"), size=16384, remote=remote)
+        assert other.path(URL).startswith("/vsisparse/")
+        assert get_object.call_count == 1
+
+    with rasterio.open(path) as cached, rasterio.open(COG) as src:
+        assert cached.profile == src.profile
+        assert numpy.array_equal(
+            cached.read(1, out_shape=(100, 100)), src.read(1, out_shape=(100, 100))
+        )
+
+    # not cached
+    headers = COGHeaderCache(str(tmp_path / "c"))
+    assert (
+        headers.path("s3://covid-eo-data/missing.tif")
+        == "s3://covid-eo-data/missing.tif"
+    )
+
+
+@mock_s3
+def test_cog_headers_replaced(tmp_path):
+    """Headers should be read again when the COG is replaced at the same url."""
+    from covid_api.db.cog_headers import COGHeaderCache
+    from covid_api.db.utils import s3
+
+    bucket = boto3.resource("s3").Bucket("covid-eo-data")
+    bucket.create()
+    bucket.upload_file(COG, "cog.tif")
+
+    remote = FakeCacheLayer()
+    headers = COGHeaderCache(str(tmp_path), size=16384, remote=remote, validate_ttl=0)
+    with patch("covid_api.db.cog_headers._vsi_path", return_value=COG), patch.object(
+        s3, "get_object", wraps=s3.get_object
+    ) as get_object, patch.object(s3, "head_object", wraps=s3.head_object) as head:
+        path = headers.path(URL)
+        assert get_object.call_count == 1
+
+        # checked, unchanged
+        assert headers.path(URL) == path
+        assert head.call_count == 2
+        assert get_object.call_count == 1
+
+        bucket.put_object(Body=b"II*\x00" + b"\x00" * 20000, Key="cog.tif")
+        assert headers.path(URL) == path
+        assert get_object.call_count == 2
+        with open(path[len("/vsisparse/") :]) as f:
+            assert "<Length>20004</Length>" in f.read()
+        assert list(remote.headers.values())[0][1] == 20004
+
+    # requests can't hang
+    headers = COGHeaderCache(str(tmp_path), timeout=2)
+    with patch("covid_api.db.cog_headers.requests") as requests:
+        requests.head.side_effect = Exception("timeout")
+        assert headers.path("https://myurl.com/cog.tif") == "https://myurl.com/cog.tif"
+        assert requests.head.call_args[1]["timeout"] == 2
+
+
+def test_cog_headers_no_range(tmp_path):
+    """COGs of servers ignoring the range shouldn't be downloaded, nor cached."""
+    from covid_api.db.cog_headers import COGHeaderCache
+
+    url = "https://myurl.com/cog.tif"
+    headers = COGHeaderCache(str(tmp_path), size=16384)
+    with patch("covid_api.db.cog_headers.requests") as requests:
+        requests.head.return_value.headers = {"Content-Length": "100000"}
+        response = requests.get.return_value.__enter__.return_value
+        response.status_code = 200
+        assert headers.path(url) == url
+        assert requests.get.call_args[1]["stream"]
+        assert not response.raw.read.called
+
+        response.status_code = 206
+        response.headers = {"Content-Range": "bytes 0-16383/100000"}
+        response.raw.read.return_value = b"\x00" * 16384
+        assert headers.path(url).startswith("/vsisparse/")
+        response.raw.read.assert_called_with(16384)
+
+
+def test_cog_headers_prune(tmp_path):
+    """The directory should keep at most `max_entries` COGs, none expired."""
+    from covid_api.db.cog_headers import COGHeaderCache
+
+    headers = COGHeaderCache(str(tmp_path), size=16384, max_entries=2)
+    with patch.object(
+        COGHeaderCache, "_stat", return_value=(100000, '"etag"')
+    ), patch.object(
+        COGHeaderCache, "_fetch", return_value=(b"\x00" * 16384, 100000, '"etag"')
+    ):
+        seen = set()
+        first = hashlib.sha224(b"s3://covid-eo-data/0.tif").hexdigest()
+        for i in range(3):
+            headers.path(f"s3://covid-eo-data/{i}.tif")
+            # oldest first, whatever the filesystem timestamps resolution
+            for name in set(os.listdir(tmp_path)) - seen:
+                mtime = time.time() - 100 + i
+                os.utime(tmp_path / name, (mtime, mtime))
+                seen.add(name)
+
+        assert len(os.listdir(tmp_path)) == 2 * 3
+        assert not any(name.startswith(first) for name in os.listdir(tmp_path))
+
+        # leftover of an interrupted write
+        (tmp_path / "leftover.bin").write_bytes(b"")
+        os.utime(tmp_path / "leftover.bin", (0, 0))
+        headers.path("s3://covid-eo-data/3.tif")
+        assert "leftover.bin" not in os.listdir(tmp_path)
+        assert len(os.listdir(tmp_path)) == 2 * 3
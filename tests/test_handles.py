@@ -0,0 +1,65 @@
+"""Test covid_api.db.handles."""
+
+import os
+import threading
+
+import rasterio
+from mock import Mock, patch
+
+PREFIX = os.path.join(os.path.dirname(__file__), "fixtures")
+COG = os.path.join(PREFIX, "cog.tif")
+
+
+def test_dataset_handles():
+    """Datasets should be reused until evicted."""
+    from covid_api.db.handles import DatasetHandles
+
+    handles = DatasetHandles(maxsize=1, ttl=60)
+    with patch("covid_api.db.handles.rasterio.open", wraps=rasterio.open) as rio:
+        with handles.open(COG) as first:
+            # nested call: another dataset, not cached
+            with handles.open(COG) as nested:
+                assert nested is not first
+            assert nested.closed
+            assert not first.closed
+
+        with handles.open(COG) as src:
+            assert src is first
+        assert rio.call_count == 2
+
+        # different options, the least recently used dataset is closed
+        with handles.open(COG, overview_level=0) as overview:
+            assert overview is not first
+        assert first.closed
+        assert len(handles) == 1
+
+        # in another thread
+        def _open():
+            with handles.open(COG, overview_level=0) as src:
+                assert src is not overview
+
+        thread = threading.Thread(target=_open)
+        thread.start()
+        thread.join()
+        assert rio.call_count == 4
+
+    handles.clear()
+    assert overview.closed
+
+
+def test_dataset_handles_expired():
+    """Expired datasets should be opened again, and closed once released."""
+    from covid_api.db.handles import DatasetHandles
+
+    handles = DatasetHandles(maxsize=4, ttl=-1)
+    rio = Mock(wraps=rasterio.open)
+    with patch("covid_api.db.handles.rasterio.open", rio):
+        with handles.open(COG) as first:
+            pass
+        with handles.open(COG) as second:
+            assert first.closed
+            # not closed while in use
+            handles.clear()
+            assert not second.closed
+        assert second.closed
+    assert rio.call_count == 2
@@ -1,5 +1,7 @@
 """Test covid_api.main.app."""
 
+import pytest
+
 
 def test_health(app):
     """Test /ping endpoint."""
@@ -13,9 +15,34 @@ def test_index(app):
     response = app.get("/")
     assert response.status_code == 200
     assert response.headers["content-type"] == "text/html; charset=utf-8"
-    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["content-encoding"] in ("gzip", "br")
 
     response = app.get("/index.html")
     assert response.status_code == 200
     assert response.headers["content-type"] == "text/html; charset=utf-8"
+    assert response.headers["content-encoding"] in ("gzip", "br")
+
+
+def test_compression(app):
+    """Only large and compressible responses should be compressed."""
+    response = app.get("/api/v1/openapi.json", headers={"Accept-Encoding": "gzip"})
     assert response.headers["content-encoding"] == "gzip"
+    assert "Compress (gzip 6)" in response.headers["X-Server-Timings"]
+    assert response.json()["paths"]
+
+    # too small
+    response = app.get("/ping", headers={"Accept-Encoding": "gzip"})
+    assert "content-encoding" not in response.headers
+
+    response = app.get("/api/v1/openapi.json", headers={"Accept-Encoding": "gzip;q=0"})
+    assert "content-encoding" not in response.headers
+
+
+def test_compression_brotli(app):
+    """Brotli should be preferred when accepted."""
+    pytest.importorskip("brotli")
+
+    response = app.get("/api/v1/openapi.json", headers={"Accept-Encoding": "gzip, br"})
+    assert response.headers["content-encoding"] == "br"
+    assert "Compress (br 4)" in response.headers["X-Server-Timings"]
+    assert response.json()["paths"]
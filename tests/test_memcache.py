@@ -0,0 +1,124 @@
+"""Test covid_api.db.memcache."""
+
+import socket
+import time
+
+import pytest
+
+
+class FakeServer(object):
+    def __init__(self, connection=None):
+        self.connection = connection
+
+
+class FakeClient(object):
+    """bmemcached client holding one connection."""
+
+    def __init__(self):
+        self.connection, self.peer = socket.socketpair()
+        self.servers = [FakeServer(self.connection)]
+        self.disconnects = 0
+
+    def disconnect_all(self):
+        self.disconnects += 1
+        self.servers[0].connection = None
+
+
+def test_pool_reuse():
+    """Clients should be kept open between calls."""
+    from covid_api.db.memcache import ClientPool
+
+    clients = []
+
+    def _factory():
+        clients.append(FakeClient())
+        return clients[-1]
+
+    pool = ClientPool(_factory, maxsize=1)
+    with pool.reserve() as first:
+        # all the clients are in use
+        with pool.reserve() as second:
+            assert first is not second
+
+    # only `maxsize` clients are kept
+    assert len(clients) == 2
+    assert first.disconnects == 1
+
+    with pool.reserve() as client:
+        assert client is second
+        assert client.disconnects == 0
+
+    pool.close()
+    assert second.disconnects == 1
+
+
+def test_pool_stale():
+    """Connections closed by the server should be reopened."""
+    from covid_api.db.memcache import ClientPool
+
+    pool = ClientPool(FakeClient, maxsize=1)
+    with pool.reserve() as client:
+        pass
+
+    client.peer.close()
+    with pool.reserve() as same:
+        assert same is client
+        assert client.disconnects == 1
+
+
+def test_pool_idle():
+    """Connections unused for too long should be reopened."""
+    from covid_api.db.memcache import ClientPool
+
+    pool = ClientPool(FakeClient, maxsize=1, max_idle=0.01)
+    with pool.reserve() as client:
+        pass
+
+    time.sleep(0.02)
+    with pool.reserve():
+        assert client.disconnects == 1
+
+
+def test_pool_error():
+    """Connections should be reopened after a failure."""
+    from covid_api.db.memcache import ClientPool
+
+    pool = ClientPool(FakeClient, maxsize=1)
+    with pytest.raises(socket.timeout):
+        with pool.reserve() as client:
+            raise socket.timeout("timed out")
+    assert client.disconnects == 1
+
+    # errors unrelated to the connection
+    with pytest.raises(TypeError):
+        with pool.reserve() as client:
+            raise TypeError("cannot unpack non-iterable NoneType object")
+    assert client.disconnects == 1
+
+
+def test_cache_layer_async():
+    """Async methods should run the memcached calls out of the event loop."""
+    import asyncio
+    import threading
+    from unittest.mock import patch
+
+    from covid_api.db.memcache import CacheLayer
+
+    threads = []
+
+    class Client(FakeClient):
+        def __init__(self, *args):
+            super().__init__()
+
+        def get(self, key):
+            threads.append(threading.current_thread())
+            return b"png", "png"
+
+    with patch("covid_api.db.memcache.Client", Client):
+        cache = CacheLayer("localhost")
+
+    body = asyncio.get_event_loop().run_until_complete(
+        cache.get_image_from_cache_async("tile")
+    )
+    assert body == (b"png", "png")
+    assert threads[0] is not threading.main_thread()
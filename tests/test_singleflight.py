@@ -0,0 +1,176 @@
+"""Test covid_api.core.singleflight and tile render coalescing."""
+
+import asyncio
+
+import pytest
+
+
+def test_singleflight():
+    """Concurrent calls with the same key should share one call."""
+    from covid_api.core.singleflight import SingleFlight
+
+    flights = SingleFlight()
+    calls = []
+
+    async def _fn():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "tile"
+
+    async def _main():
+        return await asyncio.gather(*[flights.do("key", _fn) for _ in range(5)])
+
+    results = asyncio.get_event_loop().run_until_complete(_main())
+    assert len(calls) == 1
+    assert [r for r, _ in results] == ["tile"] * 5
+    assert [shared for _, shared in results].count(False) == 1
+    assert len(flights) == 0
+
+
+def test_singleflight_error():
+    """Errors should be raised to every caller."""
+    from covid_api.core.singleflight import SingleFlight
+
+    flights = SingleFlight()
+
+    async def _fn():
+        await asyncio.sleep(0.01)
+        raise ValueError("no tile")
+
+    async def _main():
+        return await asyncio.gather(
+            *[flights.do("key", _fn) for _ in range(3)], return_exceptions=True
+        )
+
+    results = asyncio.get_event_loop().run_until_complete(_main())
+    assert all(isinstance(r, ValueError) for r in results)
+    assert len(flights) == 0
+
+
+def test_singleflight_cancelled():
+    """Waiting callers should run the call again when its caller is cancelled."""
+    from covid_api.core.singleflight import SingleFlight
+
+    flights = SingleFlight()
+    calls = []
+
+    async def _fn():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "tile"
+
+    async def _main():
+        leader = asyncio.ensure_future(flights.do("key", _fn))
+        await asyncio.sleep(0)
+        followers = [asyncio.ensure_future(flights.do("key", _fn)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await asyncio.gather(*followers)
+
+    results = asyncio.get_event_loop().run_until_complete(_main())
+    assert [r for r, _ in results] == ["tile"] * 2
+    assert [shared for _, shared in results].count(False) == 1
+    assert len(calls) == 2
+    assert len(flights) == 0
+
+
+class LockedCache(object):
+    """Cache layer whose lock is held by another worker."""
+
+    def __init__(self):
+        self.images = {}
+        self.gets = 0
+
+    async def acquire_lock(self, key, timeout=10):
+        return False
+
+    async def release_lock(self, key):
+        raise AssertionError("lock not held")
+
+    async def get_image_from_cache(self, img_hash):
+        self.gets += 1
+        if self.gets == 3:
+            # the other worker is done
+            self.images[img_hash] = (b"png", "png")
+        return self.images[img_hash]
+
+    async def set_image_cache(self, img_hash, body, timeout=None):
+        self.images[img_hash] = body
+        return True
+
+
+def test_get_or_render_image():
+    """Images should be rendered once and cached."""
+    from covid_api.api import utils
+    from covid_api.db.lru import LocalCacheLayer
+    from covid_api.db.tiered import TieredCacheLayer
+
+    cache = TieredCacheLayer([("local", LocalCacheLayer(images_maxbytes=100))])
+    calls = []
+
+    async def _render():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return b"jpg", "jpg"
+
+    async def _main():
+        return await asyncio.gather(
+            *[utils.get_or_render_image(cache, "tile", _render) for _ in range(3)]
+        )
+
+    assert asyncio.get_event_loop().run_until_complete(_main()) == [(b"jpg", "jpg")] * 3
+    assert len(calls) == 1
+    assert asyncio.get_event_loop().run_until_complete(
+        cache.get_image_from_cache("tile")
+    ) == (b"jpg", "jpg")
+
+
+def test_get_or_render_image_background():
+    """Images should be put in the cache by a background task."""
+    from covid_api.api import utils
+    from covid_api.db.lru import LocalCacheLayer
+    from covid_api.db.tiered import TieredCacheLayer
+
+    from starlette.background import BackgroundTasks
+
+    local = LocalCacheLayer(images_maxbytes=100)
+    cache = TieredCacheLayer([("local", local)])
+    background_tasks = BackgroundTasks()
+
+    async def _render():
+        return b"jpg", "jpg"
+
+    run = asyncio.get_event_loop().run_until_complete
+    assert run(utils.get_or_render_image(cache, "tile", _render, background_tasks)) == (
+        b"jpg",
+        "jpg",
+    )
+    assert local.images.get("tile") is None
+
+    run(background_tasks())
+    assert local.images.get("tile") == (b"jpg", "jpg")
+
+
+def test_get_or_render_image_locked(monkeypatch):
+    """Images rendered by another worker should be read from the cache."""
+    from covid_api.api import utils
+
+    cache = LockedCache()
+
+    async def _render():
+        raise AssertionError("rendered twice")
+
+    body = asyncio.get_event_loop().run_until_complete(
+        utils.get_or_render_image(cache, "tile", _render, poll_interval=0.001)
+    )
+    assert body == (b"png", "png")
+    assert cache.gets == 3
+
+    # the lock expired without the image showing up in the cache
+    monkeypatch.setattr(utils, "TILE_LOCK_TIMEOUT", 0.01)
+    with pytest.raises(AssertionError, match="rendered twice"):
+        asyncio.get_event_loop().run_until_complete(
+            utils.get_or_render_image(cache, "other", _render, poll_interval=0.001)
+        )
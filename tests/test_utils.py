@@ -0,0 +1,312 @@
+"""Test covid_api.api.utils."""
+
+import os
+import threading
+from unittest.mock import patch
+
+import numpy
+import pytest
+import rasterio
+import rasterio.warp
+from affine import Affine
+from rasterstats.io import bounds_window
+from shapely.geometry import Point, Polygon, mapping, shape
+
+PREFIX = os.path.join(os.path.dirname(__file__), "fixtures")
+
+
+def test_rasterize_pctcover():
+    """Vectorized coverage should match the shapely implementation."""
+    from covid_api.api import utils
+
+    atrans = Affine(0.1, 0, 10.0, 0, -0.1, 50.0)
+    shape = (45, 40)
+    grid = Polygon([(10, 50), (14, 50), (14, 45.5), (10, 45.5)])
+
+    for geom in [
+        Point(12.03, 48.51).buffer(1.23),
+        Polygon([(10.05, 49.97), (13.3, 49.1), (11.2, 46.33)]),
+        # partially outside of the grid
+        Point(13.9, 45.6).buffer(0.7),
+    ]:
+        pctcover = utils.rasterize_pctcover(geom, atrans=atrans, shape=shape)
+        expected = utils._rasterize_pctcover_shapely(geom, atrans=atrans, shape=shape)
+        assert pctcover.shape == shape
+        numpy.testing.assert_allclose(pctcover, expected, atol=1e-9)
+        assert abs(pctcover.sum() * 0.01 - geom.intersection(grid).area) < 1e-9
+
+    # interior rings are removed from the coverage
+    geom = Point(12.5, 48).buffer(1.5).difference(Point(12.4, 48.1).buffer(0.5))
+    pctcover = utils.rasterize_pctcover(geom, atrans=atrans, shape=shape)
+    assert abs(pctcover.sum() * 0.01 - geom.area) < 1e-9
+    assert pctcover[19, 24] == 0
+
+
+def test_get_pctcover():
+    """Coverages should be cached by size, and computed in parallel."""
+    from covid_api.api import utils
+
+    atrans = Affine(0.1, 0, 10, 0, -0.1, 50)
+    geom, other = Point(12.5, 48).buffer(1.5), Point(12, 48).buffer(1)
+    started, release = threading.Event(), threading.Event()
+    rasterize_pctcover = utils.rasterize_pctcover
+
+    def _rasterize(geom, atrans, shape):
+        if geom.equals(other):
+            started.set()
+            release.wait(5)
+        return rasterize_pctcover(geom, atrans=atrans, shape=shape)
+
+    cache = utils.LRUCache(100, maxbytes=40000, sizeof=lambda a: a.nbytes)
+    with patch.object(utils, "_pctcovers", cache), patch(
+        "covid_api.api.utils.rasterize_pctcover", side_effect=_rasterize
+    ) as rasterize:
+        thread = threading.Thread(
+            target=utils.get_pctcover, args=(other, atrans, (40, 50))
+        )
+        thread.start()
+        assert started.wait(5)
+        # not blocked by the other geometry
+        pctcover = utils.get_pctcover(geom, atrans, (40, 50))
+        assert utils.get_pctcover(geom, atrans, (40, 50)) is pctcover
+        assert not pctcover.flags.writeable
+        release.set()
+        thread.join()
+        assert rasterize.call_count == 2
+
+        # 16000 + 16000 + 8000 + 4000 bytes: the least recently used is evicted
+        utils.get_pctcover(other, atrans, (20, 50))
+        utils.get_pctcover(other, atrans, (10, 50))
+        assert utils._pctcovers.nbytes <= 40000
+        assert rasterize.call_count == 4
+        utils.get_pctcover(other, atrans, (40, 50))
+        assert rasterize.call_count == 4
+        assert utils.get_pctcover(geom, atrans, (40, 50)) is not pctcover
+        assert rasterize.call_count == 5
+        assert not utils._pctcover_locks
+
+
+def test_get_zonal_stat():
+    """Zonal mean should be weighted by the exact coverage."""
+    from covid_api.api import utils
+    from covid_api.models.timelapse import Feature
+
+    cog = os.path.join(PREFIX, "cog.tif")
+    feature = Feature(
+        type="Feature",
+        geometry=mapping(Point(500000, 8150000).buffer(20000)),
+        properties={},
+    )
+    with rasterio.open(cog) as src:
+        geom = shape(feature.geometry.dict())
+        window = bounds_window(geom.bounds, src.transform)
+        data = src.read(window=window, masked=True)
+        weights = utils._rasterize_pctcover_shapely(
+            geom, atrans=src.window_transform(window), shape=data.shape[1:]
+        )
+        expected = numpy.ma.average(data[0], weights=weights)
+
+    stats = utils.get_zonal_stat(feature, cog)
+    assert abs(stats["mean"] - expected) < 1e-9 * expected
+    assert stats["median"] == numpy.ma.median(data[0])
+    assert stats["resolution"] == src.res[0]
+
+    stats = utils.get_zonal_stat(
+        feature, cog, stats=["p10", "p90", "std", "count", "histogram"]
+    )
+    values = data[0].compressed()
+    valid_weights = weights[~numpy.ma.getmaskarray(data[0])]
+    assert stats["p10"] == pytest.approx(numpy.percentile(values, 10))
+    assert stats["p90"] == pytest.approx(numpy.percentile(values, 90))
+    std = numpy.sqrt(numpy.cov(values, aweights=valid_weights, bias=True))
+    assert stats["std"] == pytest.approx(std)
+    assert stats["count"] == numpy.count_nonzero(valid_weights)
+    counts, edges = stats["histogram"]
+    assert len(counts) == 20
+    assert sum(counts) == pytest.approx(valid_weights.sum())
+    assert edges[0] == values.min()
+    assert edges[-1] == values.max()
+
+
+def test_get_zonal_stat_overview():
+    """Large AOIs should be read from the overviews."""
+    from covid_api.api import utils
+    from covid_api.models.timelapse import Feature
+
+    cog = os.path.join(PREFIX, "cog.tif")
+    feature = Feature(
+        type="Feature",
+        geometry=mapping(Point(500000, 8150000).buffer(20000)),
+        properties={},
+    )
+    with rasterio.open(cog) as src:
+        # 400 x 400 pixels at full resolution
+        full_resolution = src.res[0]
+        overviews = src.overviews(1)
+
+    stats = utils.get_zonal_stat(feature, cog, max_pixels=200000)
+    assert stats["resolution"] == full_resolution
+
+    stats = utils.get_zonal_stat(feature, cog, max_pixels=30000)
+    assert stats["resolution"] == pytest.approx(
+        full_resolution * overviews[1], rel=1e-2
+    )
+
+    expected = utils.get_zonal_stat(feature, cog)
+    assert stats["mean"] == pytest.approx(expected["mean"], rel=1e-2)
+
+    # smallest overview
+    stats = utils.get_zonal_stat(feature, cog, max_pixels=1)
+    assert stats["resolution"] == pytest.approx(
+        full_resolution * overviews[-1], rel=1e-2
+    )
+
+
+def test_get_pctcover_cached():
+    """Coverage weights should be computed once per geometry and grid."""
+    from covid_api.api import utils
+    from covid_api.models.timelapse import Feature
+
+    cog = os.path.join(PREFIX, "cog.tif")
+    feature = Feature(
+        type="Feature",
+        geometry=mapping(Point(450000, 8200000).buffer(10000)),
+        properties={},
+    )
+    with patch(
+        "covid_api.api.utils.rasterize_pctcover", wraps=utils.rasterize_pctcover
+    ) as rasterize:
+        first = utils.get_zonal_stat(feature, cog)
+        second = utils.get_zonal_stat(feature, cog)
+        assert first == second
+        assert rasterize.call_count == 1
+
+    geom = shape(feature.geometry.dict())
+    with rasterio.open(cog) as src:
+        window = bounds_window(geom.bounds, src.transform)
+        pctcover = utils.get_pctcover(
+            geom, atrans=src.window_transform(window), shape=(200, 200)
+        )
+    assert not pctcover.flags.writeable
+
+
+def test_get_zonal_stats():
+    """Batch zonal statistics should match the ones of each geometry."""
+    from covid_api.api import utils
+    from covid_api.models.timelapse import Feature
+
+    cog = os.path.join(PREFIX, "cog.tif")
+    features = [
+        Feature(type="Feature", geometry=mapping(geom), properties={})
+        for geom in [
+            Point(500000, 8150000).buffer(20000),
+            Point(530000, 8170000).buffer(5000),
+            Polygon([(480000, 8140000), (520000, 8130000), (505000, 8180000)]),
+        ]
+    ]
+    stats = utils.get_zonal_stats(
+        [shape(feature.geometry.dict()) for feature in features], cog
+    )
+    assert stats == [utils.get_zonal_stat(feature, cog) for feature in features]
+
+
+def test_get_point_value():
+    """Point values should be read from the cached COG blocks."""
+    from covid_api.api import utils
+
+    cog = os.path.join(PREFIX, "cog.tif")
+    with rasterio.open(cog) as src:
+        lon, lat = rasterio.warp.transform(src.crs, "epsg:4326", [500000], [8150000])
+        expected = next(src.sample([(500000, 8150000)]))[0]
+
+    utils._point_blocks.clear()
+    utils._point_metadata.clear()
+    with patch("covid_api.db.handles.rasterio.open", wraps=rasterio.open) as rio_open:
+        assert utils.get_point_value(lon[0], lat[0], cog) == expected
+        assert utils.get_point_value(lon[0] + 0.001, lat[0], cog) is not None
+        assert rio_open.call_count == 1
+
+
+def test_colormap_lut():
+    """Colormap lookup tables should be built once and match rio-tiler's."""
+    from rio_tiler.colormap import apply_cmap, cmap
+
+    from covid_api.api import utils
+
+    lut = utils.get_colormap_lut("viridis")
+    assert lut.shape == (256, 4)
+    assert lut.dtype == numpy.uint8
+    assert utils.get_colormap_lut("viridis") is lut
+
+    tile = numpy.arange(256, dtype="uint8").reshape(1, 16, 16)
+    mask = numpy.full((16, 16), 255, dtype="uint8")
+    mask[0] = 0
+    data, alpha = utils.apply_colormap_lut(tile, mask, lut)
+    expected_data, expected_alpha = apply_cmap(tile, cmap.get("viridis"))
+    numpy.testing.assert_array_equal(data, expected_data)
+    assert not alpha[0].any()
+    assert (alpha[1:] == 255).all()
+
+    # values missing from custom colormaps are transparent
+    lut = utils.get_colormap_lut("custom_cropmonitor")
+    tile = numpy.array([[[1, 16]]], dtype="uint8")
+    data, alpha = utils.apply_colormap_lut(tile, None, lut)
+    assert data[:, 0, 0].tolist() == [120, 120, 120]
+    assert alpha.tolist() == [[255, 0]]
+
+
+@pytest.mark.parametrize("dtype", ["uint8", "int16", "uint16", "float32"])
+def test_rescale_colormap(dtype):
+    """The fused rescale/colormap should match postprocess and the colormap."""
+    from covid_api.api import utils
+
+    rng = numpy.random.RandomState(0)
+    tile = rng.randint(-100 if dtype == "int16" else 0, 250, (1, 64, 64))
+    tile = tile.astype(dtype)
+    if dtype == "float32":
+        tile += rng.random_sample(tile.shape).astype(dtype)
+    mask = numpy.full((64, 64), 255, dtype="uint8")
+    mask[:8] = 0
+    lut = utils.get_colormap_lut("viridis")
+
+    expected = utils.postprocess(tile.copy(), mask, rescale="-50,200.5")
+    expected_data, expected_alpha = utils.apply_colormap_lut(expected, mask, lut)
+    data, alpha = utils.rescale_colormap(tile, mask, (-50, 200.5), lut)
+    numpy.testing.assert_array_equal(data, expected_data)
+    numpy.testing.assert_array_equal(alpha, expected_alpha)
+
+
+def test_render_indexed_png():
+    """Colormapped tiles should be encoded as palette PNGs with transparency."""
+    from rasterio.io import MemoryFile
+
+    from covid_api.api import utils
+
+    lut = utils.get_colormap_lut("viridis")
+    index = numpy.arange(64, dtype="uint8").reshape(8, 8)
+    mask = numpy.full((8, 8), 255, dtype="uint8")
+    mask[0] = 0
+
+    content = utils.render_indexed_png(index, mask, lut)
+    assert b"PLTE" in content and b"tRNS" in content
+    with MemoryFile(content) as mem:
+        with mem.open() as src:
+            assert src.count == 1
+            decoded = src.read(1)
+            palette = src.colormap(1)
+
+    rgba = numpy.array([palette[i] for i in range(256)], dtype="uint8")[decoded]
+    expected_data, expected_alpha = utils.apply_colormap_lut(index[None], mask, lut)
+    numpy.testing.assert_array_equal(rgba[..., 3], expected_alpha)
+    numpy.testing.assert_array_equal(
+        rgba[1:, :, :3], expected_data.transpose(1, 2, 0)[1:]
+    )
+
+    # no palette entry left for the masked pixels
+    index = numpy.arange(256, dtype="uint8").reshape(16, 16)
+    mask = numpy.full((16, 16), 255, dtype="uint8")
+    assert utils.render_indexed_png(index, mask, lut)
+    index = numpy.arange(256, dtype="uint8").repeat(2).reshape(16, 32)
+    mask = numpy.full((16, 32), 255, dtype="uint8")
+    mask[0, 0] = 0
+    assert utils.render_indexed_png(index, mask, lut) is None
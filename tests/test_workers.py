@@ -0,0 +1,98 @@
+"""Test covid_api.core.workers."""
+
+import asyncio
+import threading
+import time
+from unittest.mock import patch
+
+import numpy
+import pytest
+
+from covid_api.core.workers import WorkerPool
+from covid_api.errors import WorkerPoolFull
+
+
+def test_map_as_completed():
+    """Items should run at most `max_concurrency` at a time."""
+    pool = WorkerPool(max_workers=4, max_queue=4)
+    lock = threading.Lock()
+    running = []
+    peak = []
+
+    def _work(item):
+        with lock:
+            running.append(item)
+            peak.append(len(running))
+        time.sleep(0.01)
+        with lock:
+            running.remove(item)
+        return item * 2
+
+    results = dict(
+        (item, future.result())
+        for item, future in pool.map_as_completed(_work, range(10), max_concurrency=2)
+    )
+    assert results == {i: i * 2 for i in range(10)}
+    assert max(peak) <= 2
+
+    stats = pool.stats()
+    assert stats["completed"] == 10
+    assert stats["reserved"] == 0
+    assert stats["running"] == 0
+    assert stats["queued"] == 0
+
+
+def test_map_as_completed_full():
+    """Calls should be rejected when all the slots are reserved."""
+    pool = WorkerPool(max_workers=1, max_queue=1)
+    started = threading.Event()
+    event = threading.Event()
+
+    def _work(item):
+        started.set()
+        event.wait(5)
+        return item
+
+    results = []
+    consumer = threading.Thread(
+        target=lambda: results.extend(
+            pool.map_as_completed(_work, range(5), max_concurrency=2)
+        )
+    )
+    consumer.start()
+    started.wait(5)
+    assert pool.stats()["reserved"] == 2
+    assert pool.stats()["running"] == 1
+
+    with pytest.raises(WorkerPoolFull):
+        list(pool.map_as_completed(lambda i: i, [1], max_concurrency=2))
+
+    event.set()
+    consumer.join(5)
+    assert len(results) == 5
+    assert pool.stats()["rejected"] == 1
+    assert pool.stats()["reserved"] == 0
+
+
+def test_render_pool():
+    """Arrays should be passed to the pool processes through shared memory."""
+    from covid_api.core.workers import RenderPool
+
+    pool = RenderPool(max_workers=1, min_tilesize=512)
+    assert not pool.accepts(256)
+    assert pool.accepts(512)
+    assert not RenderPool(max_workers=0).accepts(512)
+    # no shared memory before Python 3.8
+    with patch("covid_api.core.workers._shared_memory", return_value=None):
+        assert not pool.accepts(512)
+
+    a = numpy.arange(12, dtype="uint16").reshape(3, 4)
+    b = numpy.ones((3, 4), dtype="float32")
+    try:
+        result = asyncio.get_event_loop().run_until_complete(pool.run(numpy.add, a, b))
+        numpy.testing.assert_array_equal(result, a + b)
+
+        with pytest.raises(ValueError):
+            asyncio.get_event_loop().run_until_complete(pool.run(numpy.dot, a, b))
+    finally:
+        pool.shutdown()
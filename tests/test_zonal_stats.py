@@ -0,0 +1,241 @@
+"""Test covid_api.db.zonal_stats."""
+
+import json
+from unittest.mock import patch
+
+import boto3
+import numpy
+import pytest
+import rasterio
+from moto import mock_s3
+from rasterio.transform import from_origin
+
+from covid_api.core.config import (
+    DATASET_METADATA_FILENAME,
+    INDICATOR_BUCKET,
+    ZONAL_STATS_STORE_FILENAME,
+)
+
+
+@pytest.fixture
+def cog(tmp_path):
+    """Create global EPSG:4326 rasters, with a different value for each date."""
+    cogs = {}
+    for day in range(1, 3):
+        path = str(tmp_path / f"xco2_16day_mean.2020_01_0{day}.tif")
+        with rasterio.open(
+            path,
+            "w",
+            driver="GTiff",
+            dtype="float32",
+            count=1,
+            width=360,
+            height=180,
+            crs="epsg:4326",
+            transform=from_origin(-180, 90, 1, 1),
+        ) as dst:
+            dst.write(numpy.full((1, 180, 360), day, dtype="float32"))
+        cogs[f"s3://covid-eo-data/xco2-mean/xco2_16day_mean.2020_01_0{day}.tif"] = path
+
+    def _open(url, *args, **kwargs):
+        if url not in cogs:
+            raise rasterio.errors.RasterioIOError(f"{url}: No such file or directory")
+        return rasterio.open(cogs[url], *args, **kwargs)
+
+    return _open
+
+
+@pytest.fixture
+def store():
+    """Reload the store on next access."""
+    from covid_api.db.zonal_stats import store
+
+    store._expires = 0
+    yield store
+    store._expires = 0
+
+
+@mock_s3
+def _setup_s3():
+    from covid_api.db.static.sites import sites
+
+    s3 = boto3.resource("s3")
+    bucket = s3.Bucket(INDICATOR_BUCKET)
+    bucket.create()
+    domain = {"co2": {"domain": ["2020-01-01T00:00:00Z", "2020-01-03T00:00:00Z"]}}
+    metadata = {"_all": domain, "global": domain}
+    metadata.update({site_id: {} for site_id in sites.list()})
+    bucket.put_object(Body=json.dumps(metadata), Key=DATASET_METADATA_FILENAME)
+    return bucket
+
+
+def test_dumps_loads():
+    """Rows should be stored as columns."""
+    from covid_api.db import zonal_stats
+
+    rows = [
+        dict(geometry="a", url="s3://a.tif", mean=1.5, median=1, count=3),
+        dict(geometry="b", url="s3://b.tif"),
+    ]
+    columns = zonal_stats.loads(zonal_stats.dumps(rows))
+    assert list(columns["url"]) == ["s3://a.tif", "s3://b.tif"]
+    assert columns["mean"][0] == 1.5
+    assert numpy.isnan(columns["mean"][1])
+    assert numpy.isnan(columns["std"][0])
+
+
+@mock_s3
+def test_handler(cog, store):
+    """Missing statistics should be computed and stored."""
+    from covid_api.api import utils
+    from covid_api.db import zonal_stats
+    from covid_api.db.static.sites import sites
+
+    _setup_s3()
+    with patch("covid_api.db.handles.rasterio") as rio:
+        rio.open = cog
+        assert zonal_stats.handler({}, {}) == 3 * len(sites.list())
+
+    store._expires = 0
+    geometry_hash = utils.get_geometry_hash(sites.get("ny").polygon.dict())
+    url = "s3://covid-eo-data/xco2-mean/xco2_16day_mean.2020_01_02.tif"
+    stats = store.get(geometry_hash, url)
+    assert stats["mean"] == pytest.approx(2)
+    assert stats["median"] == 2
+    assert stats["std"] == pytest.approx(0)
+    assert stats["count"] > 0
+    assert stats["resolution"] == 1
+    # no COG for this date
+    url = "s3://covid-eo-data/xco2-mean/xco2_16day_mean.2020_01_03.tif"
+    assert store.get(geometry_hash, url) is None
+
+    # only the new statistics are computed
+    store._expires = 0
+    with patch(
+        "covid_api.api.utils.get_zonal_stats", wraps=utils.get_zonal_stats
+    ) as get_zonal_stats:
+        assert zonal_stats.handler({}, {}) == 3 * len(sites.list())
+        assert get_zonal_stats.call_count == 0
+
+
+@mock_s3
+def test_handler_checkpoints(cog, store):
+    """A run stopped before the Lambda timeout should save its progress."""
+    from covid_api.db import zonal_stats
+    from covid_api.db.static.sites import sites
+
+    class Context:
+        def __init__(self, remaining):
+            self.remaining = list(remaining)
+
+        def get_remaining_time_in_millis(self):
+            return self.remaining.pop(0)
+
+    _setup_s3()
+    with patch("covid_api.db.handles.rasterio") as rio, patch(
+        "covid_api.db.zonal_stats.ZONAL_STATS_CHECKPOINT_ROWS", 2
+    ):
+        rio.open = cog
+        # time for a single batch
+        assert zonal_stats.handler({}, Context([900000, 1000])) == 2
+
+        store._expires = 0
+        assert len(store.rows()) == 2
+        assert zonal_stats.handler({}, {}) == 3 * len(sites.list())
+
+
+@mock_s3
+def test_handler_read_error(cog, store):
+    """COGs which failed to be read for another reason should be retried."""
+    from covid_api.db import zonal_stats
+    from covid_api.db.static.sites import sites
+
+    def _open(url, *args, **kwargs):
+        if url.endswith("2020_01_02.tif"):
+            raise rasterio.errors.RasterioIOError(f"{url}: Connection timed out")
+        return cog(url, *args, **kwargs)
+
+    _setup_s3()
+    with patch("covid_api.db.handles.rasterio") as rio:
+        rio.open = _open
+        assert zonal_stats.handler({}, {}) == 2 * len(sites.list())
+
+        store._expires = 0
+        rio.open = cog
+        assert zonal_stats.handler({}, {}) == 3 * len(sites.list())
+
+
+@mock_s3
+def test_handler_unreadable_store(store):
+    """The store shouldn't be computed again when it can't be read."""
+    from covid_api.db import zonal_stats
+
+    bucket = _setup_s3()
+    bucket.put_object(Body=b"not a npz", Key=ZONAL_STATS_STORE_FILENAME)
+    with patch("covid_api.db.zonal_stats._get_targets") as get_targets:
+        with pytest.raises(Exception):
+            zonal_stats.handler({}, {})
+        assert not get_targets.called
+
+    # unless asked to
+    with patch("covid_api.db.zonal_stats._get_targets", return_value=[]):
+        assert zonal_stats.handler({"recompute": True}, {}) == 0
+    store._expires = 0
+    assert store.rows() == []
+
+
+@mock_s3
+def test_timelapse_precomputed(app, store):
+    """Spotlight polygons statistics should be read from the store."""
+    from covid_api.api import utils
+    from covid_api.db import zonal_stats
+    from covid_api.db.static.sites import sites
+
+    bucket = _setup_s3()
+    geometry = sites.get("ny").polygon.dict()
+    bucket.put_object(
+        Body=zonal_stats.dumps(
+            [
+                dict(
+                    geometry=utils.get_geometry_hash(geometry),
+                    url="s3://covid-eo-data/xco2-mean/xco2_16day_mean.2020_01_02.tif",
+                    mean=2.5,
+                    median=2,
+                    p10=1,
+                    resolution=1,
+                )
+            ]
+        ),
+        Key=ZONAL_STATS_STORE_FILENAME,
+    )
+
+    feature = {"type": "Feature", "properties": {}, "geometry": geometry}
+    with patch("covid_api.api.utils.get_zonal_stat") as get_zonal_stat:
+        response = app.post(
+            "/v1/timelapse",
+            json={
+                "date": "2020_01_02",
+                "datasetId": "co2",
+                "geojson": feature,
+                "stats": ["p10"],
+            },
+        )
+        assert response.status_code == 200
+        assert response.json() == {"mean": 2.5, "median": 2, "p10": 1, "resolution": 1}
+        assert not get_zonal_stat.called
+
+
+def test_polygon_coordinates():
+    """Spotlight polygons shouldn't be truncated to integer coordinates."""
+    from covid_api.api import utils  # noqa: F401 (rio-tiler imported first)
+    from covid_api.models.timelapse import Feature
+
+    feature = Feature(
+        type="Feature",
+        properties={},
+        geometry={
+            "type": "Polygon",
+            "coordinates": [[[0.5, 0.5], [1.5, 0.5], [1.5, 1.5], [0.5, 0.5]]],
+        },
+    )
+    assert feature.geometry.coordinates[0][0] == (0.5, 0.5)